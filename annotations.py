@@ -0,0 +1,102 @@
+"""
+This module reads annotation boxes, e.g. detector output, from JSON and CSV files.
+
+JSON files contain a list of boxes, or an object with a "boxes" list. CSV files have a header row.
+Every box has the fields:
+- x, y, width, height: the box in image pixels (required);
+- color: "#RRGGBB", a color name such as "red", or an [R, G, B] list in JSON (default: blue);
+- fill: whether the box is filled instead of outlined (default: false);
+- thickness: the outline thickness in pixels (default: 2);
+- label: a text drawn above the box (default: none).
+Other fields, such as a detector score, are ignored.
+"""
+import csv
+import json
+import os
+from operations import Box
+
+COLOR_NAMES = {
+    'blue': (255, 0, 0),
+    'green': (0, 255, 0),
+    'red': (0, 0, 255),
+    'yellow': (0, 255, 255),
+    'cyan': (255, 255, 0),
+    'magenta': (255, 0, 255),
+    'orange': (0, 165, 255),
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+}
+
+
+def parse_color(value):
+    """Return the BGR tuple of a "#RRGGBB" string, a color name or an [R, G, B] list"""
+    if isinstance(value, (list, tuple)) and len(value) == 3:
+        red, green, blue = (int(component) for component in value)
+        if all(0 <= component <= 255 for component in (red, green, blue)):
+            return blue, green, red
+    elif isinstance(value, str):
+        text = value.strip().lower()
+        if text in COLOR_NAMES:
+            return COLOR_NAMES[text]
+        if text.startswith('#') and len(text) == 7:
+            red, green, blue = (int(text[i:i + 2], 16) for i in (1, 3, 5))
+            return blue, green, red
+    raise ValueError(f"Invalid color {value!r}.")
+
+
+def parse_flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'filled', 'fill')
+    return bool(value)
+
+
+def make_box(record):
+    """Create a Box from a dictionary of fields"""
+    box = Box(int(float(record['x'])), int(float(record['y'])),
+              int(float(record['width'])), int(float(record['height'])))
+    if record.get('color') not in (None, ''):
+        box = box._replace(color=parse_color(record['color']))
+    if record.get('fill') not in (None, ''):
+        box = box._replace(fill=parse_flag(record['fill']))
+    if record.get('thickness') not in (None, ''):
+        box = box._replace(thickness=max(1, int(float(record['thickness']))))
+    if record.get('label') not in (None, ''):
+        box = box._replace(label=str(record['label']))
+    return box
+
+
+def load_boxes(file_path):
+    """
+    Read annotation boxes from a JSON or CSV file.
+
+    Returns:
+        tuple: The Box annotations, in file order.
+
+    Raises:
+        ValueError: If the file is malformed, naming the first invalid box.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, newline='', encoding='utf-8') as f:
+        if extension == '.json':
+            try:
+                records = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON: {e}.") from None
+            if isinstance(records, dict):
+                records = records.get('boxes', [])
+        elif extension == '.csv':
+            records = list(csv.DictReader(f))
+        else:
+            raise ValueError(f"Unsupported box file format {extension!r}, use .json or .csv.")
+
+    if not isinstance(records, list):
+        raise ValueError("Expected a list of boxes.")
+    boxes = []
+    for index, record in enumerate(records, 1):
+        try:
+            boxes.append(make_box(record))
+        except KeyError as e:
+            raise ValueError(f"Invalid box {index}: missing field {e}.") from None
+        except (TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"Invalid box {index}: {e}") from None
+    return tuple(boxes)
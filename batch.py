@@ -0,0 +1,200 @@
+"""
+This module runs a recipe of editing operations over many image files without a GUI.
+
+The work is spread over a process pool so that every core decodes, edits and encodes its own files.
+
+Usage:
+    python main.py --batch INPUT [INPUT ...] --output DIR --op brightness:70 --op resize:640x480
+
+    Each INPUT is an image file or a directory, which is searched for PNG and JPG files.
+    The operations are applied in the order they are given, see operations.parse_step for the syntax.
+
+OpenCV and the operations are imported by the functions that use them, so that main.py can register
+the batch options without delaying the window.
+"""
+import os
+import time
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def collect_inputs(paths, recursive=False):
+    """Expand files and directories into a sorted list of image files"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+                if not recursive:
+                    break
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError(f"File {path} not found.")
+    return sorted(files)
+
+
+def output_path_for(file_path, output_dir, extension=None, root=None):
+    """
+    Return the path the edited version of file_path is written to.
+
+    Args:
+        file_path (str): The input image.
+        output_dir (str): The directory the results are written to.
+        extension (str): Output file extension, the input extension by default.
+        root (str): The input directory file_path was found in, its path relative to root is kept
+            under output_dir. Only its name is kept by default.
+    """
+    relative = os.path.relpath(file_path, root) if root is not None else os.path.basename(file_path)
+    name, original_extension = os.path.splitext(relative)
+    return os.path.join(output_dir, name + (extension or original_extension))
+
+
+def output_paths(files, inputs, output_dir, extension=None):
+    """
+    Return the paths the edited files are written to.
+
+    Files found in an input directory keep their path relative to it, so a --recursive batch mirrors
+    the directory tree under output_dir. Files given directly keep their name.
+
+    Args:
+        files (list): The input image paths, as returned by collect_inputs.
+        inputs (list): The files and directories collect_inputs expanded.
+        output_dir (str): The directory the results are written to.
+        extension (str): Output file extension, the input extension by default.
+
+    Returns:
+        list: The output path of each file.
+
+    Raises:
+        ValueError: If two files would be written to the same path, e.g. a.png and a.jpg with --format .png.
+    """
+    directories = [os.path.abspath(path) for path in inputs if os.path.isdir(path)]
+    outputs = []
+    written = {}
+    for file_path in files:
+        absolute = os.path.abspath(file_path)
+        root = next((directory for directory in directories
+                     if os.path.commonpath([directory, absolute]) == directory), None)
+        output_path = output_path_for(absolute, output_dir, extension, root)
+        key = os.path.normcase(os.path.abspath(output_path))
+        if key in written:
+            raise ValueError(f"{written[key]} and {file_path} would both be written to {output_path}.")
+        written[key] = file_path
+        outputs.append(output_path)
+    return outputs
+
+
+def _init_worker():
+    import cv2
+
+    # Each process already owns a core, OpenCV's own thread pool would only oversubscribe them
+    cv2.setNumThreads(1)
+
+
+def process_file(file_path, output_path, steps):
+    """
+    Load one file, apply the steps and save the result.
+
+    Returns:
+        tuple: The input path and an error message, or None on success.
+    """
+    from operations import load_image, save_image, apply_operations
+
+    try:
+        image = load_image(file_path)
+        if image is None:
+            return file_path, "Failed to decode image."
+        image = apply_operations(image, steps, copy=False)
+        save_image(image, output_path)
+        return file_path, None
+    except Exception as e:
+        return file_path, str(e)
+
+
+def run_batch(files, output_dir, steps, workers=None, extension=None, progress=None, outputs=None):
+    """
+    Process the files in parallel.
+
+    Args:
+        files (list): The input image paths.
+        output_dir (str): The directory the results are written to.
+        steps (list): The (name, params) operations to apply.
+        workers (int): The number of worker processes, all cores by default.
+        extension (str): Output file extension, the input extension by default.
+        progress (callable): Called with (done, total) after every file.
+        outputs (list): The output path of each file, see output_paths. By default every file is
+            written under its name.
+
+    Returns:
+        list: (path, error) tuples for the files that failed.
+
+    Raises:
+        ValueError: If two files would be written to the same path.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if outputs is None:
+        outputs = output_paths(files, files, output_dir, extension)
+    for directory in {os.path.dirname(output_path) for output_path in outputs} | {output_dir}:
+        os.makedirs(directory, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    failures = []
+    total = len(files)
+    # Small chunks keep all workers busy while amortizing the inter-process round trips
+    chunksize = max(1, min(32, total // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        results = executor.map(process_file, files, outputs, [steps] * total, chunksize=chunksize)
+        for done, (file_path, error) in enumerate(results, 1):
+            if error is not None:
+                failures.append((file_path, error))
+            if progress is not None:
+                progress(done, total)
+    return failures
+
+
+def add_arguments(parser):
+    """Register the batch processing command line options on an argparse parser"""
+    parser.add_argument('--batch', nargs='+', metavar='INPUT',
+                        help="process image files or directories without opening the window")
+    parser.add_argument('--output', '-o', metavar='DIR', help="directory for the processed images")
+    parser.add_argument('--op', action='append', default=[], metavar='STEP',
+                        help="operation to apply, e.g. channel:R, brightness:70, "
+                             "rectangle:X,Y,W,H, resize:WxH, boxes:FILE (repeatable, applied in order)")
+    parser.add_argument('--workers', type=int, help="number of worker processes (default: all cores)")
+    parser.add_argument('--format', dest='extension', metavar='EXT',
+                        help="output format extension, e.g. .jpg (default: same as input)")
+    parser.add_argument('--recursive', action='store_true', help="search input directories recursively")
+
+
+def run_from_arguments(args):
+    """Run a batch described by parsed command line arguments and return the exit code"""
+    from operations import parse_step
+
+    if not args.output:
+        print("error: --output is required with --batch")
+        return 2
+    extension = args.extension
+    if extension and not extension.startswith('.'):
+        extension = '.' + extension
+    try:
+        steps = [parse_step(text) for text in args.op]
+        files = collect_inputs(args.batch, args.recursive)
+        # Name collisions are reported before any file is processed
+        outputs = output_paths(files, args.batch, args.output, extension)
+    except (ValueError, FileNotFoundError) as e:
+        print(f"error: {e}")
+        return 2
+
+    start = time.perf_counter()
+    failures = run_batch(files, args.output, steps, args.workers, extension, outputs=outputs)
+    elapsed = time.perf_counter() - start
+
+    for file_path, error in failures:
+        print(f"failed: {file_path}: {error}")
+    processed = len(files) - len(failures)
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed}/{len(files)} images in {elapsed:.2f} s ({rate:.1f} images/s)")
+    return 1 if failures else 0
@@ -0,0 +1,586 @@
+"""
+This script benchmarks the load, edit, display and camera paths of the Photo Editor application.
+
+It runs headless on the offscreen Qt platform with synthetic images, so results are reproducible
+on any machine. Every benchmark case runs in a fresh process, so its peak RSS is not inflated by the
+cases before it. Results are written as JSON and can be compared with an earlier run to catch
+performance regressions.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 1,24 --cases load,brightness --output quick.json
+    python benchmark.py --output new.json --compare baseline.json --threshold 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES_MP = (1, 12, 24, 50, 100)
+CAMERA_FRAME_SIZE = (1920, 1080)
+# The camera cases run at CAMERA_FRAME_SIZE for --camera-frames frames instead of at every image size
+CAMERA_CASES = ('camera', 'camera_record', 'camera_grid')
+# The number of sources captured at once by the camera_grid case
+GRID_SOURCES = 4
+# A camera case fails when no frame arrives for this long, e.g. when a capture thread died
+FRAME_TIMEOUT_SECONDS = 10.0
+# A case whose process has not reported after this long is stopped and reported as failed
+CASE_TIMEOUT_SECONDS = 1800.0
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None if unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _windows_peak_rss():
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def synthetic_image(width, height, seed=0):
+    """Return a reproducible BGR test image with smooth gradients and mild noise, like a photo"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    # Gradients stop at 231, so adding the noise never overflows
+    x = np.linspace(0, 231, width, dtype=np.float32)
+    y = np.linspace(0, 231, height, dtype=np.float32)[:, np.newaxis]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = x
+    image[..., 1] = y
+    image[..., 2] = (x + y) / 2
+    # Noise on a coarse grid keeps the image compressible while avoiding flat regions
+    noise = rng.integers(0, 24, size=(height // 8 + 1, width // 8 + 1), dtype=np.uint8)
+    image += np.repeat(np.repeat(noise, 8, axis=0), 8, axis=1)[:height, :width, np.newaxis]
+    return image
+
+
+def size_for_megapixels(megapixels):
+    """Return a 3:2 (width, height) with approximately the given number of megapixels"""
+    height = int((megapixels * 1e6 / 1.5) ** 0.5)
+    return int(height * 1.5), height
+
+
+def _timed(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _create_window():
+    from PyQt5.QtWidgets import QApplication
+    from main_window import MainWindow
+
+    app = QApplication.instance() or QApplication([sys.argv[0]])
+    window = MainWindow()
+    window.show()
+    app.processEvents()
+    return app, window
+
+
+def bench_load(width, height, repeat):
+    """Decode a JPEG file with MainWindow.load_image_with_cv2"""
+    import cv2
+    from main_window import MainWindow
+
+    handle, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(handle)
+    try:
+        cv2.imwrite(path, synthetic_image(width, height), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        return _timed(lambda: MainWindow.load_image_with_cv2(path), repeat), {}
+    finally:
+        os.remove(path)
+
+
+def bench_first_pixel(width, height, repeat):
+    """Time from starting a background load of a JPEG file until its first preview is ready"""
+    import cv2
+    import loader
+
+    handle, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(handle)
+
+    def first_pixel():
+        thread = loader.LoadThread(path, (800, 600))
+        start = time.perf_counter()
+        thread.start()
+        while thread.results.get()[0] not in (loader.PREVIEW, loader.DONE, loader.ERROR):
+            pass
+        latency = time.perf_counter() - start
+        # The full decode cannot be interrupted, wait for it outside of the measurement
+        thread.cancel()
+        thread.join()
+        return latency
+
+    try:
+        cv2.imwrite(path, synthetic_image(width, height), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        return [first_pixel() for _ in range(repeat)], {}
+    finally:
+        os.remove(path)
+
+
+def bench_pan(width, height, repeat):
+    """Pan a 100% view of the image in the canvas and repaint it, as a mouse drag would"""
+    from PyQt5.QtCore import QPointF
+
+    app, window = _create_window()
+    window.set_image(synthetic_image(width, height))
+    canvas = window.canvas
+    canvas.set_zoom(1.0)
+    # The first paint at 100% requests the visible full-resolution tiles, later frames only draw the visible pixels
+    canvas.repaint()
+    while canvas.pending_tiles():
+        app.processEvents()
+        time.sleep(0.001)
+    canvas.repaint()
+
+    def pan():
+        canvas.offset = QPointF(canvas.offset.x() - 16, canvas.offset.y() - 9)
+        canvas.clamp_view()
+        canvas.repaint()
+
+    return _timed(pan, repeat), {}
+
+
+def _bench_operation(width, height, repeat, name, params):
+    import operations
+
+    image = synthetic_image(width, height)
+    return _timed(lambda: operations.apply_operation(image, name, params), repeat), {}
+
+
+def bench_channel(width, height, repeat):
+    """Extract the red channel at full resolution"""
+    return _bench_operation(width, height, repeat, 'channel', {'channel': 'R'})
+
+
+def bench_brightness(width, height, repeat):
+    """Scale brightness to 70% at full resolution"""
+    return _bench_operation(width, height, repeat, 'brightness', {'percentage': 70})
+
+
+def bench_rectangle(width, height, repeat):
+    """Fill a rectangle covering a quarter of the image in place"""
+    return _bench_operation(width, height, repeat, 'rectangle',
+                            {'x': width // 4, 'y': height // 4, 'width': width // 2, 'height': height // 2})
+
+
+def bench_boxes(width, height, repeat):
+    """Draw 2000 labelled detector boxes, a fifth of them filled, in place"""
+    import numpy as np
+    from operations import Box
+
+    rng = np.random.default_rng(0)
+    boxes = tuple(Box(int(x), int(y), int(w), int(h), (255, 0, 0), bool(fill), 2, 'person')
+                  for x, y, w, h, fill in zip(rng.integers(0, width, 2000), rng.integers(0, height, 2000),
+                                              rng.integers(10, max(11, width // 20), 2000),
+                                              rng.integers(10, max(11, height // 20), 2000),
+                                              rng.random(2000) < 0.2))
+    return _bench_operation(width, height, repeat, 'boxes', {'boxes': boxes})
+
+
+def bench_resize(width, height, repeat):
+    """Resize to half the size"""
+    return _bench_operation(width, height, repeat, 'resize', {'width': width // 2, 'height': height // 2})
+
+
+def bench_recipe(width, height, repeat):
+    """Apply a brightness, red channel and brightness recipe fused into one pass, against step by step"""
+    import numpy as np
+    import operations
+
+    image = synthetic_image(width, height)
+    steps = [('brightness', {'percentage': 70}), ('channel', {'channel': 'R'}), ('brightness', {'percentage': 130})]
+
+    def unfused():
+        result = image
+        for name, params in steps:
+            result = operations.apply_operation(result, name, params)
+
+    fused = _timed(lambda: operations.apply_operations(image, steps), repeat)
+    step_by_step = _timed(unfused, repeat)
+    median = float(np.median(step_by_step)) * 1000
+    return fused, {'unfused_p50_ms': median, 'speedup': median / (float(np.median(fused)) * 1000)}
+
+
+def bench_session_reopen(width, height, repeat):
+    """Reopen a saved session and fit its stored preview to the display, against decoding the JPEG source"""
+    import numpy as np
+    import loader
+    import operations
+    import session
+    from document import Document
+
+    directory = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(directory, 'source.jpg')
+        operations.save_image(synthetic_image(width, height), source_path)
+        steps = [('brightness', {'percentage': 70}), ('channel', {'channel': 'R'})]
+        document = Document(operations.load_image(source_path), steps)
+        session_path = os.path.join(directory, 'source' + session.SESSION_EXTENSION)
+        session.write_session(session_path, steps, len(steps), document.output_size(),
+                              document.render(session.preview_size(document.output_size())), source_path=source_path)
+
+        def reopen():
+            session.read_session(session_path).pyramid.fit(*(800, 600))
+
+        latencies = _timed(reopen, repeat)
+        decode = _timed(lambda: loader.load_full(source_path, (800, 600)), repeat)
+        extra = {'decode_p50_ms': float(np.median(decode)) * 1000,
+                 'session_bytes': os.path.getsize(session_path)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return latencies, extra
+
+
+def bench_histogram(width, height, repeat):
+    """Compute the per-channel histograms and statistics of a still image on its decimated sample"""
+    import histogram
+
+    image = synthetic_image(width, height)
+    return _timed(lambda: histogram.compute_statistics(image), repeat), {}
+
+
+def bench_window_edit(width, height, repeat):
+    """Apply a brightness edit through the window and display its preview, as a click would"""
+    app, window = _create_window()
+    window.set_image(synthetic_image(width, height))
+    percentages = [50 + index % 50 for index in range(repeat)]
+
+    def edit(percentage):
+        window.apply_brightness(percentage)
+        # The canvas paints on the next event loop iteration
+        app.processEvents()
+
+    latencies = [_timed(lambda: edit(percentage), 1)[0] for percentage in percentages]
+    # Wait for the background commits, they would otherwise overlap with the next case
+    commit = _timed(window.full_resolution_image, 1)[0]
+    return latencies, {'final_commit_seconds': commit}
+
+
+def _check_frame_deadline(last_frame):
+    """Raise TimeoutError if no frame was displayed for FRAME_TIMEOUT_SECONDS since last_frame"""
+    if time.perf_counter() - last_frame > FRAME_TIMEOUT_SECONDS:
+        raise TimeoutError(f"No camera frame for {FRAME_TIMEOUT_SECONDS:.0f} s.")
+
+
+def _bench_camera(width, height, repeat, record=False):
+    app, window = _create_window()
+    window.camera_sources = [f'synthetic:{width}x{height}@0']
+    window.start_capture()
+    # Drive update_frame directly instead of from the timer, so every call is measured
+    window.timer.stop()
+    thread = window.capture_thread
+    recorder = None
+    if record:
+        import camera
+
+        directory = tempfile.mkdtemp()
+        recorder = camera.VideoRecorder(os.path.join(directory, 'recording.avi'), 30.0)
+        thread.sinks = thread.sinks + (recorder,)
+
+    latencies = []
+    displayed = 0
+    start = time.perf_counter()
+    try:
+        last_frame = start
+        while displayed < repeat:
+            if not len(thread.buffer):
+                _check_frame_deadline(last_frame)
+                time.sleep(0.0005)
+                continue
+            call_start = time.perf_counter()
+            window.update_frame()
+            app.processEvents()
+            last_frame = time.perf_counter()
+            latencies.append(last_frame - call_start)
+            displayed += 1
+        elapsed = time.perf_counter() - start
+        captured = thread.frames_captured
+        dropped = thread.dropped
+    finally:
+        window.stop_capture()
+    extra = {'display_fps': displayed / elapsed, 'capture_fps': captured / elapsed,
+             'frames_captured': captured, 'frames_dropped': dropped}
+    if recorder is not None:
+        recorder.stop()
+        extra.update(frames_recorded=recorder.frames_written, frames_not_recorded=recorder.dropped)
+        shutil.rmtree(directory, ignore_errors=True)
+    return latencies, extra
+
+
+def bench_camera_grid(width, height, repeat):
+    """Run the grid view of GRID_SOURCES synthetic sources producing frames as fast as possible"""
+    app, window = _create_window()
+    window.camera_sources = [f'synthetic:{width}x{height}@0'] * GRID_SOURCES
+    window.start_capture()
+    window.timer.stop()
+    grid = window.camera_grid
+
+    latencies = []
+    displayed = 0
+    start = time.perf_counter()
+    try:
+        last_frame = start
+        while displayed < repeat:
+            if not any(len(thread.buffer) for thread in grid.threads):
+                _check_frame_deadline(last_frame)
+                time.sleep(0.0005)
+                continue
+            call_start = time.perf_counter()
+            window.update_frame()
+            app.processEvents()
+            last_frame = time.perf_counter()
+            latencies.append(last_frame - call_start)
+            displayed += 1
+        elapsed = time.perf_counter() - start
+        captured = [thread.frames_captured for thread in grid.threads]
+        source_latencies = list(grid.latencies)
+    finally:
+        window.stop_capture()
+    extra = {'display_fps': displayed / elapsed, 'capture_fps': sum(captured) / elapsed,
+             'source_fps': [round(count / elapsed, 1) for count in captured],
+             'source_latency_ms': [round(latency * 1000, 1) for latency in source_latencies]}
+    return latencies, extra
+
+
+def bench_camera(width, height, repeat):
+    """Run the camera update_frame loop on a synthetic source producing frames as fast as possible"""
+    return _bench_camera(width, height, repeat)
+
+
+def bench_camera_record(width, height, repeat):
+    """Run the camera loop while recording to an MJPEG file and filling the burst ring"""
+    return _bench_camera(width, height, repeat, record=True)
+
+
+BENCHMARKS = {
+    'load': bench_load,
+    'first_pixel': bench_first_pixel,
+    'pan': bench_pan,
+    'channel': bench_channel,
+    'brightness': bench_brightness,
+    'rectangle': bench_rectangle,
+    'boxes': bench_boxes,
+    'resize': bench_resize,
+    'recipe': bench_recipe,
+    'session_reopen': bench_session_reopen,
+    'histogram': bench_histogram,
+    'window_edit': bench_window_edit,
+    'camera': bench_camera,
+    'camera_record': bench_camera_record,
+    'camera_grid': bench_camera_grid,
+}
+
+
+def run_case(name, width, height, repeat, warmup):
+    """Run one benchmark case in the current process and return its result"""
+    import numpy as np
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    benchmark = BENCHMARKS[name]
+    if warmup and name not in CAMERA_CASES:
+        benchmark(width, height, warmup)
+
+    latencies, extra = benchmark(width, height, repeat)
+    latencies = np.array(latencies)
+    total = latencies.sum()
+    return dict({
+        'case': name,
+        'width': width,
+        'height': height,
+        'megapixels': round(width * height / 1e6, 2),
+        'repeat': len(latencies),
+        'mean_ms': float(latencies.mean() * 1000),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p90_ms': float(np.percentile(latencies, 90) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'max_ms': float(latencies.max() * 1000),
+        'throughput_per_s': float(len(latencies) / total) if total > 0 else None,
+        'megapixels_per_s': float(width * height * len(latencies) / total / 1e6) if total > 0 else None,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }, **extra)
+
+
+def _case_process(queue, name, width, height, repeat, warmup):
+    try:
+        queue.put(run_case(name, width, height, repeat, warmup))
+    except Exception as e:
+        queue.put({'case': name, 'width': width, 'height': height, 'error': f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(name, width, height, repeat, warmup, timeout=CASE_TIMEOUT_SECONDS):
+    """
+    Run one benchmark case in a fresh process, so peak RSS is measured per case.
+
+    A process that crashes, or does not report within timeout seconds, is reported as a failed case.
+    """
+    from queue import Empty
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_case_process, args=(queue, name, width, height, repeat, warmup))
+    process.start()
+    deadline = time.monotonic() + timeout
+    error = None
+    while True:
+        try:
+            result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            pass
+        if not process.is_alive():
+            # The result may have been sent just before the process exited
+            try:
+                result = queue.get(timeout=1.0)
+                break
+            except Empty:
+                error = f"The benchmark process exited with code {process.exitcode}."
+                break
+        if time.monotonic() > deadline:
+            process.terminate()
+            error = f"Timed out after {timeout:.0f} s."
+            break
+    process.join()
+    if error is not None:
+        return {'case': name, 'width': width, 'height': height, 'error': error}
+    return result
+
+
+def environment():
+    """Describe the machine and revision the results were measured on"""
+    import cv2
+    import numpy as np
+    from PyQt5.QtCore import QT_VERSION_STR
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        'revision': revision,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'qt': QT_VERSION_STR,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare p50 latencies with a baseline run.
+
+    Returns:
+        list: Descriptions of the cases that got slower by more than threshold percent.
+    """
+    previous = {(item['case'], item['width'], item['height']): item
+                for item in baseline['results'] if 'error' not in item}
+    regressions = []
+    for item in results:
+        old = previous.get((item['case'], item['width'], item['height']))
+        if old is None or 'error' in item:
+            continue
+        change = (item['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0.0
+        line = (f"{item['case']:12} {item['megapixels']:7.1f} MP  p50 {old['p50_ms']:9.2f} -> "
+                f"{item['p50_ms']:9.2f} ms ({change:+.1f}%)")
+        print(line)
+        if change > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Photo Editor benchmarks")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES_MP),
+                        help="comma-separated image sizes in megapixels (default: %(default)s)")
+    parser.add_argument('--cases', default=','.join(BENCHMARKS),
+                        help="comma-separated benchmark cases (default: all)")
+    parser.add_argument('--repeat', type=int, default=10, help="measured iterations per case (default: 10)")
+    parser.add_argument('--warmup', type=int, default=1, help="unmeasured iterations per case (default: 1)")
+    parser.add_argument('--camera-frames', type=int, default=300,
+                        help="frames displayed in the camera case (default: 300)")
+    parser.add_argument('--timeout', type=float, default=CASE_TIMEOUT_SECONDS,
+                        help="seconds after which a case is stopped and reported as failed (default: %(default)s)")
+    parser.add_argument('--output', '-o', default='benchmark_results.json', help="JSON results file")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="p50 slowdown in percent reported as a regression (default: 10)")
+    args = parser.parse_args(argv)
+
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    unknown = [case for case in cases if case not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+    sizes = [size_for_megapixels(float(size)) for size in args.sizes.split(',')]
+
+    results = []
+    for case in cases:
+        # The camera loop runs at a fixed frame size, the image sizes do not apply to it
+        case_sizes = [CAMERA_FRAME_SIZE] if case in CAMERA_CASES else sizes
+        repeat = args.camera_frames if case in CAMERA_CASES else args.repeat
+        for width, height in case_sizes:
+            result = run_isolated(case, width, height, repeat, args.warmup, args.timeout)
+            results.append(result)
+            if 'error' in result:
+                print(f"{case:12} {width}x{height}: {result['error']}")
+            else:
+                rss = result['peak_rss_bytes']
+                print(f"{case:12} {result['megapixels']:7.1f} MP  p50 {result['p50_ms']:9.2f} ms  "
+                      f"p99 {result['p99_ms']:9.2f} ms  {result['throughput_per_s']:8.1f}/s  "
+                      f"peak RSS {rss / 1024 ** 2 if rss else float('nan'):8.1f} MB")
+
+    report = {'environment': environment(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold}%")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
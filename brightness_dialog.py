@@ -1,50 +1,79 @@
 """
 This module defines a dialog for adjusting the brightness of an image
 """
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtGui import QIntValidator
-from PyQt5.QtWidgets import QLabel, QVBoxLayout, QDialog, QLineEdit, QDialogButtonBox
+from PyQt5.QtWidgets import QLabel, QVBoxLayout, QDialog, QLineEdit, QDialogButtonBox, QSlider
+
+MAX_PERCENTAGE = 200
 
 
 class BrightnessDialog(QDialog):
     """
     A dialog for adjusting the brightness of an image.
 
+    While the slider or the text field changes, percentage_changed is emitted once the value has
+    been stable for PREVIEW_DELAY_MS, so the caller can preview the adjustment live.
+
     Attributes:
         layout (QVBoxLayout): The layout of the dialog.
         label (QLabel): The label that displays instructions.
+        slider (QSlider): The slider for choosing the brightness percentage.
         line_edit (QLineEdit): The input field for entering the brightness percentage.
         button_box (QDialogButtonBox): The box containing OK and Cancel buttons.
+        preview_timer (QTimer): The single-shot timer that debounces preview updates.
     """
+    PREVIEW_DELAY_MS = 15
+
+    percentage_changed = pyqtSignal(int)
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Adjust Brightness")
 
         self.layout = QVBoxLayout(self)
-        self.label = QLabel("Enter the percentage of brightness (0-100):", self)
+        self.label = QLabel(f"Enter the percentage of brightness (0-{MAX_PERCENTAGE}):", self)
+        self.slider = QSlider(Qt.Horizontal, self)
+        self.slider.setRange(0, MAX_PERCENTAGE)
+        self.slider.setValue(100)
         self.line_edit = QLineEdit(self)
-        self.line_edit.setValidator(QIntValidator(0, 100, self))
+        self.line_edit.setValidator(QIntValidator(0, MAX_PERCENTAGE, self))
         self.line_edit.setText("100")
 
         self.buttons = QDialogButtonBox.Ok | QDialogButtonBox.Cancel
         self.button_box = QDialogButtonBox(self.buttons)
         self.button_box.button(QDialogButtonBox.Ok).setEnabled(False)
 
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(self.PREVIEW_DELAY_MS)
+        self.preview_timer.timeout.connect(lambda: self.percentage_changed.emit(self.slider.value()))
+
+        self.slider.valueChanged.connect(self.on_slider_changed)
         self.line_edit.textChanged.connect(self.validate_input)
         self.button_box.accepted.connect(self.accept)
         self.button_box.rejected.connect(self.reject)
 
         self.layout.addWidget(self.label)
+        self.layout.addWidget(self.slider)
         self.layout.addWidget(self.line_edit)
         self.layout.addWidget(self.button_box)
 
+    def on_slider_changed(self, value):
+        """Mirror the slider value in the line edit and schedule a preview"""
+        if self.line_edit.text() != str(value):
+            self.line_edit.setText(str(value))
+        self.preview_timer.start()
+
     def validate_input(self):
         """
         Validate the input in the line edit field.
-        Enables the OK button if the input is a valid percentage (0-100).
+        Enables the OK button if the input is a valid percentage and moves the slider to it.
         """
         text = self.line_edit.text()
-        if text.isdigit() and 0 <= int(text) <= 100:
+        if text.isdigit() and 0 <= int(text) <= MAX_PERCENTAGE:
             self.button_box.button(QDialogButtonBox.Ok).setEnabled(True)
+            self.slider.setValue(int(text))
         else:
             self.button_box.button(QDialogButtonBox.Ok).setEnabled(False)
 
@@ -0,0 +1,608 @@
+"""
+This module defines the camera capture pipeline of the Photo Editor application.
+
+Frames are read by a dedicated capture thread from a frame source and pushed into a small ring buffer.
+When the consumer falls behind, the oldest frames are dropped, so the main window only ever
+displays the newest frame and never blocks on the device.
+
+Frame sources:
+- CameraSource: a camera device opened with cv2.VideoCapture;
+- VideoFileSource: a video file, optionally paced to its own frame rate and looped;
+- SyntheticSource: generated frames, for tests and benchmarks without a camera.
+
+Several sources are shown at once by CaptureGrid, which runs a capture thread per source and composites
+their newest frames into a grid, with the frame rate and latency of each source over its tile.
+
+Every captured frame is also pushed to the sinks of the capture thread, on the capture thread, whether
+it is displayed or not:
+- VideoRecorder: encodes the frames to a video file on its own thread;
+- BurstBuffer: keeps the last seconds of frames in a preallocated ring, saved with save_burst when
+  the user triggers it.
+Sinks never block and do not allocate per frame, so they do not slow down the live view.
+"""
+import collections
+import math
+import os
+import queue
+import re
+import threading
+import time
+import cv2
+import numpy as np
+
+# The frames that may wait for the video encoder, beyond them frames are left out of the recording
+RECORDER_QUEUE_FRAMES = 32
+# The codec of each video file extension
+VIDEO_CODECS = {'.avi': 'MJPG', '.mp4': 'mp4v'}
+# The memory the burst ring may use, it holds fewer frames than requested for large frames
+BURST_MAX_BYTES = 512 * 1024 ** 2
+# The weight of the newest sample in the moving average of the latency of each grid tile
+LATENCY_SMOOTHING = 0.1
+
+
+class FrameSource:
+    """
+    Base class for the sources frames are captured from.
+
+    Attributes:
+        fps (float): The nominal frame rate of the source, 0 if unknown.
+    """
+    fps = 0.0
+
+    def open(self):
+        """Open the source, raise an exception if it is not available"""
+
+    def read(self):
+        """Return the next BGR frame, or None when the source is exhausted"""
+        raise NotImplementedError
+
+    def release(self):
+        """Release the resources held by the source"""
+
+
+class CameraSource(FrameSource):
+    """A camera device opened with cv2.VideoCapture"""
+    def __init__(self, index=0):
+        self.index = index
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.index)
+        if not self.capture.isOpened():
+            raise IOError("Failed to open camera.")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 0.0
+
+    def read(self):
+        ret, frame = self.capture.read()
+        return frame if ret else None
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+class VideoFileSource(FrameSource):
+    """
+    A video file used in place of a camera.
+
+    Attributes:
+        path (str): The path of the video file.
+        realtime (bool): Whether frames are delivered at the file's frame rate instead of as fast as possible.
+        loop (bool): Whether to restart from the beginning at the end of the file.
+    """
+    def __init__(self, path, realtime=True, loop=True):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.capture = None
+        self._next_time = 0.0
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError(f"Failed to open video file {self.path}.")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self._next_time = time.perf_counter()
+
+    def read(self):
+        ret, frame = self.capture.read()
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        if not ret:
+            return None
+        if self.realtime:
+            self._next_time = _pace(self._next_time, self.fps)
+        return frame
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generated frames with a moving bar and a frame counter, so motion and dropped frames are visible.
+
+    Attributes:
+        width (int): The frame width.
+        height (int): The frame height.
+        fps (float): The frame rate to pace the frames at, 0 to generate them as fast as possible.
+        frame_count (int): The number of frames to produce, None for an endless stream.
+    """
+    def __init__(self, width=640, height=480, fps=30.0, frame_count=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frame_count = frame_count
+        self.index = 0
+        self._background = None
+        self._next_time = 0.0
+
+    def open(self):
+        gradient = np.linspace(0, 255, self.width, dtype=np.uint8)
+        self._background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self._background[...] = gradient[np.newaxis, :, np.newaxis]
+        self.index = 0
+        self._next_time = time.perf_counter()
+
+    def read(self):
+        if self.frame_count is not None and self.index >= self.frame_count:
+            return None
+        frame = self._background.copy()
+        bar_width = max(1, self.width // 16)
+        x = (self.index * 4) % self.width
+        frame[:, x:x + bar_width] = (0, 0, 255)
+        cv2.putText(frame, str(self.index), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 2)
+        self.index += 1
+        if self.fps:
+            self._next_time = _pace(self._next_time, self.fps)
+        return frame
+
+
+def _pace(next_time, fps):
+    """Sleep until next_time and return the deadline of the following frame"""
+    delay = next_time - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+    else:
+        # Fell behind, do not try to catch up with a burst of frames
+        next_time = time.perf_counter()
+    return next_time + 1.0 / fps
+
+
+_SYNTHETIC_SPEC = re.compile(r'synthetic(?::([1-9]\d*)[xX]([1-9]\d*)(?:@(\d+(?:\.\d+)?))?)?')
+
+
+def open_frame_source(spec):
+    """
+    Create a frame source from a textual description.
+
+    Accepted forms:
+        0, 1, ...                       a camera device index
+        synthetic[:WIDTHxHEIGHT[@FPS]]  generated frames
+        PATH                            a video file, any other description, e.g. synthetic.mp4
+    """
+    spec = str(spec)
+    if spec.isdigit():
+        return CameraSource(int(spec))
+    match = _SYNTHETIC_SPEC.fullmatch(spec)
+    if match is not None:
+        width, height, fps = match.groups()
+        # A frame rate of 0 generates the frames as fast as possible
+        return SyntheticSource(int(width or 640), int(height or 480), float(fps) if fps else 30.0)
+    return VideoFileSource(spec)
+
+
+class FrameRingBuffer:
+    """
+    A bounded, thread-safe buffer that drops the oldest frame when it is full.
+
+    Attributes:
+        capacity (int): The maximum number of frames held.
+        dropped (int): The number of frames that were discarded without being consumed.
+    """
+    def __init__(self, capacity=2):
+        self.capacity = capacity
+        self.dropped = 0
+        self._frames = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def put(self, item):
+        """Append an item, discarding the oldest one if the buffer is full"""
+        with self._lock:
+            if len(self._frames) == self.capacity:
+                self.dropped += 1
+            self._frames.append(item)
+            self._available.notify()
+
+    def latest(self):
+        """Return the newest item and discard the older ones, or None if the buffer is empty"""
+        with self._lock:
+            if not self._frames:
+                return None
+            item = self._frames.pop()
+            self.dropped += len(self._frames)
+            self._frames.clear()
+            return item
+
+    def get(self, timeout=None):
+        """Wait for the oldest item and return it, or None on timeout"""
+        with self._available:
+            if not self._frames and not self._available.wait_for(lambda: self._frames, timeout):
+                return None
+            return self._frames.popleft()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._frames)
+
+
+class CapturedFrame:
+    """
+    A frame taken from a source.
+
+    Attributes:
+        index (int): The sequence number of the frame.
+        timestamp (float): The time.perf_counter() value when the frame was read.
+        image (np.ndarray): The full-resolution BGR frame.
+        preview (np.ndarray): The frame downscaled to the display size, or the frame itself.
+    """
+    __slots__ = ('index', 'timestamp', 'image', 'preview')
+
+    def __init__(self, index, timestamp, image, preview):
+        self.index = index
+        self.timestamp = timestamp
+        self.image = image
+        self.preview = preview
+
+
+class CaptureThread(threading.Thread):
+    """
+    Reads frames from a source into a ring buffer until stopped or the source is exhausted.
+
+    The preview for display is downscaled here, so the GUI thread never scales full camera frames.
+
+    Attributes:
+        source (FrameSource): The source frames are read from.
+        buffer (FrameRingBuffer): The buffer the frames are pushed into.
+        display_size (tuple): The (width, height) to fit previews into, None for no preview scaling.
+        frames_captured (int): The number of frames read so far.
+        fps (float): The measured capture rate.
+        sinks (tuple): The objects every frame is pushed to, with a push(frame) method that must not block.
+            Replace the tuple to add or remove one, it is read by the capture thread.
+    """
+    def __init__(self, source, buffer=None, display_size=None):
+        super().__init__(daemon=True)
+        self.source = source
+        self.buffer = buffer if buffer is not None else FrameRingBuffer()
+        self.display_size = display_size
+        self.frames_captured = 0
+        self.fps = 0.0
+        self.error = None
+        self.sinks = ()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last_time = time.perf_counter()
+        try:
+            while not self._stop_event.is_set():
+                image = self.source.read()
+                if image is None:
+                    break
+                now = time.perf_counter()
+                interval = now - last_time
+                last_time = now
+                if interval > 0:
+                    # Exponential moving average smooths out scheduling jitter
+                    rate = 1.0 / interval
+                    self.fps = rate if self.fps == 0.0 else 0.9 * self.fps + 0.1 * rate
+
+                frame = CapturedFrame(self.frames_captured, now, image, self._preview(image))
+                self.buffer.put(frame)
+                for sink in self.sinks:
+                    sink.push(frame)
+                self.frames_captured += 1
+        except Exception as e:
+            self.error = e
+        finally:
+            self.source.release()
+
+    def _preview(self, image):
+        display_size = self.display_size
+        if display_size is None:
+            return image
+        h, w = image.shape[:2]
+        scale = min(display_size[0] / w, display_size[1] / h)
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        if size == (w, h):
+            return image
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+        return cv2.resize(image, size, interpolation=interpolation)
+
+    def stop(self, timeout=1.0):
+        """Ask the thread to finish and wait for it"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    @property
+    def dropped(self):
+        """The number of captured frames that were never displayed"""
+        return self.buffer.dropped
+
+
+def grid_shape(count):
+    """Return the (columns, rows) of the most square grid with room for count tiles"""
+    columns = max(1, math.ceil(math.sqrt(count)))
+    return columns, max(1, math.ceil(count / columns))
+
+
+class CaptureGrid:
+    """
+    Captures several sources at once and composites their newest frames into a grid image.
+
+    Each source has its own CaptureThread, which also downscales its frames to the tile size, so the
+    reading and scaling of each source run in parallel: OpenCV releases the GIL while it decodes and
+    resizes. The GUI thread only copies the tiles that received a new frame into the grid and draws the
+    frame rate and latency of their source over them.
+
+    Attributes:
+        threads (list): The CaptureThread of each source.
+        columns (int): The number of tiles per row.
+        rows (int): The number of tile rows.
+        tile_size (tuple): The (width, height) of each tile.
+        image (np.ndarray): The composited BGR grid, updated in place.
+        frames (list): The newest CapturedFrame of each source, None until its first frame.
+        latencies (list): The smoothed time in seconds from the capture of a frame to its compositing,
+            for each source.
+    """
+    def __init__(self, sources, display_size):
+        self.threads = [CaptureThread(source) for source in sources]
+        self.columns, self.rows = grid_shape(len(self.threads))
+        self.tile_size = None
+        self.image = None
+        self.frames = [None] * len(self.threads)
+        self.latencies = [0.0] * len(self.threads)
+        self.resize(display_size)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stop every capture thread, the sources are released by their threads"""
+        for thread in self.threads:
+            thread.stop(timeout)
+
+    def is_alive(self):
+        """Whether any source is still capturing"""
+        return any(thread.is_alive() for thread in self.threads)
+
+    def resize(self, display_size):
+        """
+        Fit the grid to a new display size.
+
+        Returns:
+            bool: Whether the grid was reallocated, in which case every tile was redrawn.
+        """
+        width, height = max(display_size[0], self.columns), max(display_size[1], self.rows)
+        if self.image is not None and self.image.shape[:2] == (height, width):
+            return False
+        self.image = np.zeros((height, width, 3), dtype=np.uint8)
+        self.tile_size = (width // self.columns, height // self.rows)
+        for thread in self.threads:
+            thread.display_size = self.tile_size
+        for index, frame in enumerate(self.frames):
+            if frame is not None:
+                self._draw_tile(index)
+        return True
+
+    def tile_rect(self, index):
+        """Return the (x, y, width, height) of the tile of a source in the grid"""
+        width, height = self.tile_size
+        return (index % self.columns) * width, (index // self.columns) * height, width, height
+
+    def update(self):
+        """
+        Composite the frames captured since the previous update.
+
+        Returns:
+            tuple: The (y0, y1, x0, x1) region of the grid that changed, None if no tile did.
+        """
+        now = time.perf_counter()
+        dirty = None
+        for index, thread in enumerate(self.threads):
+            frame = thread.buffer.latest()
+            if frame is None:
+                continue
+            self.frames[index] = frame
+            latency = now - frame.timestamp
+            previous = self.latencies[index]
+            self.latencies[index] = latency if previous == 0.0 else \
+                (1 - LATENCY_SMOOTHING) * previous + LATENCY_SMOOTHING * latency
+            x, y, width, height = self._draw_tile(index)
+            if dirty is None:
+                dirty = (y, y + height, x, x + width)
+            else:
+                dirty = (min(dirty[0], y), max(dirty[1], y + height), min(dirty[2], x), max(dirty[3], x + width))
+        return dirty
+
+    def label(self, index):
+        """Return the text drawn over the tile of a source"""
+        thread = self.threads[index]
+        return f"{index + 1}: {thread.fps:.0f} fps, {self.latencies[index] * 1000:.0f} ms, {thread.dropped} dropped"
+
+    def _draw_tile(self, index):
+        x, y, width, height = self.tile_rect(index)
+        tile = self.image[y:y + height, x:x + width]
+        preview = self.frames[index].preview
+        if preview.ndim == 2:
+            preview = cv2.cvtColor(preview, cv2.COLOR_GRAY2BGR)
+        if preview.shape[1] > width or preview.shape[0] > height:
+            # Scaled for the tile size before the last resize, or not scaled yet
+            scale = min(width / preview.shape[1], height / preview.shape[0])
+            size = (max(1, int(preview.shape[1] * scale)), max(1, int(preview.shape[0] * scale)))
+            preview = cv2.resize(preview, size, interpolation=cv2.INTER_AREA)
+        top = (height - preview.shape[0]) // 2
+        left = (width - preview.shape[1]) // 2
+        tile[...] = 0
+        tile[top:top + preview.shape[0], left:left + preview.shape[1]] = preview
+        cv2.putText(tile, self.label(index), (6, 16), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1,
+                    cv2.LINE_AA)
+        return x, y, width, height
+
+
+class VideoRecorder:
+    """
+    Encodes captured frames to a video file on its own thread.
+
+    push only hands the frame to a bounded queue and never waits. When the encoder falls behind, the
+    frames that do not fit are left out of the recording and counted, the live view is unaffected.
+    The frames are not copied, sources return a new array for every frame.
+
+    Attributes:
+        path (str): The video file, its extension selects the codec, see VIDEO_CODECS.
+        fps (float): The frame rate written to the file.
+        frames_written (int): The number of frames encoded so far.
+        dropped (int): The number of frames left out because the queue was full.
+        error (Exception): The error that stopped the encoder, if any.
+    """
+    def __init__(self, path, fps, queue_frames=RECORDER_QUEUE_FRAMES):
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in VIDEO_CODECS:
+            raise ValueError(f"Unsupported video format {extension!r}, expected one of {', '.join(VIDEO_CODECS)}.")
+        self.path = path
+        self.fps = fps
+        self.frames_written = 0
+        self.dropped = 0
+        self.error = None
+        self._codec = VIDEO_CODECS[extension]
+        self._queue = queue.Queue(queue_frames)
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+
+    def push(self, frame):
+        try:
+            self._queue.put_nowait(frame.image)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Encode the queued frames, close the file and wait for the encoder"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _encode(self):
+        writer = None
+        try:
+            while True:
+                image = self._queue.get()
+                if image is None:
+                    break
+                if writer is None:
+                    # The frame size is only known from the first frame
+                    writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self._codec), self.fps,
+                                             (image.shape[1], image.shape[0]))
+                    if not writer.isOpened():
+                        raise IOError(f"Failed to open {self.path} for writing.")
+                writer.write(image)
+                self.frames_written += 1
+        except Exception as e:
+            self.error = e
+            # Keep consuming, so push never finds the queue full because the encoder is gone
+            while self._queue.get() is not None:
+                self.dropped += 1
+        finally:
+            if writer is not None:
+                writer.release()
+
+
+class BurstBuffer:
+    """
+    Keeps the last frames of the stream in a ring preallocated on the first frame, to save what happened
+    before a trigger.
+
+    Each frame is copied into the next slot of the ring, so nothing is allocated per frame. When
+    triggered, the ring is frozen: it stops taking frames until resume is called, so the frames can be
+    saved from the ring itself without copying them.
+
+    Attributes:
+        max_frames (int): The number of frames requested.
+        max_bytes (int): The memory the ring may use.
+        capacity (int): The number of frames the ring holds, known after the first frame.
+        skipped (int): The number of frames not kept because the ring was frozen.
+    """
+    def __init__(self, max_frames, max_bytes=BURST_MAX_BYTES):
+        self.max_frames = max(1, max_frames)
+        self.max_bytes = max_bytes
+        self.capacity = 0
+        self.skipped = 0
+        self._frames = None
+        self._indices = None
+        self._next = 0
+        self._count = 0
+        self._frozen = False
+        self._lock = threading.Lock()
+
+    def push(self, frame):
+        image = frame.image
+        with self._lock:
+            if self._frozen:
+                self.skipped += 1
+                return
+            if self._frames is None or self._frames.shape[1:] != image.shape:
+                self.capacity = max(1, min(self.max_frames, self.max_bytes // image.nbytes))
+                # The previous ring is released before the new one is allocated
+                self._frames = None
+                self._frames = np.empty((self.capacity,) + image.shape, dtype=image.dtype)
+                self._indices = np.empty(self.capacity, dtype=np.int64)
+                self._next = 0
+                self._count = 0
+            np.copyto(self._frames[self._next], image)
+            self._indices[self._next] = frame.index
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def freeze(self):
+        """
+        Stop taking frames and return the frames held, oldest first.
+
+        Returns:
+            list: (frame index, image) tuples. The images are views of the ring, valid until resume.
+        """
+        with self._lock:
+            self._frozen = True
+            slots = [(self._next - self._count + offset) % self.capacity for offset in range(self._count)]
+            return [(int(self._indices[slot]), self._frames[slot]) for slot in slots]
+
+    def resume(self):
+        """Empty the ring and take frames again"""
+        with self._lock:
+            self._frozen = False
+            self._count = 0
+
+    def memory_buffers(self):
+        """Return the ring, for the memory manager"""
+        return [self._frames]
+
+
+def save_burst(frames, directory, extension='.jpg'):
+    """
+    Write frames returned by BurstBuffer.freeze as numbered image files.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    from operations import save_image
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index, image in frames:
+        path = os.path.join(directory, f"burst_{index:06d}{extension}")
+        save_image(image, path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,405 @@
+"""
+This module defines the canvas that displays the image with zoom and pan.
+
+The canvas shows an image given at any resolution, usually a display-sized proxy, in the coordinates
+of the full-resolution image. When zoomed in beyond the proxy, it draws from a higher power-of-two
+scale, up to full resolution. The detail is rendered tile by tile on a worker thread, only for the
+tiles in view, and the magnified proxy is shown until they arrive. An edit only discards the tiles
+it touched. Painting only draws the part of the image in the repainted area, so panning a 100% crop
+of a large image costs one unscaled copy of the visible pixels per frame, and an edit that touches a
+small region only repaints that region.
+"""
+import collections
+import math
+from PyQt5.QtCore import Qt, QPointF, QRectF, pyqtSignal
+from PyQt5.QtGui import QPainter, QColor
+from PyQt5.QtWidgets import QWidget
+from profiling import tracer
+
+MAX_ZOOM = 16.0
+# The side length of the detail tiles, in the pixels of their scale
+DETAIL_TILE_SIZE = 512
+# The detail tiles kept, the least recently drawn ones are dropped first
+MAX_DETAIL_BYTES = 256 * 1024 ** 2
+# The zoom factor of one wheel notch (120 units) is 2 ** (120 / WHEEL_UNITS_PER_DOUBLING)
+WHEEL_UNITS_PER_DOUBLING = 480
+
+
+class ImageCanvas(QWidget):
+    """
+    A widget that displays an image with wheel zoom and drag pan.
+
+    Zoom is the number of widget pixels per full-resolution pixel. Until the user zooms or pans, the
+    canvas fits the image to the widget and follows its size. Double-click returns to the fitted view.
+
+    Attributes:
+        image (np.ndarray): The image displayed at low zoom, usually a display-sized proxy.
+        full_size (tuple): The (width, height) of the full-resolution image the canvas coordinates refer to.
+        detail (callable): Called on the canvas worker with a scale from 0 to 1 and a (y0, y1, x0, x1) region
+            in the pixels of that fraction of full resolution, to render the region. It may also be an
+            array at a higher resolution than image, drawn from directly, or None to magnify the image.
+        fit (bool): Whether the image is fitted to the widget.
+        zoom (float): The current zoom when not fitted.
+        offset (QPointF): The widget position of the top-left corner of the image when not fitted.
+    """
+    # Emitted by the worker with the (generation, key, tile) of a rendered detail tile, tile is None if it failed
+    tile_rendered = pyqtSignal(object)
+    # Emitted on the GUI thread with the error message when a detail tile could not be rendered
+    tile_failed = pyqtSignal(str)
+
+    def __init__(self, parent=None, background='#fcf3e3'):
+        super().__init__(parent)
+        self.image = None
+        self.full_size = None
+        self.detail = None
+        self.fit = True
+        self.zoom = 1.0
+        self.offset = QPointF()
+        self.background = QColor(background)
+        # Detail tiles keyed by (scale, row, column), in least recently drawn order
+        self._tiles = collections.OrderedDict()
+        self._tile_bytes = 0
+        # Set by set_image, tiles requested for an earlier image are discarded when they arrive
+        self._generation = 0
+        self._requested = set()
+        self._executor = None
+        self._drag_start = None
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.tile_rendered.connect(self._store_tile)
+
+    def set_image(self, image, full_size=None, detail=None, dirty=None):
+        """
+        Display an image.
+
+        The view is kept when the full-resolution size is unchanged, e.g. after an edit, and is
+        fitted to the widget otherwise.
+
+        Args:
+            image (np.ndarray): The image at any resolution. The canvas keeps a reference and paints
+                from it until the next image is set.
+            full_size (tuple): The (width, height) of the full-resolution image, the size of image by default.
+            detail (callable): The detail callback, see the class attributes.
+            dirty (tuple): The (y0, y1, x0, x1) full-resolution region that changed since the previous
+                image, only it is repainted and only the detail tiles it touches are rendered again.
+                None repaints the whole canvas and discards every detail tile.
+        """
+        full_size = full_size or (image.shape[1], image.shape[0])
+        unchanged_view = (self.image is not None and full_size == self.full_size
+                          and image.shape == self.image.shape)
+        if full_size != self.full_size:
+            self.fit = True
+        self.image = image
+        self.full_size = full_size
+        self.detail = detail
+        self._generation += 1
+        self._requested.clear()
+        if dirty is not None and unchanged_view:
+            self._discard_tiles(dirty)
+            self.update(self.widget_rect(dirty).toAlignedRect().adjusted(-2, -2, 2, 2))
+        else:
+            self._discard_tiles()
+            self.clamp_view()
+            self.update()
+
+    def clear(self):
+        self.image = None
+        self.full_size = None
+        self.detail = None
+        self._generation += 1
+        self._requested.clear()
+        self._discard_tiles()
+        self.update()
+
+    def pending_tiles(self):
+        """Return the number of detail tiles requested for the current image and not rendered yet"""
+        return len(self._requested)
+
+    def shutdown(self):
+        """Stop the detail worker, the tiles still queued are skipped"""
+        self._generation += 1
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def memory_buffers(self):
+        """Return the arrays the canvas holds, for the memory manager"""
+        buffers = [self.image] + list(self._tiles.values())
+        if hasattr(self.detail, 'memory_buffers'):
+            buffers += self.detail.memory_buffers()
+        return buffers
+
+    def drop_caches(self, excess_bytes):
+        """Drop the least recently drawn detail tiles, they are requested again on the next paint that needs them"""
+        target = max(0, self._tile_bytes - excess_bytes)
+        while self._tiles and self._tile_bytes > target:
+            _, tile = self._tiles.popitem(last=False)
+            self._tile_bytes -= tile.nbytes
+
+    def fit_zoom(self):
+        """Return the zoom at which the image fits the widget"""
+        width, height = self.full_size
+        return min(self.width() / width, self.height() / height)
+
+    def view(self):
+        """Return the current (zoom, offset)"""
+        if not self.fit:
+            return self.zoom, self.offset
+        zoom = self.fit_zoom()
+        width, height = self.full_size
+        return zoom, QPointF(round((self.width() - width * zoom) / 2), round((self.height() - height * zoom) / 2))
+
+    def widget_rect(self, bounds):
+        """Return the widget rectangle covering a (y0, y1, x0, x1) full-resolution region"""
+        zoom, offset = self.view()
+        y0, y1, x0, x1 = bounds
+        return QRectF(offset.x() + x0 * zoom, offset.y() + y0 * zoom, (x1 - x0) * zoom, (y1 - y0) * zoom)
+
+    def zoom_to_fit(self):
+        self.fit = True
+        self.update()
+
+    def set_zoom(self, zoom, anchor=None):
+        """
+        Zoom the view, keeping the image point under anchor in place.
+
+        Args:
+            zoom (float): The new zoom, limited to the range from the fitted zoom (or 1 if smaller) to MAX_ZOOM.
+            anchor (QPointF): The widget position that stays in place, the center of the widget by default.
+        """
+        if self.image is None:
+            return
+        old_zoom, old_offset = self.view()
+        zoom = min(max(zoom, min(self.fit_zoom(), 1.0)), MAX_ZOOM)
+        if anchor is None:
+            anchor = QPointF(self.width() / 2, self.height() / 2)
+        # The full-resolution point under the anchor
+        x = (anchor.x() - old_offset.x()) / old_zoom
+        y = (anchor.y() - old_offset.y()) / old_zoom
+        self.fit = False
+        self.zoom = zoom
+        self.offset = QPointF(anchor.x() - x * zoom, anchor.y() - y * zoom)
+        self.clamp_view()
+        self.update()
+
+    def clamp_view(self):
+        """Center the image along the sides it is smaller than the widget and keep it in view along the others"""
+        if self.fit or self.full_size is None:
+            return
+        width, height = self.full_size
+        offset = []
+        for position, image_size, widget_size in ((self.offset.x(), width * self.zoom, self.width()),
+                                                  (self.offset.y(), height * self.zoom, self.height())):
+            if image_size <= widget_size:
+                position = (widget_size - image_size) / 2
+            else:
+                position = min(max(position, widget_size - image_size), 0)
+            # Whole pixel offsets keep 100% views sharp
+            offset.append(round(position))
+        self.offset = QPointF(*offset)
+
+    def level(self, zoom):
+        """
+        Return the scale to draw at a zoom.
+
+        Returns:
+            float: The fraction of full resolution to draw detail tiles at, None to draw the image or
+                the detail array.
+        """
+        width, height = self.full_size
+        scale = min(self.image.shape[1] / width, self.image.shape[0] / height)
+        # Proxies are rounded to whole pixels, so the fitted zoom can be slightly above their scale
+        if zoom <= scale * 1.01 or not callable(self.detail):
+            return None
+        # The smallest power-of-two fraction of full resolution that is at least the zoom
+        return min(1.0, 2.0 ** math.ceil(math.log2(zoom)))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        rect = event.rect()
+        painter.fillRect(rect, self.background)
+        if self.image is None:
+            return
+
+        with tracer.span('display.paint'):
+            zoom, offset = self.view()
+            scale = self.level(zoom)
+            if scale is None:
+                image = self.image
+                if self.detail is not None and not callable(self.detail) \
+                        and zoom > self.image.shape[1] / self.full_size[0] * 1.01:
+                    image = self.detail
+                self._draw(painter, rect, image, 0, 0, image.shape[1] / self.full_size[0],
+                           image.shape[0] / self.full_size[1])
+                return
+
+            # The repainted area in the pixels of the scale and the tiles covering it
+            x0, y0, x1, y1 = self._visible(rect, zoom, offset, scale, scale, self._level_size(scale))
+            if x0 >= x1 or y0 >= y1:
+                return
+            keys = [(scale, row, column)
+                    for row in range(y0 // DETAIL_TILE_SIZE, (y1 - 1) // DETAIL_TILE_SIZE + 1)
+                    for column in range(x0 // DETAIL_TILE_SIZE, (x1 - 1) // DETAIL_TILE_SIZE + 1)]
+            missing = [key for key in keys if key not in self._tiles]
+            for key in missing:
+                self._request_tile(key)
+            if not missing:
+                # The visible pixels are assembled into one image, so tiles join without seams when smoothed
+                from qt_image import numpy_to_qimage
+                import numpy as np
+
+                first = self._tiles[keys[0]]
+                region = np.zeros((y1 - y0, x1 - x0) + first.shape[2:], dtype=first.dtype)
+                for key in keys:
+                    self._tiles.move_to_end(key)
+                    tile = self._tiles[key]
+                    top, left = key[1] * DETAIL_TILE_SIZE, key[2] * DETAIL_TILE_SIZE
+                    ty0, tx0 = max(y0, top), max(x0, left)
+                    ty1, tx1 = min(y1, top + tile.shape[0]), min(x1, left + tile.shape[1])
+                    region[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0] = tile[ty0 - top:ty1 - top, tx0 - left:tx1 - left]
+                self._draw_region(painter, zoom, offset, scale, scale, x0, y0, numpy_to_qimage(region))
+                return
+
+            # The magnified image is shown until the missing tiles arrive
+            self._draw(painter, rect, self.image, 0, 0, self.image.shape[1] / self.full_size[0],
+                       self.image.shape[0] / self.full_size[1])
+            for key in keys:
+                if key in self._tiles:
+                    self._tiles.move_to_end(key)
+                    tile = self._tiles[key]
+                    self._draw(painter, rect, tile, key[2] * DETAIL_TILE_SIZE, key[1] * DETAIL_TILE_SIZE,
+                               scale, scale)
+
+    def _level_size(self, scale):
+        """Return the (width, height) of the image at a fraction of full resolution"""
+        width, height = self.full_size
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def _visible(self, rect, zoom, offset, scale_x, scale_y, size, left=0, top=0):
+        """Return the (x0, y0, x1, y1) pixels of an image placed at (left, top) of a scale in the widget rectangle"""
+        width, height = size
+        # With a pixel of margin for the interpolation
+        x0 = max(math.floor((rect.left() - offset.x()) / zoom * scale_x) - 1 - left, 0)
+        y0 = max(math.floor((rect.top() - offset.y()) / zoom * scale_y) - 1 - top, 0)
+        x1 = min(math.ceil((rect.right() + 1 - offset.x()) / zoom * scale_x) + 1 - left, width)
+        y1 = min(math.ceil((rect.bottom() + 1 - offset.y()) / zoom * scale_y) + 1 - top, height)
+        return x0, y0, x1, y1
+
+    def _draw(self, painter, rect, image, left, top, scale_x, scale_y):
+        """Draw the part of an image placed at (left, top) of a scale that is in the widget rectangle"""
+        from qt_image import numpy_to_qimage
+
+        zoom, offset = self.view()
+        height, width = image.shape[:2]
+        x0, y0, x1, y1 = self._visible(rect, zoom, offset, scale_x, scale_y, (width, height), left, top)
+        if x0 >= x1 or y0 >= y1:
+            return
+        self._draw_region(painter, zoom, offset, scale_x, scale_y, left + x0, top + y0,
+                          numpy_to_qimage(image[y0:y1, x0:x1]))
+
+    @staticmethod
+    def _draw_region(painter, zoom, offset, scale_x, scale_y, x0, y0, image):
+        factor_x, factor_y = zoom / scale_x, zoom / scale_y
+        target = QRectF(offset.x() + x0 * factor_x, offset.y() + y0 * factor_y,
+                        image.width() * factor_x, image.height() * factor_y)
+        # Magnified pixels stay sharp for inspection, reductions are smoothed
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, factor_x < 1.0)
+        painter.drawImage(target, image)
+
+    def _tile_bounds(self, key):
+        """Return the (y0, y1, x0, x1) pixels of a tile at its scale"""
+        scale, row, column = key
+        width, height = self._level_size(scale)
+        y0, x0 = row * DETAIL_TILE_SIZE, column * DETAIL_TILE_SIZE
+        return y0, min(y0 + DETAIL_TILE_SIZE, height), x0, min(x0 + DETAIL_TILE_SIZE, width)
+
+    def _request_tile(self, key):
+        """Render a tile on the worker, unless it was already requested for the current image"""
+        if key in self._requested:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='canvas-detail')
+        self._requested.add(key)
+        self._executor.submit(self._render_tile, self._generation, key, self.detail, self._tile_bounds(key))
+
+    def _render_tile(self, generation, key, detail, bounds):
+        # Runs on the worker, the tiles requested for an earlier image are skipped
+        if generation != self._generation:
+            return
+        try:
+            with tracer.span('display.detail', scale=key[0]):
+                tile = detail(key[0], bounds)
+        except Exception as e:
+            # The magnified image stays in place, the tile is requested again the next time it is painted
+            self.tile_rendered.emit((generation, key, None))
+            # A MemoryError usually has no message
+            self.tile_failed.emit(str(e) or type(e).__name__)
+            return
+        self.tile_rendered.emit((generation, key, tile))
+
+    def _store_tile(self, rendered):
+        generation, key, tile = rendered
+        if generation != self._generation:
+            return
+        self._requested.discard(key)
+        if tile is None:
+            return
+        self._tiles[key] = tile
+        self._tile_bytes += tile.nbytes
+        while self._tile_bytes > MAX_DETAIL_BYTES and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._tile_bytes -= evicted.nbytes
+        scale = key[0]
+        y0, y1, x0, x1 = self._tile_bounds(key)
+        self.update(self.widget_rect((y0 / scale, y1 / scale, x0 / scale, x1 / scale)).toAlignedRect().adjusted(-2, -2, 2, 2))
+
+    def _discard_tiles(self, dirty=None):
+        """Discard the detail tiles a (y0, y1, x0, x1) full-resolution region touches, all of them by default"""
+        for key in list(self._tiles):
+            if dirty is not None:
+                scale = key[0]
+                y0, y1, x0, x1 = self._tile_bounds(key)
+                # Scaled edits may round a pixel beyond their full-resolution region
+                margin = 2 / scale
+                if (y1 / scale + margin <= dirty[0] or y0 / scale - margin >= dirty[1]
+                        or x1 / scale + margin <= dirty[2] or x0 / scale - margin >= dirty[3]):
+                    continue
+            self._tile_bytes -= self._tiles.pop(key).nbytes
+
+    def wheelEvent(self, event):
+        if self.image is None:
+            return
+        zoom, _ = self.view()
+        self.set_zoom(zoom * 2.0 ** (event.angleDelta().y() / WHEEL_UNITS_PER_DOUBLING), QPointF(event.pos()))
+        event.accept()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and self.image is not None:
+            zoom, offset = self.view()
+            self._drag_start = (QPointF(event.pos()), offset)
+            self.setCursor(Qt.ClosedHandCursor)
+
+    def mouseMoveEvent(self, event):
+        if self._drag_start is None:
+            return
+        start, start_offset = self._drag_start
+        zoom, _ = self.view()
+        if self.fit:
+            # Dragging the fitted view starts panning at the fitted zoom
+            self.fit = False
+            self.zoom = zoom
+        self.offset = start_offset + QPointF(event.pos()) - start
+        self.clamp_view()
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        self._drag_start = None
+        self.unsetCursor()
+
+    def mouseDoubleClickEvent(self, event):
+        self.zoom_to_fit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.clamp_view()
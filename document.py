@@ -0,0 +1,293 @@
+"""
+This module defines the non-destructive document model of the Photo Editor application.
+
+A document is a source image plus an ordered list of (name, params) operations. Nothing is computed
+when the operations change, the image is evaluated lazily when it is rendered at a given resolution.
+Intermediate results are memoized in an LRU cache with a byte budget, keyed by the resolution and the
+operations that produced them, so changing operation N only recomputes from N onward.
+"""
+import collections
+import numpy as np
+import histogram
+import operations
+import tiled
+from preview import PreviewPyramid, scale_step
+from profiling import traced
+
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+# Statistics are small, the ones of many edit states are kept so undo and redo never recompute them
+STATISTICS_CACHE_ENTRIES = 64
+
+
+class IntermediateCache:
+    """
+    An LRU cache of images limited by the total number of bytes they hold.
+
+    Attributes:
+        budget_bytes (int): The maximum number of bytes held.
+        nbytes (int): The number of bytes currently held.
+    """
+    def __init__(self, budget_bytes=DEFAULT_CACHE_BYTES):
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        """Store an image, evicting the least recently used ones to stay within the budget"""
+        # Memory-mapped results live on disk and do not count against the budget
+        size = 0 if isinstance(image, np.memmap) else image.nbytes
+        if size > self.budget_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= 0 if isinstance(previous, np.memmap) else previous.nbytes
+        self._entries[key] = image
+        self.nbytes += size
+        self.shrink(self.budget_bytes)
+
+    def shrink(self, target_bytes):
+        """Evict the least recently used images until at most target_bytes are held"""
+        while self.nbytes > target_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= 0 if isinstance(evicted, np.memmap) else evicted.nbytes
+
+    def values(self):
+        return list(self._entries.values())
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _freeze(step):
+    """Return a hashable form of a (name, params) step"""
+    name, params = step
+    return name, tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                              for key, value in params.items()))
+
+
+class Document:
+    """
+    A source image and the operations applied to it, evaluated lazily.
+
+    Consecutive in-place operations such as rectangles are applied to a single copy and only the
+    result after the last of them is cached, so a run of rectangles costs one copy, not one per step.
+
+    Attributes:
+        source (np.ndarray): The source image. It is never modified.
+        operations (list): The (name, params) steps in full-resolution coordinates.
+        pyramid (PreviewPyramid): The preview pyramid of the source, used for proxy renders.
+        cache (IntermediateCache): The memoized intermediate results.
+        statistics_cache (OrderedDict): The memoized statistics, keyed by the steps that change pixels.
+    """
+    def __init__(self, source, steps=(), cache_bytes=DEFAULT_CACHE_BYTES, pyramid=None):
+        self.source = source
+        self.operations = list(steps)
+        self.pyramid = pyramid or PreviewPyramid(source)
+        self.cache = IntermediateCache(cache_bytes)
+        self.statistics_cache = collections.OrderedDict()
+
+    @property
+    def width(self):
+        return self.source.shape[1]
+
+    @property
+    def height(self):
+        return self.source.shape[0]
+
+    def output_size(self, count=None):
+        """Return the (width, height) of the rendered image, which resize steps change"""
+        width, height = self.width, self.height
+        for name, params in (self.operations if count is None else self.operations[:count]):
+            if name == 'resize':
+                width, height = operations.resize_dimensions(width, height, params['width'], params['height'],
+                                                             params.get('keep_aspect_ratio', True))
+        return width, height
+
+    def replace_source(self, source):
+        """Replace the source with an identical copy, e.g. one spilled to disk"""
+        self.source = source
+        self.pyramid.replace_image(source)
+
+    def memory_buffers(self):
+        """Return the arrays the document holds, for the memory manager"""
+        return [self.source] + self.pyramid.memory_buffers() + self.cache.values()
+
+    def drop_caches(self, excess_bytes):
+        """Free memoized renders, least recently used first, then the pyramid if that is not enough"""
+        held = self.cache.nbytes
+        self.cache.shrink(max(0, held - excess_bytes))
+        if held < excess_bytes:
+            self.pyramid.drop_caches()
+
+    def set_operations(self, steps):
+        """Replace the operations, cached results for the unchanged leading steps are kept"""
+        self.operations = list(steps)
+
+    def append(self, step):
+        self.operations.append(step)
+
+    def insert(self, index, step):
+        self.operations.insert(index, step)
+
+    def replace(self, index, step):
+        self.operations[index] = step
+
+    def remove(self, index):
+        del self.operations[index]
+
+    @traced('render')
+    def render(self, max_size=None, count=None):
+        """
+        Evaluate the document.
+
+        Args:
+            max_size (tuple): The (width, height) to fit a proxy render into, None for full resolution.
+            count (int): The number of leading operations to apply, all of them by default.
+
+        Returns:
+            np.ndarray: The rendered image. It is cached and shared, callers must copy it before modifying it.
+        """
+        steps = self.operations if count is None else self.operations[:count]
+        if max_size is None:
+            base = self.source
+            resolution = None
+        else:
+            # The proxy is sized so the result fits max_size, resize steps may shrink or enlarge it. It is
+            # never enlarged beyond full resolution unless the source itself is smaller than max_size.
+            output_width, output_height = self.output_size(count)
+            fitted = min(max_size[0] / self.width, max_size[1] / self.height)
+            scale = min(max_size[0] / output_width, max_size[1] / output_height, max(1.0, fitted))
+            base = self.pyramid.fit(max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+            resolution = (base.shape[1], base.shape[0])
+            scale_x, scale_y = base.shape[1] / self.width, base.shape[0] / self.height
+            steps = [scale_step(step, scale_x, scale_y) for step in steps]
+
+        # A prefix is keyed by its frozen steps themselves, so different prefixes never share an entry
+        frozen = [_freeze(step) for step in steps]
+
+        # Resume from the longest prefix that is still cached
+        start = len(steps)
+        image = None
+        while start > 0:
+            image = self.cache.get((resolution, tuple(frozen[:start])))
+            if image is not None:
+                break
+            start -= 1
+        if image is None:
+            image = base
+
+        index = start
+        while index < len(steps):
+            # A segment is a run of in-place steps ending with the next allocating step, if any, and the
+            # channel and brightness steps that follow it, which are fused into one pass
+            end = index
+            while end < len(steps) and steps[end][0] in operations.IN_PLACE_OPERATIONS:
+                end += 1
+            end = min(end + 1, len(steps))
+            if steps[end - 1][0] in operations.PIXEL_OPERATIONS:
+                while end < len(steps) and steps[end][0] in operations.PIXEL_OPERATIONS:
+                    end += 1
+            image = self._apply_segment(image, steps[index:end])
+            self.cache.put((resolution, tuple(frozen[:end])), image)
+            index = end
+        return image
+
+    def statistics(self):
+        """
+        Return the histograms and statistics of the rendered image.
+
+        They are computed on a proxy render of histogram.STATISTICS_SIZE and memoized. Steps that leave
+        every pixel unchanged are not part of the key, so adding or removing one reuses the statistics.
+
+        Returns:
+            histogram.Statistics: The statistics.
+        """
+        key = tuple(_freeze(step) for step in self.operations if not operations.is_identity(step))
+        statistics = self.statistics_cache.get(key)
+        if statistics is not None:
+            self.statistics_cache.move_to_end(key)
+            return statistics
+        statistics = histogram.compute_statistics(self.render(histogram.STATISTICS_SIZE))
+        self.statistics_cache[key] = statistics
+        while len(self.statistics_cache) > STATISTICS_CACHE_ENTRIES:
+            self.statistics_cache.popitem(last=False)
+        return statistics
+
+    def region_renderer(self):
+        """Return a RegionRenderer of the current source and operations"""
+        return RegionRenderer(self.source, self.operations)
+
+    @staticmethod
+    def _apply_segment(image, steps):
+        if isinstance(image, np.memmap):
+            return tiled.apply_operations_large(image, steps)
+        return operations.apply_operations(image, steps)
+
+
+class RegionRenderer:
+    """
+    Renders regions of a document at power-of-two fractions of full resolution, for the zoomed-in canvas.
+
+    The renderer keeps the source and the operations it was created with, so it runs on a worker thread
+    while the document changes. When every operation is tile-local, only the requested region of the
+    source is reduced and edited. Otherwise, e.g. after a resize, the whole level is rendered once and
+    the regions are cut from it.
+
+    Attributes:
+        source (np.ndarray): The source image. It is never modified.
+        steps (list): The (name, params) steps in full-resolution coordinates.
+    """
+    def __init__(self, source, steps):
+        self.source = source
+        self.steps = list(steps)
+        self._tile_local = all(name in tiled.TILE_LOCAL_OPERATIONS for name, _ in self.steps)
+        # The (scale, image) of the last whole level rendered
+        self._level = None
+
+    def __call__(self, scale, bounds):
+        """
+        Render a region of the edited image.
+
+        Args:
+            scale (float): The fraction of full resolution, a power of two up to 1.
+            bounds (tuple): The (y0, y1, x0, x1) region in the pixels of the image at that scale.
+
+        Returns:
+            np.ndarray: The region, smaller than bounds where it extends past the image.
+        """
+        y0, y1, x0, x1 = bounds
+        if not self._tile_local:
+            return self._whole_level(scale)[y0:y1, x0:x1]
+        factor = round(1 / scale)
+        region = self.source[y0 * factor:y1 * factor, x0 * factor:x1 * factor]
+        steps = self.steps
+        if factor > 1:
+            # Blocks of factor x factor pixels are averaged, so adjacent regions match
+            region = tiled.reduce(region, factor)
+            steps = [scale_step(step, scale, scale) for step in steps]
+        return operations.apply_operations(region, tiled.tile_steps(steps, bounds), copy=factor == 1)
+
+    def memory_buffers(self):
+        """Return the whole level the renderer holds, if any, for the memory manager"""
+        return [] if self._level is None else [self._level[1]]
+
+    def _whole_level(self, scale):
+        if self._level is None or self._level[0] != scale:
+            factor = round(1 / scale)
+            if factor > 1:
+                image = operations.apply_operations(tiled.reduce(self.source, factor),
+                                                    [scale_step(step, scale, scale) for step in self.steps], copy=False)
+            else:
+                image = Document._apply_segment(self.source, self.steps)
+            self._level = (scale, image)
+        return self._level[1]
@@ -0,0 +1,139 @@
+"""
+This module exports edited images to one or more files.
+
+Every output has its own format, quality and maximum size, e.g. a full-size JPEG, a web-size WebP
+and a thumbnail. All outputs are encoded in parallel from the same full-resolution image: OpenCV
+releases the GIL while resizing and encoding, so a thread pool keeps several cores busy without
+copying the image into other processes.
+
+Each file is written under a temporary name in its destination directory and renamed when it is
+complete, so an interrupted export never leaves a truncated file behind, and an existing file is
+replaced atomically.
+"""
+import collections
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import operations
+import tiled
+
+# Format name: (file extension, description)
+FORMATS = {
+    'jpeg': ('.jpg', "JPEG"),
+    'png': ('.png', "PNG"),
+    'webp': ('.webp', "WebP"),
+    'tiff': ('.tif', "TIFF (lossless)"),
+}
+# libtiff's LZW compression, lossless and supported by every TIFF reader
+TIFF_COMPRESSION_LZW = 5
+
+ExportTarget = collections.namedtuple('ExportTarget', ['path', 'format', 'quality', 'compression', 'max_size'],
+                                      defaults=(95, 3, None))
+ExportTarget.__doc__ = """
+An output of an export.
+
+Attributes:
+    path (str): The output file.
+    format (str): One of FORMATS.
+    quality (int): The JPEG or WebP quality from 1 to 100. WebP above 100 is lossless.
+    compression (int): The PNG compression level from 0 (fastest) to 9 (smallest).
+    max_size (tuple): The (width, height) to fit the image into, None for full size.
+"""
+
+ExportResult = collections.namedtuple('ExportResult', ['path', 'format', 'width', 'height', 'seconds', 'size',
+                                                       'error'])
+ExportResult.__doc__ = """
+The outcome of one output of an export.
+
+Attributes:
+    seconds (float): The time spent resizing, encoding and writing the output.
+    size (int): The size of the written file in bytes.
+    error (str): The error message if the output failed, otherwise None.
+"""
+
+
+def encode_params(target):
+    """Return the cv2.imencode parameters of an export target"""
+    if target.format == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, target.quality]
+    if target.format == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, target.compression]
+    if target.format == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, target.quality]
+    if target.format == 'tiff':
+        return [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION_LZW]
+    raise ValueError(f"Unknown export format {target.format!r}.")
+
+
+def write_atomic(path, data):
+    """Write bytes to a temporary file next to path and rename it to path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def export_image(image, target):
+    """
+    Resize, encode and write one output.
+
+    Returns:
+        ExportResult: The outcome, errors are reported in it instead of raised.
+    """
+    start = time.perf_counter()
+    try:
+        if target.max_size is not None:
+            width, height = operations.fit_size(image.shape[1], image.shape[0], *target.max_size)
+            if width < image.shape[1]:
+                if isinstance(image, np.memmap):
+                    image = tiled.resize(image, width, height)
+                else:
+                    image = operations.resize_image(image, width, height)
+        ok, encoded = cv2.imencode(FORMATS[target.format][0], image, encode_params(target))
+        if not ok:
+            raise ValueError(f"Failed to encode image as {FORMATS[target.format][1]}.")
+        write_atomic(target.path, encoded)
+        error = None
+    except (OSError, ValueError, cv2.error) as e:
+        encoded, error = (), str(e)
+    return ExportResult(target.path, target.format, image.shape[1], image.shape[0],
+                        time.perf_counter() - start, len(encoded), error)
+
+
+def export_all(image, targets, workers=None):
+    """
+    Export an image to several outputs in parallel.
+
+    Args:
+        image (np.ndarray): The full-resolution image. It is only read.
+        targets (list): The ExportTarget outputs.
+        workers (int): The number of threads, one per output by default.
+
+    Returns:
+        list: The ExportResult of every target, in the same order.
+    """
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or len(targets)) as executor:
+        return list(executor.map(lambda target: export_image(image, target), targets))
+
+
+def format_results(results):
+    """Return one line per result with its format, size, file size and time"""
+    lines = []
+    for result in results:
+        name = FORMATS[result.format][1]
+        if result.error:
+            lines.append(f"{os.path.basename(result.path)}: {name} failed: {result.error}")
+        else:
+            lines.append(f"{os.path.basename(result.path)}: {name} {result.width}x{result.height}, "
+                         f"{result.size / 1024:.0f} KB in {result.seconds * 1000:.0f} ms")
+    return lines
@@ -0,0 +1,151 @@
+"""
+This module defines a dialog for exporting an image to one or more files.
+"""
+import os
+from PyQt5.QtWidgets import (QDialog, QDialogButtonBox, QLineEdit, QLabel, QVBoxLayout, QHBoxLayout, QGridLayout,
+                             QComboBox, QCheckBox, QSpinBox, QPushButton, QFileDialog)
+from export import FORMATS, ExportTarget
+
+FORMAT_NAMES = list(FORMATS)
+
+# The outputs offered by default: (label, enabled, format, quality, max side or 0 for full size, file suffix)
+PRESETS = [
+    ("Full size", True, 'jpeg', 95, 0, ''),
+    ("Web", False, 'webp', 80, 2048, '_web'),
+    ("Thumbnail", False, 'jpeg', 85, 256, '_thumb'),
+]
+
+
+class ExportDialog(QDialog):
+    """
+    A dialog for choosing the outputs of an export.
+
+    Each row is one output with its own format, quality, PNG compression level, maximum side and
+    file name suffix. All outputs share the base file name.
+
+    Attributes:
+        path_edit (QLineEdit): The base output path, without extension.
+        rows (list): The widgets of each output row.
+        error_label (QLabel): Why the outputs cannot be exported, e.g. two of them have the same file name.
+    """
+    def __init__(self, base_path, parent=None):
+        super().__init__(parent)
+
+        self.setWindowTitle("Export Image")
+        self.setMinimumWidth(560)
+
+        self.path_edit = QLineEdit(base_path)
+        self.path_edit.textChanged.connect(self.validate_input)
+        browse_button = QPushButton("Browse...")
+        browse_button.clicked.connect(self.browse)
+        path_layout = QHBoxLayout()
+        path_layout.addWidget(self.path_edit)
+        path_layout.addWidget(browse_button)
+
+        grid = QGridLayout()
+        for column, title in enumerate(["Output", "Format", "Quality", "PNG level", "Max side (0 = full)",
+                                        "Suffix"]):
+            grid.addWidget(QLabel(title), 0, column)
+
+        self.rows = []
+        for index, (label, enabled, format_name, quality, max_side, suffix) in enumerate(PRESETS, 1):
+            row = {
+                'enabled': QCheckBox(label),
+                'format': QComboBox(self),
+                'quality': QSpinBox(self),
+                'compression': QSpinBox(self),
+                'max_side': QSpinBox(self),
+                'suffix': QLineEdit(suffix),
+            }
+            row['enabled'].setChecked(enabled)
+            row['enabled'].toggled.connect(self.validate_input)
+            for name in FORMAT_NAMES:
+                row['format'].addItem(FORMATS[name][1])
+            row['format'].setCurrentIndex(FORMAT_NAMES.index(format_name))
+            row['format'].currentIndexChanged.connect(lambda _, row=row: self.update_row(row))
+            row['format'].currentIndexChanged.connect(self.validate_input)
+            # WebP above 100 is lossless
+            row['quality'].setRange(1, 101)
+            row['quality'].setValue(quality)
+            row['compression'].setRange(0, 9)
+            row['compression'].setValue(3)
+            row['max_side'].setRange(0, 65535)
+            row['max_side'].setValue(max_side)
+            row['suffix'].textChanged.connect(self.validate_input)
+            for column, key in enumerate(['enabled', 'format', 'quality', 'compression', 'max_side', 'suffix']):
+                grid.addWidget(row[key], index, column)
+            self.update_row(row)
+            self.rows.append(row)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        self.ok_button = button_box.button(QDialogButtonBox.Ok)
+        self.error_label = QLabel()
+        self.error_label.setStyleSheet("color: #b00020;")
+
+        main_layout = QVBoxLayout()
+        main_layout.addWidget(QLabel("Base file name:"))
+        main_layout.addLayout(path_layout)
+        main_layout.addLayout(grid)
+        main_layout.addWidget(self.error_label)
+        main_layout.addWidget(button_box)
+        self.setLayout(main_layout)
+        self.validate_input()
+
+    def update_row(self, row):
+        """Enable the quality or compression input the format of a row uses"""
+        format_name = FORMAT_NAMES[row['format'].currentIndex()]
+        row['quality'].setEnabled(format_name in ('jpeg', 'webp'))
+        row['compression'].setEnabled(format_name == 'png')
+
+    def browse(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Image", self.path_edit.text())
+        if file_path:
+            self.path_edit.setText(os.path.splitext(file_path)[0])
+
+    def validate_input(self):
+        """Enable the OK button if there is a base path and at least one output, and no two outputs share a file"""
+        has_output = any(row['enabled'].isChecked() for row in self.rows)
+        duplicate = self.duplicate_path()
+        self.error_label.setText(f"Two outputs would be written to {duplicate}, change a suffix or format."
+                                 if duplicate else "")
+        self.ok_button.setEnabled(bool(self.path_edit.text().strip()) and has_output and duplicate is None)
+
+    def duplicate_path(self):
+        """Return a file path that two enabled outputs would be written to, or None"""
+        paths = set()
+        for target in self.get_targets():
+            key = os.path.normcase(os.path.abspath(target.path))
+            if key in paths:
+                return target.path
+            paths.add(key)
+        return None
+
+    def accept(self):
+        # Exporting two outputs to one file would write it from two threads at once
+        if self.duplicate_path() is None:
+            super().accept()
+
+    def get_targets(self):
+        """
+        Get the outputs chosen by the user.
+
+        Returns:
+            list: An ExportTarget for each enabled output.
+        """
+        base_path = os.path.splitext(self.path_edit.text().strip())[0]
+        targets = []
+        for row in self.rows:
+            if not row['enabled'].isChecked():
+                continue
+            format_name = FORMAT_NAMES[row['format'].currentIndex()]
+            max_side = row['max_side'].value()
+            targets.append(ExportTarget(
+                path=base_path + row['suffix'].text().strip() + FORMATS[format_name][0],
+                format=format_name,
+                quality=min(row['quality'].value(), 100) if format_name == 'jpeg' else row['quality'].value(),
+                compression=row['compression'].value(),
+                max_size=(max_side, max_side) if max_side else None,
+            ))
+        return targets
@@ -0,0 +1,186 @@
+"""
+This module defines the filmstrip that browses the images of a folder
+"""
+import functools
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PyQt5.QtCore import Qt, QSize, QTimer, QPoint, pyqtSignal
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QListWidget, QListWidgetItem, QListView, QStyle
+import batch
+from qt_image import numpy_to_qpixmap
+from thumbnails import ThumbnailCache, THUMBNAIL_SIZE, cached_thumbnail
+
+
+class Filmstrip(QListWidget):
+    """
+    A horizontal strip of thumbnails of the images in a folder.
+
+    Thumbnails are only requested for the items in view, plus a margin on both sides. Cached ones
+    are read directly, missing ones are created by a pool of worker processes, and requests for
+    items that scrolled out of view before a worker picked them up are cancelled.
+
+    Attributes:
+        files (list): The image files of the folder, in display order.
+        cache (ThumbnailCache): The on-disk thumbnail cache.
+        thumbnail_size (int): The size of the thumbnails.
+        margin (int): The number of items on each side of the view whose thumbnails are also requested.
+    """
+    image_selected = pyqtSignal(str)
+
+    def __init__(self, parent=None, thumbnail_size=THUMBNAIL_SIZE, workers=None, margin=10):
+        super().__init__(parent)
+        self.files = []
+        self.cache = ThumbnailCache()
+        self.thumbnail_size = thumbnail_size
+        self.workers = workers
+        self.margin = margin
+        self.executor = None
+        self._rows = {}
+        self._pending = {}
+        self._loaded = set()
+        # Worker results arrive on the executor's thread and are handed over through this queue
+        self._finished = queue.Queue()
+
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setHorizontalScrollMode(QListView.ScrollPerPixel)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setIconSize(QSize(thumbnail_size, thumbnail_size))
+        self.setFixedHeight(thumbnail_size + 48)
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(20)
+        self.poll_timer.timeout.connect(self.poll_thumbnails)
+        self.horizontalScrollBar().valueChanged.connect(self.request_visible)
+        self.currentRowChanged.connect(self.on_row_changed)
+
+    def set_folder(self, folder):
+        """Show the images of a folder"""
+        self.cancel_pending()
+        self.clear()
+        self.files = batch.collect_inputs([folder])
+        self._rows = {file_path: row for row, file_path in enumerate(self.files)}
+        self._loaded.clear()
+        for file_path in self.files:
+            item = QListWidgetItem(os.path.basename(file_path))
+            item.setSizeHint(QSize(self.thumbnail_size + 16, self.thumbnail_size + 32))
+            item.setToolTip(file_path)
+            self.addItem(item)
+        self.cache.evict()
+        # Wait for the layout, the visible range is not known before
+        QTimer.singleShot(0, self.request_visible)
+
+    def visible_rows(self):
+        """Return the range of rows that are in view"""
+        if not self.files:
+            return range(0)
+        middle = self.viewport().height() // 2
+        first = self.indexAt(QPoint(0, middle)).row()
+        last = self.indexAt(QPoint(self.viewport().width() - 1, middle)).row()
+        first = max(first, 0)
+        last = len(self.files) - 1 if last < 0 else last
+        return range(first, last + 1)
+
+    def request_visible(self):
+        """Load the thumbnails of the items in view and cancel the requests of items far out of view"""
+        rows = self.visible_rows()
+        if not rows:
+            return
+        wanted = range(max(0, rows.start - self.margin), min(len(self.files), rows.stop + self.margin))
+
+        for file_path in list(self._pending):
+            if self._rows[file_path] not in wanted and self._pending[file_path].cancel():
+                del self._pending[file_path]
+
+        for row in wanted:
+            file_path = self.files[row]
+            if file_path in self._loaded or file_path in self._pending:
+                continue
+            # Cached thumbnails are small JPEG files, reading them here is faster than a round trip to a worker
+            thumbnail = self.cache.get(file_path)
+            if thumbnail is not None:
+                self.set_thumbnail(file_path, thumbnail)
+                continue
+            try:
+                future = self._submit(file_path)
+            except BrokenProcessPool:
+                # A worker died, e.g. on a file that exhausted its memory, the others are restarted
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                future = self._submit(file_path)
+            future.add_done_callback(functools.partial(self._on_done, file_path))
+            self._pending[file_path] = future
+        if self._pending:
+            self.poll_timer.start()
+
+    def _submit(self, file_path):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=batch._init_worker)
+        return self.executor.submit(cached_thumbnail, file_path, self.cache.directory, self.thumbnail_size)
+
+    def _on_done(self, file_path, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # The worker failed, the file gets the placeholder of files that cannot be decoded
+            self._finished.put((file_path, None))
+        else:
+            self._finished.put(future.result())
+
+    def poll_thumbnails(self):
+        """Show the thumbnails the workers have finished"""
+        while True:
+            try:
+                file_path, thumbnail = self._finished.get_nowait()
+            except queue.Empty:
+                break
+            # Results of a previous folder are dropped
+            if self._pending.pop(file_path, None) is None:
+                continue
+            if thumbnail is not None:
+                self.set_thumbnail(file_path, thumbnail)
+            else:
+                # Files that cannot be decoded show a placeholder and are not requested again
+                self.item(self._rows[file_path]).setIcon(self.style().standardIcon(QStyle.SP_MessageBoxWarning))
+                self._loaded.add(file_path)
+        if not self._pending:
+            self.poll_timer.stop()
+
+    def set_thumbnail(self, file_path, thumbnail):
+        self.item(self._rows[file_path]).setIcon(QIcon(numpy_to_qpixmap(thumbnail)))
+        self._loaded.add(file_path)
+
+    def neighbors(self, file_path, count=1):
+        """Return the files up to count positions before and after a file"""
+        row = self._rows.get(file_path)
+        if row is None:
+            return []
+        rows = list(range(row + 1, row + count + 1)) + list(range(row - 1, row - count - 1, -1))
+        return [self.files[index] for index in rows if 0 <= index < len(self.files)]
+
+    def on_row_changed(self, row):
+        if 0 <= row < len(self.files):
+            self.image_selected.emit(self.files[row])
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.request_visible()
+
+    def cancel_pending(self):
+        """Cancel the thumbnail requests that have not started yet"""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        self.cancel_pending()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
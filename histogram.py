@@ -0,0 +1,139 @@
+"""
+This module computes the per-channel histograms and exposure statistics of images.
+
+Histograms are counted on a decimated sample of at most SAMPLE_PIXELS pixels, every n-th pixel of
+every n-th row, with a single np.bincount for all channels: the values of channel c are offset by
+256 * c, so one pass over the sample counts every channel. A 24 MP image is sampled down to 240K
+pixels, which takes a few milliseconds however large the image is.
+
+For a stream of camera frames, IncrementalHistogram spreads the counting over consecutive frames
+under a time budget per frame, so it never holds up the display of the frames.
+"""
+import math
+import time
+import numpy as np
+from profiling import tracer
+
+SAMPLE_PIXELS = 256 * 1024
+# The proxy size the statistics of a still image are computed on, see Document.statistics
+STATISTICS_SIZE = (1024, 1024)
+# The time a camera frame may spend counting and the number of sample rows counted between time checks
+FRAME_BUDGET_SECONDS = 0.002
+CHUNK_ROWS = 16
+
+_OFFSETS = np.arange(4, dtype=np.uint16) * 256
+
+
+class Statistics:
+    """
+    The histograms and exposure statistics of an image sample.
+
+    Attributes:
+        histograms (np.ndarray): The channels x 256 pixel counts, in the channel order of the image (BGR).
+        pixels (int): The number of sampled pixels.
+        mean (np.ndarray): The mean value of each channel.
+        clipped_low (np.ndarray): The fraction of pixels of each channel at 0.
+        clipped_high (np.ndarray): The fraction of pixels of each channel at 255.
+    """
+    def __init__(self, histograms):
+        self.histograms = histograms
+        self.pixels = int(histograms[0].sum())
+        total = max(self.pixels, 1)
+        self.mean = histograms @ np.arange(256) / total
+        self.clipped_low = histograms[:, 0] / total
+        self.clipped_high = histograms[:, 255] / total
+
+
+def sample_step(height, width, max_pixels=SAMPLE_PIXELS):
+    """Return the stride that decimates a height x width image to at most max_pixels pixels"""
+    return max(1, math.ceil(math.sqrt(height * width / max_pixels)))
+
+
+def count(sample):
+    """
+    Count the values of every channel of an image in a single pass.
+
+    Args:
+        sample (np.ndarray): A uint8 image with up to 4 channels, or a single-channel 2D image.
+
+    Returns:
+        np.ndarray: The channels * 256 counts, channel by channel.
+    """
+    if sample.ndim == 2:
+        sample = sample[..., np.newaxis]
+    channels = sample.shape[2]
+    values = np.add(sample, _OFFSETS[:channels], dtype=np.uint16)
+    return np.bincount(values.ravel(), minlength=256 * channels)
+
+
+def compute_statistics(image, max_pixels=SAMPLE_PIXELS):
+    """
+    Compute the histograms and statistics of an image on a decimated sample.
+
+    Args:
+        image (np.ndarray): The uint8 image.
+        max_pixels (int): The maximum number of pixels sampled.
+
+    Returns:
+        Statistics: The statistics of the sample.
+    """
+    with tracer.span('histogram'):
+        step = sample_step(image.shape[0], image.shape[1], max_pixels)
+        counts = count(image[::step, ::step])
+        return Statistics(counts.reshape(-1, 256))
+
+
+class IncrementalHistogram:
+    """
+    The statistics of a stream of frames, counted a few sample rows at a time under a time budget per frame.
+
+    Each update continues counting on the new frame from the sample row the previous update stopped at.
+    When every sample row has been counted, the statistics are published and counting starts over.
+    The statistics are therefore refreshed every few frames and mix rows of consecutive frames, which
+    is close enough for judging the exposure of a live view.
+
+    Attributes:
+        budget_seconds (float): The time an update may take, at least one chunk of rows is always counted.
+        max_pixels (int): The maximum number of pixels sampled per frame.
+        statistics (Statistics): The latest published statistics, None until the first ones are complete.
+    """
+    def __init__(self, budget_seconds=FRAME_BUDGET_SECONDS, max_pixels=SAMPLE_PIXELS):
+        self.budget_seconds = budget_seconds
+        self.max_pixels = max_pixels
+        self.statistics = None
+        self._shape = None
+        self._counts = None
+        self._row = 0
+
+    def update(self, image):
+        """
+        Count more sample rows of a frame.
+
+        Args:
+            image (np.ndarray): The newest frame.
+
+        Returns:
+            bool: Whether new statistics were published.
+        """
+        deadline = time.perf_counter() + self.budget_seconds
+        if image.shape != self._shape:
+            # Rows of frames of different sizes cannot be mixed
+            self._shape = image.shape
+            self._counts = None
+            self._row = 0
+        step = sample_step(image.shape[0], image.shape[1], self.max_pixels)
+        rows = math.ceil(image.shape[0] / step)
+        with tracer.span('histogram.update'):
+            while self._row < rows:
+                end = min(self._row + CHUNK_ROWS, rows)
+                counts = count(image[self._row * step:end * step:step, ::step])
+                self._counts = counts if self._counts is None else self._counts + counts
+                self._row = end
+                if time.perf_counter() >= deadline:
+                    break
+        if self._row < rows:
+            return False
+        self.statistics = Statistics(self._counts.reshape(-1, 256))
+        self._counts = None
+        self._row = 0
+        return True
@@ -0,0 +1,76 @@
+"""
+This module defines the panel that shows the histograms and exposure statistics of the image.
+"""
+from PyQt5.QtCore import Qt, QPointF, QRectF
+from PyQt5.QtGui import QPainter, QColor, QPolygonF, QFont
+from PyQt5.QtWidgets import QWidget
+
+# The colors and names of the channels of BGR images, single-channel images are shown as luminance
+CHANNELS = {
+    3: [('B', '#2f6fd6'), ('G', '#3d9a48'), ('R', '#d6453b')],
+    1: [('L', '#4a4a4a')],
+}
+TEXT_LINE_HEIGHT = 16
+
+
+class HistogramPanel(QWidget):
+    """
+    A widget that draws the histogram of each channel with its mean and clipping percentages.
+
+    The vertical scale ignores the 0 and 255 bins, so a clipped channel does not flatten the rest of
+    its histogram. Clipping is reported as a percentage instead.
+
+    Attributes:
+        statistics (histogram.Statistics): The statistics shown, None for an empty panel.
+    """
+    def __init__(self, parent=None, background='#fcf3e3'):
+        super().__init__(parent)
+        self.statistics = None
+        self.background = QColor(background)
+        self.setMinimumHeight(160)
+
+    def set_statistics(self, statistics):
+        self.statistics = statistics
+        self.update()
+
+    def clear(self):
+        self.statistics = None
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.background)
+        if self.statistics is None:
+            return
+        statistics = self.statistics
+        channels = CHANNELS.get(len(statistics.histograms), CHANNELS[1] * len(statistics.histograms))
+
+        text_height = TEXT_LINE_HEIGHT * len(channels)
+        plot = QRectF(4, 4, self.width() - 8, self.height() - text_height - 12)
+        histograms = statistics.histograms.tolist()
+        peak = max(max(counts[1:255]) for counts in histograms) or 1
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        for counts, (_, color) in zip(histograms, channels):
+            points = [QPointF(plot.left(), plot.bottom())]
+            for value, count in enumerate(counts):
+                height = min(count / peak, 1.0) * plot.height()
+                points.append(QPointF(plot.left() + value * plot.width() / 255, plot.bottom() - height))
+            points.append(QPointF(plot.right(), plot.bottom()))
+            fill = QColor(color)
+            fill.setAlpha(80)
+            painter.setPen(QColor(color))
+            painter.setBrush(fill)
+            painter.drawPolygon(QPolygonF(points))
+
+        painter.setFont(QFont('Consolas', 8))
+        painter.setPen(QColor('#013d5a'))
+        top = plot.bottom() + 6
+        # Red first, the usual reading order
+        for line, index in enumerate(reversed(range(len(channels)))):
+            name = channels[index][0]
+            # The percentages of the channel clipped to black and to white
+            text = (f"{name} mean {statistics.mean[index]:.1f} "
+                    f"clip {statistics.clipped_low[index] * 100:.1f}/{statistics.clipped_high[index] * 100:.1f}%")
+            painter.drawText(QRectF(plot.left(), top + line * TEXT_LINE_HEIGHT, plot.width(), TEXT_LINE_HEIGHT),
+                             Qt.AlignLeft | Qt.AlignVCenter, text)
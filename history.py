@@ -0,0 +1,375 @@
+"""
+This module defines the undo/redo history of the Photo Editor application.
+
+The history stores each edit as a (name, params) step, plus the smallest delta needed to undo it
+at full resolution:
+- a rectangle or a set of annotation boxes keeps the pixels it overwrote, so undoing or redoing
+  it only touches its region;
+- a global adjustment such as brightness keeps only its parameters, and undoing it recomputes
+  the image from the base image and the remaining steps.
+
+Region deltas count against a byte budget. When the budget is exceeded, the oldest deltas are
+spilled to disk, or dropped if no spill directory is configured. An entry without its delta can
+still be undone by recomputation, so eviction only makes undo slower, never impossible.
+"""
+import functools
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import operations
+import tiled
+from profiling import traced
+
+DEFAULT_BUDGET_BYTES = 256 * 1024 ** 2
+
+
+class HistoryEntry:
+    """
+    A single edit in the history.
+
+    Attributes:
+        step (tuple): The (name, params) operation in full-resolution coordinates.
+        bounds (tuple): The (y0, y1, x0, x1) region a local edit overwrites, None for global edits.
+        pixels (np.ndarray): The pixels the edit overwrote, None if not captured, spilled or evicted.
+        spill_path (str): The file the pixels were spilled to, if any.
+        last_used (float): The time.monotonic() the entry was added or its pixels were last restored.
+    """
+    __slots__ = ('step', 'bounds', 'pixels', 'spill_path', 'last_used')
+
+    def __init__(self, step):
+        self.step = step
+        self.bounds = None
+        self.pixels = None
+        self.spill_path = None
+        self.last_used = time.monotonic()
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes if self.pixels is not None else 0
+
+    def load_pixels(self):
+        """Return the overwritten pixels from memory or the spill file, or None if they were evicted"""
+        self.last_used = time.monotonic()
+        if self.pixels is not None:
+            return self.pixels
+        spill_path = self.spill_path
+        if spill_path is not None:
+            try:
+                return np.load(spill_path)
+            except OSError:
+                # Discarded while an undo was reading it, the edit is recomputed instead
+                return None
+        return None
+
+    def spill(self, directory):
+        """Move the pixels to a .npy file in directory"""
+        self.spill_path = save_pixels(self.pixels, directory)
+        self.pixels = None
+
+    def discard(self):
+        """Drop the delta, the entry can then only be undone by recomputation"""
+        self.pixels = None
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
+
+
+def save_pixels(pixels, directory):
+    """Write pixels to a new .npy file in directory and return its path"""
+    os.makedirs(directory, exist_ok=True)
+    handle, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        np.save(f, pixels)
+    return path
+
+
+def rectangle_bounds(params, shape):
+    """Return the (y0, y1, x0, x1) pixels a filled rectangle covers, clipped to the image"""
+    height, width = shape[:2]
+    # cv2.rectangle includes the bottom-right corner
+    y0 = min(max(params['y'], 0), height)
+    x0 = min(max(params['x'], 0), width)
+    y1 = min(max(params['y'] + params['height'] + 1, 0), height)
+    x1 = min(max(params['x'] + params['width'] + 1, 0), width)
+    return y0, y1, x0, x1
+
+
+def edit_bounds(step, shape):
+    """Return the (y0, y1, x0, x1) region an in-place step overwrites, clipped to the image"""
+    name, params = step
+    if name == 'boxes':
+        return operations.boxes_bounds(params['boxes'], shape, params.get('text_scale', 1.0))
+    return rectangle_bounds(params, shape)
+
+
+class EditHistory:
+    """
+    The list of edits applied to a base image, with an undo/redo position.
+
+    Moving through the history is O(1). The full-resolution image is only brought up to date by
+    materialize(), which undoes local edits by restoring their regions and redoes them by
+    redrawing their regions. The methods are thread-safe, so materialize() can run in the background
+    while the window keeps pushing, undoing and redoing edits.
+
+    Attributes:
+        base (np.ndarray): The image the edits are applied to. It is never modified.
+        entries (list): The HistoryEntry objects, including the ones that were undone.
+        position (int): The number of entries currently applied.
+        budget_bytes (int): The memory available to region deltas.
+        spill_directory (str): The directory deltas are spilled to when over budget, None to drop them.
+    """
+    def __init__(self, base, budget_bytes=DEFAULT_BUDGET_BYTES, spill_directory=None):
+        self.base = base
+        self.entries = []
+        self.position = 0
+        self.budget_bytes = budget_bytes
+        self.spill_directory = spill_directory
+        self._image = base
+        self._image_position = 0
+        self._owns_image = False
+        self._image_used = time.monotonic()
+        self._lock = threading.RLock()
+        self._commit_lock = threading.RLock()
+
+    def steps(self):
+        """Return the currently applied steps in order"""
+        with self._lock:
+            return [entry.step for entry in self.entries[:self.position]]
+
+    def recorded_steps(self):
+        """Return every recorded step, including the undone ones, and the current position"""
+        with self._lock:
+            return [entry.step for entry in self.entries], self.position
+
+    def push(self, step):
+        """Add an edit after the current position, discarding the edits that were undone"""
+        with self._lock:
+            # The materialized image must not keep edits whose deltas are about to be discarded
+            self._image, self._owns_image, self._image_position = self._roll_back(
+                self._image, self._owns_image, self._image_position, self.position, self.entries, self.base)
+            for entry in self.entries[self.position:]:
+                entry.discard()
+            del self.entries[self.position:]
+            self.entries.append(HistoryEntry(step))
+            self.position += 1
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.entries)
+
+    def undo(self):
+        """Step back one edit, return False if there is nothing to undo"""
+        with self._lock:
+            if not self.can_undo():
+                return False
+            self.position -= 1
+            return True
+
+    def redo(self):
+        """Step forward one edit, return False if there is nothing to redo"""
+        with self._lock:
+            if not self.can_redo():
+                return False
+            self.position += 1
+            return True
+
+    @property
+    def delta_bytes(self):
+        """The memory currently held by region deltas"""
+        return sum(entry.nbytes for entry in self.entries)
+
+    @traced('commit')
+    def materialize(self):
+        """Bring the full-resolution image up to the current position and return it"""
+        return self._materialize(share=False)
+
+    def snapshot(self):
+        """
+        Return the full-resolution image at the current position, safe to read from another thread.
+
+        The history gives up ownership of the returned image, so later edits copy it instead of
+        changing it in place.
+        """
+        return self._materialize(share=True)
+
+    def _materialize(self, share):
+        # One commit at a time. The state lock is only held to take and publish the image, so moving
+        # through the history never waits for the edits to be applied.
+        with self._commit_lock:
+            while True:
+                with self._lock:
+                    if self._image_position == self.position:
+                        self._enforce_budget()
+                        self._image_used = time.monotonic()
+                        if share:
+                            self._owns_image = False
+                        return self._image
+                    image, owns, image_position = self._image, self._owns_image, self._image_position
+                    entries = list(self.entries)
+                    position = self.position
+                    # The image is detached while the edits are applied to it, so nothing else changes it
+                    self._image = self.base
+                    self._owns_image = False
+                    self._image_position = 0
+
+                base = self.base
+                image, owns, image_position = self._roll_back(image, owns, image_position, position, entries, base)
+                while image_position < position:
+                    image, owns = self._apply(image, owns, entries[image_position])
+                    image_position += 1
+
+                with self._lock:
+                    # Edits pushed after the undone ones replace them, the image is then recomputed
+                    if all(a is b for a, b in zip(self.entries[:image_position], entries[:image_position])) \
+                            and len(self.entries) >= image_position:
+                        self._image, self._owns_image, self._image_position = image, owns, image_position
+
+    @staticmethod
+    def _roll_back(image, owns, image_position, position, entries, base):
+        """Undo the edits of image beyond position, return the image, its ownership and its position"""
+        while image_position > position:
+            entry = entries[image_position - 1]
+            pixels = entry.load_pixels() if entry.bounds is not None else None
+            if pixels is None:
+                # A global edit or an evicted delta, recompute from the base image
+                return base, False, 0
+            if not owns:
+                # A snapshot shares the image, restore the region on a copy
+                image = EditHistory._copy(image)
+                owns = True
+            y0, y1, x0, x1 = entry.bounds
+            image[y0:y1, x0:x1] = pixels
+            image_position -= 1
+        return image, owns, image_position
+
+    def _apply(self, image, owns, entry):
+        """Apply an entry to image, return the result and whether the history owns it"""
+        name, params = entry.step
+        if name not in operations.IN_PLACE_OPERATIONS:
+            return self._apply_global(image, entry.step), True
+
+        if not owns:
+            image = self._copy(image)
+        if entry.bounds is None:
+            entry.bounds = edit_bounds(entry.step, image.shape)
+        if entry.pixels is None and entry.spill_path is None:
+            y0, y1, x0, x1 = entry.bounds
+            entry.pixels = np.array(image[y0:y1, x0:x1])
+        operations.apply_operation(image, name, params)
+        return image, True
+
+    @staticmethod
+    def _apply_global(image, step):
+        if isinstance(image, np.memmap):
+            return tiled.apply_operations_large(image, [step])
+        return operations.apply_operation(image, *step)
+
+    @staticmethod
+    def _copy(image):
+        if isinstance(image, np.memmap):
+            return tiled.apply_operations_tiled(image, [])
+        return image.copy()
+
+    def _enforce_budget(self):
+        """Spill or drop the oldest in-memory deltas until they fit in the budget"""
+        total = self.delta_bytes
+        for entry in self.entries:
+            if total <= self.budget_bytes:
+                break
+            if entry.pixels is None:
+                continue
+            total -= entry.nbytes
+            if self.spill_directory is not None:
+                entry.spill(self.spill_directory)
+            else:
+                entry.discard()
+
+    def memory_buffers(self):
+        """
+        Return the arrays the history holds, for the memory manager.
+
+        The lock is not taken, so the GUI thread never waits for a commit. The result may be slightly
+        out of date while a commit is running.
+        """
+        return [self.base, self._image] + [entry.pixels for entry in list(self.entries)]
+
+    def spill_candidates(self):
+        """Return the (last used, bytes, spill function) of the materialized image and the in-memory deltas"""
+        candidates = []
+        image = self._image
+        if self._owns_image and not isinstance(image, np.memmap):
+            candidates.append((self._image_used, image.nbytes, self._spill_image))
+        for entry in list(self.entries):
+            if entry.pixels is not None:
+                candidates.append((entry.last_used, entry.nbytes, functools.partial(self._spill_entry, entry)))
+        return candidates
+
+    def _spill_image(self, directory):
+        # Runs on the memory manager's worker, the lock is only held to take and replace the image.
+        # A commit in progress detaches the image, it is spilled on a later attempt.
+        with self._lock:
+            image = self._image
+            if not self._owns_image or isinstance(image, np.memmap):
+                return False
+            # Edits made while it is copied go to a copy of their own
+            self._owns_image = False
+        spilled = tiled.spill(image, directory)
+        with self._lock:
+            if self._image is not image:
+                # Replaced meanwhile, the scratch file is deleted with the last reference to the copy
+                return False
+            self._image = spilled
+            self._owns_image = True
+            return True
+
+    def _spill_entry(self, entry, directory):
+        # Runs on the memory manager's worker, the file is written without holding the lock
+        pixels = entry.pixels
+        if pixels is None:
+            return False
+        path = save_pixels(pixels, directory or self.spill_directory or tempfile.gettempdir())
+        with self._lock:
+            if entry.pixels is pixels and entry in self.entries:
+                entry.spill_path = path
+                entry.pixels = None
+                return True
+        # The entry was discarded or spilled by a commit meanwhile
+        os.remove(path)
+        return False
+
+    def replace_base(self, previous, base):
+        """
+        Replace the base image with an identical copy, e.g. one spilled to disk.
+
+        Returns:
+            bool: False if the base is not previous or the history is busy, the base is then unchanged.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self.base is not previous:
+                return False
+            if self._image is self.base:
+                self._image = base
+            self.base = base
+            return True
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all entries and their spill files"""
+        with self._lock:
+            for entry in self.entries:
+                entry.discard()
+            self.entries = []
+            self.position = 0
+            self._image = self.base
+            self._image_position = 0
+            self._owns_image = False
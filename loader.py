@@ -0,0 +1,284 @@
+"""
+This module loads images progressively on a background thread.
+
+Decoding a 40 MP JPEG takes the better part of a second, so a load first delivers a quick
+low-resolution version of the image and then the full-resolution one:
+- the thumbnail embedded in the EXIF data of JPEG files, which is decoded in a few milliseconds;
+- a reduced JPEG decode (IMREAD_REDUCED_COLOR_2/4/8), where libjpeg skips most of the inverse DCT,
+  at the smallest reduction that still covers the display;
+- the full-resolution image, together with its preview pyramid fitted to the display, so the
+  GUI thread does not have to downscale it either.
+
+Other formats cannot be decoded at a reduced size faster than at full size and go straight to the
+full-resolution decode. A load can be cancelled at any time, its remaining results are then dropped.
+
+The Prefetcher decodes the images the user is likely to open next, such as the neighbors of the
+selected image in the folder browser, so that opening them is immediate.
+"""
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import cv2
+import operations
+import tiled
+from preview import PreviewPyramid
+from profiling import tracer
+
+PREVIEW_REDUCTIONS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# The results a LoadThread puts in its queue, as (kind, value) tuples
+PREVIEW = 'preview'
+PROGRESS = 'progress'
+DONE = 'done'
+ERROR = 'error'
+
+
+class LoadCancelled(Exception):
+    """Raised inside a LoadThread to abort the load"""
+
+
+def _read_ifd(data, position, order):
+    """Return the tags of the TIFF directory at position as {tag: value} and the offset of the next directory"""
+    count, = struct.unpack_from(order + 'H', data, position)
+    tags = {}
+    for index in range(count):
+        tag, kind, _, value = struct.unpack_from(order + 'HHI4s', data, position + 2 + 12 * index)
+        # Only SHORT and LONG values are needed, both fit in the value field
+        if kind == 3:
+            tags[tag], = struct.unpack_from(order + 'H', value)
+        elif kind == 4:
+            tags[tag], = struct.unpack_from(order + 'I', value)
+    next_offset, = struct.unpack_from(order + 'I', data, position + 2 + 12 * count)
+    return tags, next_offset
+
+
+def read_exif_thumbnail(data):
+    """
+    Return the JPEG thumbnail embedded in the EXIF data of a JPEG file.
+
+    Thumbnails of rotated images (EXIF orientation other than 1) are not returned, since OpenCV
+    rotates the decoded image but not the thumbnail.
+
+    Args:
+        data (np.ndarray): The bytes of the file.
+
+    Returns:
+        np.ndarray: The bytes of the thumbnail, or None if there is none.
+    """
+    if bytes(data[:2]) != b'\xff\xd8':
+        return None
+    position = 2
+    try:
+        # The EXIF segment comes right after the start of image marker, or after a JFIF segment
+        while position + 4 <= data.size and data[position] == 0xFF:
+            marker = data[position + 1]
+            length = int(data[position + 2]) << 8 | int(data[position + 3])
+            if marker == 0xE1 and bytes(data[position + 4:position + 10]) == b'Exif\x00\x00':
+                break
+            if marker == 0xDA or not 0xE0 <= marker <= 0xEF:
+                return None
+            position += 2 + length
+        else:
+            return None
+
+        tiff = position + 10
+        segment = bytes(data[tiff:position + 2 + length])
+        order = '<' if segment[:2] == b'II' else '>'
+        ifd0_offset, = struct.unpack_from(order + 'I', segment, 4)
+        ifd0, ifd1_offset = _read_ifd(segment, ifd0_offset, order)
+        if ifd0.get(0x0112, 1) != 1 or ifd1_offset == 0:
+            return None
+        ifd1, _ = _read_ifd(segment, ifd1_offset, order)
+    except (struct.error, IndexError):
+        return None
+
+    offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+    if not offset or not length or offset + length > len(segment):
+        return None
+    thumbnail = data[tiff + offset:tiff + offset + length]
+    return thumbnail if bytes(thumbnail[:2]) == b'\xff\xd8' else None
+
+
+def preview_reduction(width, height, display_size):
+    """Return the largest JPEG reduction factor and flag whose result still covers the display, or None"""
+    fitted_width, fitted_height = operations.fit_size(width, height, *display_size)
+    for factor, flag in PREVIEW_REDUCTIONS:
+        if width // factor >= fitted_width and height // factor >= fitted_height:
+            return factor, flag
+    return None
+
+
+def load_full(file_path, display_size, progress=None):
+    """
+    Decode an image at full resolution and build its preview pyramid for the display.
+
+    Returns:
+        tuple: The image and its PreviewPyramid, or None if the file cannot be decoded.
+    """
+    with tracer.span('decode'):
+        image = tiled.open_image(file_path, progress=progress)
+    if image is None:
+        return None
+    with tracer.span('pyramid'):
+        pyramid = PreviewPyramid(image)
+        pyramid.fit(*display_size)
+    return image, pyramid
+
+
+class LoadThread(threading.Thread):
+    """
+    Loads an image progressively and puts the results in a queue.
+
+    The queue receives (PREVIEW, image) for every low-resolution version, (PROGRESS, fraction) as the
+    load advances, and finally (DONE, (image, pyramid)) or (ERROR, message).
+
+    Attributes:
+        file_path (str): The image file.
+        display_size (tuple): The (width, height) the previews and the pyramid are fitted to.
+        prefetched (Future): A decode of the file still running in the Prefetcher, waited for instead of
+            decoding the file again. The file is decoded if it fails.
+        results (queue.Queue): The results for the GUI thread.
+    """
+    def __init__(self, file_path, display_size, prefetched=None):
+        super().__init__(daemon=True)
+        self.file_path = file_path
+        self.display_size = display_size
+        self.prefetched = prefetched
+        self.results = queue.Queue()
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        """Stop the load as soon as possible, results already queued are kept"""
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _put(self, kind, value):
+        if self.cancelled:
+            raise LoadCancelled()
+        self.results.put((kind, value))
+
+    def run(self):
+        try:
+            with tracer.span('load', path=self.file_path):
+                self._load()
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            self.results.put((ERROR, str(e)))
+
+    def _load(self):
+        if self.prefetched is not None:
+            result = self._wait_for_prefetch()
+            if result is not None:
+                self._put(DONE, result)
+                return
+
+        if not self.file_path.lower().endswith('.npy'):
+            self._load_previews()
+
+        # The display proxy is built here too, instead of on the GUI thread
+        result = load_full(self.file_path, self.display_size, progress=self._decode_progress)
+        if result is None:
+            self._put(ERROR, "Failed to load image.")
+            return
+        self._put(DONE, result)
+
+    def _wait_for_prefetch(self):
+        """Return the result of the prefetched decode, or None if it failed"""
+        while True:
+            if self.cancelled:
+                raise LoadCancelled()
+            try:
+                return self.prefetched.result(timeout=0.05)
+            except TimeoutError:
+                continue
+            except Exception:
+                return None
+
+    def _decode_progress(self, fraction):
+        self._put(PROGRESS, 0.3 + 0.7 * fraction)
+
+    def _load_previews(self):
+        data = operations.map_file(self.file_path)
+        size = tiled.read_image_size(data)
+        if size is None or bytes(data[:2]) != b'\xff\xd8':
+            return
+
+        thumbnail = read_exif_thumbnail(data)
+        if thumbnail is not None:
+            with tracer.span('decode.thumbnail'):
+                image = cv2.imdecode(thumbnail, cv2.IMREAD_COLOR)
+            # Some cameras pad thumbnails to 4:3, those would visibly jump when replaced
+            if image is not None and abs(image.shape[1] / image.shape[0] - size[0] / size[1]) < 0.02:
+                self._put(PREVIEW, image)
+        self._put(PROGRESS, 0.1)
+
+        reduction = preview_reduction(size[0], size[1], self.display_size)
+        if reduction is not None:
+            with tracer.span('decode.reduced', factor=reduction[0]):
+                image = cv2.imdecode(data, reduction[1])
+            if image is not None:
+                self._put(PREVIEW, image)
+        self._put(PROGRESS, 0.3)
+
+
+class Prefetcher:
+    """
+    Decodes images that are likely to be opened next on background threads.
+
+    Only the images of the latest prefetch call are kept, so memory holds at most a few decoded images.
+    """
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+
+    def prefetch(self, file_paths, display_size):
+        """Start decoding the files, dropping the prefetched images of other files"""
+        for file_path in list(self._futures):
+            if file_path not in file_paths:
+                self._futures.pop(file_path).cancel()
+        for file_path in file_paths:
+            if file_path not in self._futures:
+                self._futures[file_path] = self._executor.submit(load_full, file_path, display_size)
+
+    def take(self, file_path):
+        """
+        Return the prefetched decode of a file and forget it.
+
+        Returns:
+            Future: The decode, done or still running, which gives the image and its PreviewPyramid.
+                None if the file was not prefetched or its decode failed.
+        """
+        future = self._futures.pop(file_path, None)
+        if future is None or future.cancelled():
+            return None
+        if future.done() and (future.exception() is not None or future.result() is None):
+            return None
+        return future
+
+    def memory_buffers(self):
+        """Return the arrays of the prefetched images, for the memory manager"""
+        buffers = []
+        for future in list(self._futures.values()):
+            if future.done() and not future.cancelled() and future.exception() is None \
+                    and future.result() is not None:
+                image, pyramid = future.result()
+                buffers.append(image)
+                buffers.extend(pyramid.memory_buffers())
+        return buffers
+
+    def drop_caches(self, excess_bytes):
+        """Forget the prefetched images, their files are decoded again when they are opened"""
+        for file_path, future in list(self._futures.items()):
+            if future.done():
+                del self._futures[file_path]
+
+    def shutdown(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=False)
@@ -7,18 +7,129 @@ The application allows users to load, display, and edit images using various fea
 - Adjusting brightness;
 - Drawing a blue rectangle on the image.
 
+The same operations can be applied to many files without opening the window with --batch, to
+every frame of video files with --video, or offered to other programs by a resident service with --serve.
+
+NumPy and OpenCV are only imported on the first image or camera action, so the window appears as
+quickly as possible. --measure-startup prints how long each startup stage took and exits.
+
 Usage:
     To run the application, execute this script.
 
     Example:
         python main.py
+        python main.py --camera synthetic:1280x720@60
+        python main.py --camera 0 1 2 3
+        python main.py --measure-startup
+        python main.py --batch photos/ --output edited/ --op brightness:70 --op resize:1280x720
+        python main.py --video clip.mp4 --output edited/ --op channel:R
+        python main.py --serve --port 8765
 """
+import time
+
+# Startup stages are measured from here, before anything else is imported
+STARTED = time.perf_counter()
+
+import argparse
 import sys
-from PyQt5.QtWidgets import QApplication
-from main_window import MainWindow
+
+
+def parse_arguments(argv):
+    """Parse the command line arguments of the application"""
+    import batch
+    import service
+    import video
+
+    parser = argparse.ArgumentParser(description="Photo Editor")
+    batch.add_arguments(parser)
+    service.add_arguments(parser)
+    video.add_arguments(parser)
+    parser.add_argument('--camera', nargs='+', default=['0'], metavar='SOURCE',
+                        help="camera device index, video file or synthetic[:WIDTHxHEIGHT[@FPS]], several sources "
+                             "are shown in a grid (default: 0)")
+    parser.add_argument('--burst-seconds', type=float, default=3.0, metavar='SECONDS',
+                        help="camera frames kept for Save Burst, 0 to disable (default: 3)")
+    parser.add_argument('--history-budget', type=int, default=256, metavar='MB',
+                        help="memory for undo data, older undo data is spilled or dropped beyond it (default: 256)")
+    parser.add_argument('--profile', action='store_true',
+                        help="time edit operations and the camera loop and show the timings over the image (F12)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="enable profiling and write a Chrome trace-event file when the window closes")
+    parser.add_argument('--history-spill', metavar='DIR',
+                        help="directory to spill undo data and image buffers over the memory limit to "
+                             "instead of the temporary directory (undo data beyond the history budget is "
+                             "dropped without it)")
+    parser.add_argument('--memory-limit', type=int, metavar='MB',
+                        help="memory for image buffers, caches are dropped and buffers spilled to disk beyond it "
+                             "(default: half of the physical memory)")
+    parser.add_argument('--measure-startup', action='store_true',
+                        help="print the import, window creation and first paint times and exit")
+    # Qt consumes its own options (e.g. -platform), leave them in place for QApplication
+    args, qt_args = parser.parse_known_args(argv[1:])
+    if args.video:
+        video.check_arguments(parser, args)
+    return args, argv[:1] + qt_args
+
+
+def report_startup_on_first_paint(app, stages):
+    """
+    Print the startup stages and quit once the first frame of the window has been painted.
+
+    Args:
+        app (QApplication): The application.
+        stages (list): The (name, time.perf_counter()) of each stage finished so far.
+    """
+    from PyQt5.QtCore import QObject, QEvent, QTimer
+
+    class FirstPaintFilter(QObject):
+        def eventFilter(self, watched, event):
+            if event.type() == QEvent.Paint:
+                app.removeEventFilter(self)
+                # The paint events of the other widgets of the frame are delivered before the timer fires
+                QTimer.singleShot(0, report)
+            return False
+
+    def report():
+        stages.append(('first paint', time.perf_counter()))
+        print("Startup time since main.py started:")
+        previous = STARTED
+        for name, finished in stages:
+            print(f"  {name:<12} {(finished - STARTED) * 1000:8.1f} ms  (+{(finished - previous) * 1000:.1f} ms)")
+            previous = finished
+        heavy = [name for name in ('numpy', 'cv2') if name in sys.modules]
+        print(f"Imported before the first paint: {', '.join(heavy) if heavy else 'no NumPy or OpenCV'}")
+        app.quit()
+
+    paint_filter = FirstPaintFilter(app)
+    app.installEventFilter(paint_filter)
+
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    args, qt_argv = parse_arguments(sys.argv)
+
+    if args.batch:
+        import batch
+        sys.exit(batch.run_from_arguments(args))
+    if args.video:
+        import video
+        sys.exit(video.run_from_arguments(args))
+    if args.serve:
+        import service
+        sys.exit(service.run_from_arguments(args))
+
+    stages = [('arguments', time.perf_counter())]
+    from PyQt5.QtWidgets import QApplication
+    from main_window import MainWindow
+    stages.append(('imports', time.perf_counter()))
+
+    app = QApplication(qt_argv)
+    stages.append(('application', time.perf_counter()))
+    window = MainWindow(camera_sources=args.camera, history_budget=args.history_budget * 1024 ** 2,
+                        history_spill_directory=args.history_spill, profile=args.profile, trace_path=args.trace,
+                        memory_limit=args.memory_limit * 1024 ** 2 if args.memory_limit else None,
+                        burst_seconds=args.burst_seconds)
+    stages.append(('window', time.perf_counter()))
+    if args.measure_startup:
+        report_startup_on_first_paint(app, stages)
     window.show()
     sys.exit(app.exec_())
@@ -1,49 +1,79 @@
 """
 This script defines the main window for the Photo Editor application.
+
+Only Qt and the standard library are imported up front, so the window appears as soon as possible.
+NumPy, OpenCV, the image modules and the dialogs are imported by the methods that use them, on the
+first image, folder or camera action.
 """
+import functools
 import os
-import cv2
-import numpy as np
-from PyQt5.QtGui import QPixmap, QImage, QPainter
+import queue
+import time
+from PyQt5.QtGui import QKeySequence
 from PyQt5.QtWidgets import QMainWindow, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, \
-    QSizePolicy, QFileDialog, QMessageBox
+    QSizePolicy, QFileDialog, QMessageBox, QShortcut, QProgressDialog
 from PyQt5.QtCore import Qt, QTimer
-from resize_dialog import ResizeDialog
-from brightness_dialog import BrightnessDialog
-from rectangle_dialog import RectangleDialog
+from canvas import ImageCanvas
+from memory import MemoryManager, CallbackConsumer, heap_buffer
+from profiling import tracer, traced
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, camera_sources=('0',), history_budget=None, history_spill_directory=None,
+                 profile=False, trace_path=None, memory_limit=None, burst_seconds=3.0):
         super().__init__()
 
         self.take_photo_button = None
-        self.current_pixmap = None
-        self.original_pixmap = None
         self.cv_image = None
         self.original_image = None
+        # Edits are previewed on display-sized proxies and applied at full resolution on demand
+        self.document = None
+        self.history = None
+        self.history_budget = history_budget
+        self.history_spill_directory = history_spill_directory
+        self.preview_image = None
+        self.brightness_buffer = None
+        self.source_used = None
+        # Image buffers are kept under the memory limit by dropping caches and spilling to disk
+        self.memory = MemoryManager(memory_limit, history_spill_directory)
+        # A single worker applies committed edits at full resolution in the background, created with the first image
+        self.commit_executor = None
+        # Set by the commit worker when applying the edits failed, shown by update_memory on the GUI thread
+        self.commit_error = None
+        # Exports run on their own worker so they never wait behind commits, and vice versa
+        self.export_executor = None
+        self.export_future = None
+        # Video files are processed frame by frame on their own worker, with a progress dialog
+        self.video_executor = None
+        self.video_future = None
+        self.video_progress = (0, None)
+        self.video_cancel = None
+        self.video_dialog = None
+        # A reopened session shows its stored previews until its source is decoded
+        self.pending_session = None
+        self.image_path = None
         self.setWindowTitle("Photo Editor")
 
         main_widget = QWidget(self)
         self.setCentralWidget(main_widget)
         main_widget.setStyleSheet("background-color: #bdd3ce;")
 
-        # Image display label
-        self.image_label = QLabel(self)
-        self.image_label.setStyleSheet("background-color: #fcf3e3;")
-        self.image_label.setAlignment(Qt.AlignCenter)
-        self.image_label.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        # Image display with wheel zoom and drag pan
+        self.canvas = ImageCanvas(self, background='#fcf3e3')
+        self.canvas.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.canvas.tile_failed.connect(self.show_detail_error)
 
         # Buttons
         self.red_button = QPushButton("Display Red Channel")
         self.green_button = QPushButton("Display Green Channel")
         self.blue_button = QPushButton("Display Blue Channel")
         self.resize_button = QPushButton("Resize Image")
-        self.brightness_button = QPushButton("Decrease Brightness")
+        self.brightness_button = QPushButton("Adjust Brightness")
         self.rectangle_button = QPushButton("Draw Blue Rectangle")
+        self.boxes_button = QPushButton("Import Boxes")
 
         buttons = [self.red_button, self.green_button, self.blue_button, self.resize_button, self.brightness_button,
-                   self.rectangle_button]
+                   self.rectangle_button, self.boxes_button]
         for button in buttons:
             button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
             button.setStyleSheet(
@@ -60,18 +90,77 @@ class MainWindow(QMainWindow):
         self.load_button.setStyleSheet(
             "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
             " background-color: #708c69; color: #fcf3e3;")
+        self.folder_button = QPushButton("Open Folder")
+        self.folder_button.setStyleSheet(
+            "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+            " background-color: #708c69; color: #fcf3e3;")
         self.camera_button = QPushButton("Connect to Camera")
         self.camera_button.setStyleSheet(
             "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
             " background-color: #708c69; color: #fcf3e3;")
         self.camera_button.setCheckable(True)
+        # Recording and burst saving are shown while the camera is connected
+        self.record_button = QPushButton("Record")
+        self.record_button.setCheckable(True)
+        self.burst_button = QPushButton("Save Burst")
+        for button in (self.record_button, self.burst_button):
+            button.setStyleSheet(
+                "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+                " background-color: #708c69; color: #fcf3e3;")
+            button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+            button.hide()
+        self.export_button = QPushButton("Export")
+        self.export_button.setStyleSheet(
+            "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+            " background-color: #708c69; color: #fcf3e3;")
+        self.session_button = QPushButton("Save Session")
+        self.session_button.setStyleSheet(
+            "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+            " background-color: #708c69; color: #fcf3e3;")
+        self.video_button = QPushButton("Process Video")
+        self.video_button.setStyleSheet(
+            "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+            " background-color: #708c69; color: #fcf3e3;")
+        self.histogram_button = QPushButton("Histogram")
+        self.histogram_button.setStyleSheet(
+            "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+            " background-color: #708c69; color: #fcf3e3;")
+        self.histogram_button.setCheckable(True)
+
+        # Undo and redo buttons
+        self.undo_button = QPushButton("Undo")
+        self.redo_button = QPushButton("Redo")
+        for button in (self.undo_button, self.redo_button):
+            button.setStyleSheet(
+                "font-size: 15px; font-family: Bahnschrift; font-weight: bold;"
+                " background-color: #708c69; color: #fcf3e3;")
+            button.setEnabled(False)
+        self.undo_button.setShortcut(QKeySequence.Undo)
+        self.redo_button.setShortcut(QKeySequence.Redo)
 
         self.load_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.folder_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.camera_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.export_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.video_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.session_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.histogram_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.undo_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.redo_button.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
         # Connect buttons to functions
         self.load_button.clicked.connect(self.load_image)
+        self.folder_button.clicked.connect(self.open_folder)
         self.camera_button.clicked.connect(self.toggle_camera)
+        self.record_button.toggled.connect(self.toggle_recording)
+        self.burst_button.clicked.connect(self.save_burst)
+        self.export_button.clicked.connect(self.export_image)
+        self.video_button.clicked.connect(self.process_video)
+        self.session_button.clicked.connect(self.save_session)
+        self.session_button.setShortcut(QKeySequence.Save)
+        self.histogram_button.toggled.connect(self.toggle_histogram)
+        self.undo_button.clicked.connect(self.undo)
+        self.redo_button.clicked.connect(self.redo)
 
         self.resize_button.clicked.connect(self.resize_image)
         self.red_button.clicked.connect(lambda: self.display_channel('R'))
@@ -79,11 +168,21 @@ class MainWindow(QMainWindow):
         self.blue_button.clicked.connect(lambda: self.display_channel('B'))
         self.brightness_button.clicked.connect(self.adjust_brightness)
         self.rectangle_button.clicked.connect(self.draw_rectangle)
+        self.boxes_button.clicked.connect(self.import_boxes)
 
         # Bottom button layout
         self.bottom_button_layout = QHBoxLayout()
         self.bottom_button_layout.addWidget(self.load_button)
+        self.bottom_button_layout.addWidget(self.folder_button)
         self.bottom_button_layout.addWidget(self.camera_button)
+        self.bottom_button_layout.addWidget(self.record_button)
+        self.bottom_button_layout.addWidget(self.burst_button)
+        self.bottom_button_layout.addWidget(self.export_button)
+        self.bottom_button_layout.addWidget(self.session_button)
+        self.bottom_button_layout.addWidget(self.video_button)
+        self.bottom_button_layout.addWidget(self.histogram_button)
+        self.bottom_button_layout.addWidget(self.undo_button)
+        self.bottom_button_layout.addWidget(self.redo_button)
 
         self.bottom_container = QWidget()
         self.bottom_container.setLayout(self.bottom_button_layout)
@@ -91,9 +190,22 @@ class MainWindow(QMainWindow):
 
         # Main layout
         self.main_layout = QHBoxLayout()
-        self.main_layout.addWidget(self.image_label, 3)
+        self.main_layout.addWidget(self.canvas, 3)
         self.main_layout.addLayout(self.button_layout, 1)
 
+        self.memory.register('image', CallbackConsumer(
+            lambda: [self.original_image, self.loading_preview, self.brightness_buffer],
+            self.source_spill_candidates))
+        self.memory.register('canvas', self.canvas)
+
+        # Histogram panel under the edit buttons, created when it is first shown
+        self.histogram_panel = None
+        self.camera_histogram = None
+
+        # Folder browser, created when a folder is first opened
+        self.filmstrip = None
+        self.prefetcher = None
+
         self.final_layout = QVBoxLayout()
         self.final_layout.addLayout(self.main_layout, 7)
         self.final_layout.addWidget(self.bottom_container, 1)
@@ -102,211 +214,941 @@ class MainWindow(QMainWindow):
 
         self.resize(800, 600)
 
-        # Timer for camera updates
-        self.capture = None
+        # Memory usage of the image buffers, checked against the limit every second once an image is loaded
+        self.memory_label = QLabel()
+        self.statusBar().addPermanentWidget(self.memory_label)
+        self.memory_timer = QTimer(self)
+        self.memory_timer.setInterval(1000)
+        self.memory_timer.timeout.connect(self.update_memory)
+
+        # Camera capture runs on its own thread, the timer only pulls the newest frame for display.
+        # Several sources are shown in a grid, each captured and scaled on its own thread.
+        self.camera_sources = list(camera_sources)
+        self.capture_thread = None
+        self.camera_grid = None
+        self.last_frame = None
         self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.update_frame)
+        # The capture thread also feeds the video recorder and the ring of the last burst_seconds of frames
+        self.burst_seconds = burst_seconds
+        self.recorder = None
+        self.burst = None
+        self.burst_future = None
+        self.burst_timer = QTimer(self)
+        self.burst_timer.setInterval(50)
+        self.burst_timer.timeout.connect(self.poll_burst)
+
+        # Images are decoded on a loader thread, the timer delivers its previews and the final image
+        self.load_thread = None
+        self.loading_preview = None
+        self.load_timer = QTimer(self)
+        self.load_timer.setInterval(10)
+        self.load_timer.timeout.connect(self.poll_load)
+
+        # Exports are encoded on a worker thread, the timer reports their results when they are done
+        self.export_timer = QTimer(self)
+        self.export_timer.setInterval(50)
+        self.export_timer.timeout.connect(self.poll_export)
+        self.video_timer = QTimer(self)
+        self.video_timer.setInterval(100)
+        self.video_timer.timeout.connect(self.poll_video)
+
+        # Profiling overlay, refreshed a few times per second while profiling is enabled
+        self.trace_path = trace_path
+        self.profile_overlay = QLabel(self.canvas)
+        self.profile_overlay.setStyleSheet(
+            "background-color: rgba(1, 61, 90, 190); color: #fcf3e3; font-family: Consolas, monospace;"
+            " font-size: 11px; padding: 4px;")
+        self.profile_overlay.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.profile_overlay.hide()
+        self.profile_timer = QTimer(self)
+        self.profile_timer.timeout.connect(self.update_profile_overlay)
+        QShortcut(QKeySequence(Qt.Key_F12), self, self.toggle_profiling)
+        QShortcut(QKeySequence("Ctrl+Shift+T"), self, self.export_trace)
+        QShortcut(QKeySequence("Ctrl+0"), self, self.canvas.zoom_to_fit)
+        QShortcut(QKeySequence("Ctrl+1"), self, lambda: self.canvas.set_zoom(1.0))
+        if profile or trace_path:
+            self.toggle_profiling()
 
         self.cv_image = None
 
     def load_image(self):
-        """Load an image from the filesystem and display it"""
-        file_path, _ = QFileDialog.getOpenFileName(self, "Open Image File", "", "Images (*.png *.jpg)")
-        if file_path:
+        """Load an image from the filesystem in the background, or cancel the load in progress"""
+        if self.load_thread is not None:
+            self.finish_load()
+            return
+
+        file_path, _ = QFileDialog.getOpenFileName(self, "Open Image File", "",
+                                                   "Images and sessions (*.png *.jpg *.jpeg *.ppm *.pgm *.npy "
+                                                   "*.session)")
+        if file_path.lower().endswith('.session'):
+            self.open_session(file_path)
+        elif file_path:
+            self.start_load(file_path)
+
+    def open_folder(self):
+        """Browse the images of a folder in the filmstrip"""
+        folder = QFileDialog.getExistingDirectory(self, "Open Folder")
+        if folder:
+            if self.filmstrip is None:
+                self.create_filmstrip()
+            try:
+                self.filmstrip.set_folder(folder)
+            except OSError as e:
+                QMessageBox.critical(self, "Error", f"Failed to open folder: {str(e)}")
+                return
+            self.filmstrip.show()
+
+    def create_filmstrip(self):
+        """Create the folder browser and the prefetcher of its images"""
+        from filmstrip import Filmstrip
+        import loader
+
+        self.filmstrip = Filmstrip(self)
+        self.filmstrip.image_selected.connect(self.open_file)
+        self.filmstrip.hide()
+        self.final_layout.insertWidget(1, self.filmstrip)
+        self.prefetcher = loader.Prefetcher()
+        self.memory.register('prefetch', self.prefetcher)
+
+    def open_file(self, file_path):
+        """Open an image selected in the filmstrip and prefetch its neighbors"""
+        if self.load_thread is not None:
+            self.finish_load()
+        prefetched = self.prefetcher.take(file_path)
+        if prefetched is not None and prefetched.done():
+            self.set_image(*prefetched.result())
+            self.image_path = file_path
+        else:
+            # A prefetch that is still decoding is waited for on the loader thread, not started over
+            self.start_load(file_path, prefetched)
+        self.prefetcher.prefetch(self.filmstrip.neighbors(file_path), self.display_size())
+
+    def start_load(self, file_path, prefetched=None):
+        """Start loading an image file on the loader thread, or waiting for its prefetched decode"""
+        import loader
+
+        self.load_thread = loader.LoadThread(file_path, self.display_size(), prefetched)
+        self.load_thread.start()
+        self.load_timer.start()
+        self.set_edit_buttons_enabled(False)
+        self.load_button.setText("Cancel Loading")
+
+    def poll_load(self):
+        """Display the previews of the image being loaded and switch to the full image when it is ready"""
+        import loader
+
+        while self.load_thread is not None:
             try:
-                image = self.load_image_with_cv2(file_path)
-                if image is not None:
-                    self.cv_image = image
-                    self.original_image = image.copy()
-                    pixmap = self.convert_cvimage_to_qpixmap(image)
-                    if pixmap is not None:
-                        self.display_image(pixmap)
-                    else:
-                        QMessageBox.critical(self, "Error", "Failed to load image.")
+                kind, value = self.load_thread.results.get_nowait()
+            except queue.Empty:
+                return
+            if kind == loader.PREVIEW:
+                # The previews of a session already show its edits
+                if self.pending_session is None:
+                    self.loading_preview = value
+                    self.display_image(value)
+            elif kind == loader.PROGRESS:
+                self.load_button.setText(f"Cancel Loading ({value:.0%})")
+            elif kind == loader.DONE:
+                self.loading_preview = None
+                file_path = self.load_thread.file_path
+                session = self.pending_session
+                self.finish_load()
+                if session is not None:
+                    self.set_image(*value, steps=session.steps, position=session.position)
                 else:
-                    QMessageBox.critical(self, "Error", "Failed to load image.")
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Failed to load image: {str(e)}")
+                    self.set_image(*value)
+                self.image_path = file_path
+            else:
+                self.finish_load()
+                QMessageBox.critical(self, "Error", f"Failed to load image: {value}")
+
+    def finish_load(self):
+        """Stop polling the loader thread and cancel it if it is still running"""
+        self.load_thread.cancel()
+        self.load_thread = None
+        self.load_timer.stop()
+        self.load_button.setText("Load Image")
+        self.set_edit_buttons_enabled(True)
+        self.pending_session = None
+        if self.loading_preview is not None and self.document is not None:
+            # The load was cancelled or failed, show the image being edited again
+            self.refresh_preview()
+        self.loading_preview = None
+
+    def set_edit_buttons_enabled(self, enabled):
+        """Enable or disable the buttons that edit the current image"""
+        for button in (self.red_button, self.green_button, self.blue_button, self.resize_button,
+                       self.brightness_button, self.rectangle_button, self.boxes_button):
+            button.setEnabled(enabled)
+        if enabled:
+            self.update_history_buttons()
+        else:
+            self.undo_button.setEnabled(False)
+            self.redo_button.setEnabled(False)
 
     @staticmethod
+    @traced('decode')
     def load_image_with_cv2(file_path):
-        """Load an image using OpenCV"""
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"File {file_path} not found.")
-
-        with open(file_path, 'rb') as f:
-            image_data = np.frombuffer(f.read(), dtype=np.uint8)
-            image = cv2.imdecode(image_data, cv2.IMREAD_COLOR)
-            return image
-
-    def convert_cvimage_to_qpixmap(self, image):
-        """Convert a CV image to QPixmap"""
-        if image is None:
-            return None
-
-        # Resize the image to fit the label
-        label_width = self.image_label.width()
-        label_height = self.image_label.height()
-
-        h, w, ch = image.shape
-        bytes_per_line = ch * w
-        q_image = QImage(image.data, w, h, bytes_per_line, QImage.Format_BGR888)
-        pixmap = QPixmap.fromImage(q_image).scaled(label_width, label_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        return pixmap
-
-    def display_image(self, pixmap):
-        """Display the given QPixmap in the image label"""
-        self.image_label.setPixmap(pixmap)
-        self.image_label.adjustSize()
-        self.current_pixmap = pixmap
+        """Load an image using OpenCV, large images are kept memory-mapped in the tile cache"""
+        import tiled
+
+        return tiled.open_image(file_path)
+
+    @traced('set_image')
+    def set_image(self, image, pyramid=None, steps=(), position=None):
+        """
+        Make the given image the one being edited and display it.
+
+        Args:
+            image (np.ndarray): The image.
+            pyramid (PreviewPyramid): The preview pyramid of the image if it was already built, e.g. by the loader.
+            steps (list): The edits to restore, e.g. from a session. They are applied at full resolution
+                in the background.
+            position (int): The number of restored edits applied, the others can be redone. All by default.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from document import Document
+        from history import EditHistory, DEFAULT_BUDGET_BYTES
+
+        if self.commit_executor is None:
+            self.commit_executor = ThreadPoolExecutor(max_workers=1)
+        # Edits never modify the loaded image in place, so the original shares its array
+        self.cv_image = image
+        self.original_image = image
+        self.document = Document(image, pyramid=pyramid)
+        if self.history is not None:
+            self.history.clear()
+        budget = DEFAULT_BUDGET_BYTES if self.history_budget is None else self.history_budget
+        self.history = EditHistory(image, budget, self.history_spill_directory)
+        for step in steps:
+            self.history.push(step)
+        for _ in range(len(steps) - (len(steps) if position is None else position)):
+            self.history.undo()
+        self.source_used = time.monotonic()
+        self.memory.register('history', self.history)
+        self.memory.register('document', self.document)
+        self.refresh_preview()
+        if steps:
+            self.commit_in_background()
+        self.update_memory()
+        self.memory_timer.start()
+
+    @traced('preview')
+    def refresh_preview(self, dirty_step=None):
+        """
+        Render the applied edits at display size and display the result.
+
+        Args:
+            dirty_step (tuple): The in-place step that was just added, if any. Only the region it
+                changed is then repainted.
+        """
+        from history import edit_bounds
+
+        # Earlier renders are memoized, so undo and redo usually only hit the cache
+        self.document.set_operations(self.history.steps())
+        self.preview_image = self.document.render(self.display_size())
+        full_width, full_height = self.document.output_size()
+        dirty = None if dirty_step is None else edit_bounds(dirty_step, (full_height, full_width))
+        self.display_image(self.preview_image, (full_width, full_height), self.document.region_renderer(), dirty)
+        self.update_history_buttons()
+        self.update_histogram()
+
+    def toggle_histogram(self, checked):
+        """Show or hide the histogram panel"""
+        if self.histogram_panel is None:
+            from histogram_panel import HistogramPanel
+
+            self.histogram_panel = HistogramPanel(self)
+            self.button_layout.addWidget(self.histogram_panel)
+        self.histogram_panel.setVisible(checked)
+        if checked:
+            self.update_histogram()
+
+    def histogram_visible(self):
+        return self.histogram_panel is not None and self.histogram_panel.isVisible()
+
+    def update_histogram(self):
+        """Show the statistics of the edited image, they are memoized until an edit changes pixels"""
+        if not self.histogram_visible() or self.camera_running():
+            return
+        if self.document is None:
+            self.histogram_panel.clear()
+        else:
+            self.histogram_panel.set_statistics(self.document.statistics())
+
+    @traced('edit')
+    def preview_edit(self, step):
+        """
+        Add an edit to the history and show its effect on the display proxy.
+
+        Args:
+            step (tuple): The (name, params) operation in full-resolution coordinates.
+        """
+        import operations
+
+        self.history.push(step)
+        # Only the new step is computed, the render before it is cached
+        self.refresh_preview(step if step[0] in operations.IN_PLACE_OPERATIONS else None)
+        self.commit_in_background()
+
+    def commit_in_background(self):
+        """Start applying the edits at full resolution on the worker thread"""
+        # Queued requests are cheap, materialize returns immediately when the image is up to date
+        future = self.commit_executor.submit(self.history.materialize)
+        future.add_done_callback(self.commit_done)
+
+    def commit_done(self, future):
+        # Runs on the commit worker, the error is shown by update_memory
+        error = future.exception()
+        if error is not None:
+            # A MemoryError usually has no message
+            self.commit_error = str(error) or type(error).__name__
+
+    def full_resolution_image(self):
+        """Apply the edits at full resolution and return the result"""
+        return self.history.materialize()
+
+    def update_memory(self):
+        """Enforce the memory limit and show the memory usage in the status bar"""
+        self.memory.enforce()
+        if self.commit_error is not None:
+            self.statusBar().showMessage(f"Applying the edits at full resolution failed: {self.commit_error}", 10000)
+            self.commit_error = None
+        line, details = self.memory.summary()
+        self.memory_label.setText(line)
+        self.memory_label.setToolTip("\n".join(details))
+
+    def show_detail_error(self, message):
+        """Show in the status bar that the zoomed-in detail could not be rendered"""
+        self.statusBar().showMessage(f"Rendering the zoomed-in detail failed: {message}", 10000)
+
+    def source_spill_candidates(self):
+        """Return the loaded image as a spill candidate for the memory manager, unless it is already on disk"""
+        image = self.original_image
+        if image is None or heap_buffer(image) is None:
+            return []
+        return [(self.source_used, image.nbytes, functools.partial(self.spill_source, image))]
+
+    def spill_source(self, image, directory):
+        """
+        Copy the loaded image to a memory-mapped file, on the memory manager's worker.
+
+        Returns:
+            callable: Puts the copy in place on the GUI thread, see replace_source.
+        """
+        import tiled
+
+        spilled = tiled.spill(image, directory)
+        return functools.partial(self.replace_source, image, spilled)
+
+    def replace_source(self, image, spilled):
+        """Replace the loaded image with its spilled copy everywhere it is used, unless another image was opened"""
+        # The history shares the image and may refuse while it is busy, so it is replaced first. A refused
+        # copy is an anonymous scratch file, deleted with its last reference.
+        if self.original_image is not image or not self.history.replace_base(image, spilled):
+            return False
+        self.document.replace_source(spilled)
+        self.cv_image = self.original_image = spilled
+        return True
+
+    @traced('undo')
+    def undo(self):
+        """Undo the last edit"""
+        if self.history is not None and self.history.undo():
+            self.refresh_preview()
+            self.commit_in_background()
+
+    @traced('redo')
+    def redo(self):
+        """Redo the last undone edit"""
+        if self.history is not None and self.history.redo():
+            self.refresh_preview()
+            self.commit_in_background()
+
+    def update_history_buttons(self):
+        """Enable the undo and redo buttons when there is something to undo or redo"""
+        self.undo_button.setEnabled(self.history is not None and self.history.can_undo())
+        self.redo_button.setEnabled(self.history is not None and self.history.can_redo())
+
+    def resizeEvent(self, event):
+        """Recompute the display proxy for the new label size"""
+        super().resizeEvent(event)
+        if self.pending_session is not None:
+            self.display_session_preview()
+        elif self.loading_preview is not None:
+            self.display_image(self.loading_preview)
+        elif self.document is not None and not self.camera_running():
+            self.refresh_preview()
+
+    def display_image(self, image, full_size=None, detail=None, dirty=None):
+        """Display an image in the canvas, see ImageCanvas.set_image for the arguments"""
+        with tracer.span('display.update'):
+            self.canvas.set_image(image, full_size, detail, dirty)
 
     def toggle_camera(self):
         """Toggle the camera on and off"""
         if self.camera_button.isChecked():
             self.camera_button.setText("Take Photo")
             try:
-                self.capture = cv2.VideoCapture(0)
-                if not self.capture.isOpened():
-                    raise Exception("Failed to open camera.")
-                self.timer.start(10)
+                self.start_capture()
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Failed to open camera: {str(e)}")
                 self.camera_button.setChecked(False)
                 self.camera_button.setText("Connect to Camera")
         else:
             self.camera_button.setText("Connect to Camera")
-            if self.capture and self.capture.isOpened():
-                self.timer.stop()
-                self.capture.release()
+            self.stop_capture()
+            self.take_photo()
+
+    def start_capture(self):
+        """Open the frame sources and start a capture thread for each of them"""
+        import camera
+
+        sources = []
+        try:
+            for spec in self.camera_sources:
+                source = camera.open_frame_source(spec)
+                source.open()
+                sources.append(source)
+        except Exception:
+            for source in sources:
+                source.release()
+            raise
+        self.last_frame = None
+        self.camera_histogram = None
+        if len(sources) > 1:
+            # Recording and bursts follow a single source, they are not offered for the grid
+            self.camera_grid = camera.CaptureGrid(sources, self.display_size())
+            self.camera_grid.start()
+            self.timer.start(self.display_interval())
+            return
+        source = sources[0]
+        self.capture_thread = camera.CaptureThread(source, display_size=self.display_size())
+        if self.burst_seconds > 0 and self.burst_future is None:
+            self.burst = camera.BurstBuffer(round(self.burst_seconds * (source.fps or 30.0)))
+            self.capture_thread.sinks = (self.burst,)
+            self.memory.register('burst', self.burst)
+            self.burst_button.show()
+        self.record_button.show()
+        self.capture_thread.start()
+        self.timer.start(self.display_interval())
+
+    def camera_running(self):
+        return self.capture_thread is not None or self.camera_grid is not None
+
+    def stop_capture(self):
+        """Stop the capture threads and release the frame sources"""
+        self.timer.stop()
+        if self.camera_grid is not None:
+            self.camera_grid.stop()
+            if any(frame is not None for frame in self.camera_grid.frames):
+                # Take Photo keeps the grid as it was last displayed
+                self.last_frame = self.camera_grid
+            self.camera_grid = None
+            self.update_histogram()
+        if self.capture_thread is not None:
+            self.capture_thread.stop()
+            self.capture_thread = None
+            self.update_histogram()
+        self.record_button.setChecked(False)
+        self.record_button.hide()
+        self.burst_button.hide()
+        # A burst being saved keeps its frames until it is written
+        if self.burst_future is None:
+            self.release_burst()
+
+    def release_burst(self):
+        self.burst = None
+        self.memory.unregister('burst')
+
+    def toggle_recording(self, checked):
+        """Start recording the camera stream to a video file, or stop and report the recording"""
+        import camera
+
+        if checked:
+            file_path, _ = QFileDialog.getSaveFileName(self, "Record Video", "recording.avi",
+                                                       "Video (*.avi *.mp4)")
+            if not file_path or self.capture_thread is None:
+                self.record_button.setChecked(False)
+                return
+            thread = self.capture_thread
+            try:
+                self.recorder = camera.VideoRecorder(file_path, thread.source.fps or thread.fps or 30.0)
+            except ValueError as e:
+                QMessageBox.warning(self, "Warning", str(e))
+                self.record_button.setChecked(False)
+                return
+            thread.sinks = thread.sinks + (self.recorder,)
+            self.record_button.setText("Stop Recording")
+            return
+
+        self.record_button.setText("Record")
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        if self.capture_thread is not None:
+            self.capture_thread.sinks = tuple(sink for sink in self.capture_thread.sinks if sink is not recorder)
+        recorder.stop()
+        if recorder.error is not None:
+            QMessageBox.critical(self, "Error", f"Failed to record video: {str(recorder.error)}")
+        elif recorder.dropped:
+            QMessageBox.warning(self, "Warning", f"Recorded {recorder.frames_written} frames to {recorder.path}, "
+                                                 f"{recorder.dropped} frames were left out because the encoder "
+                                                 f"could not keep up.")
+
+    def save_burst(self):
+        """Save the frames of the last burst_seconds as numbered images, in the background"""
+        from concurrent.futures import ThreadPoolExecutor
+        import camera
+
+        if self.burst is None or self.burst_future is not None:
+            return
+        # Frozen at the click, the frames after it are not kept while the burst is saved
+        frames = self.burst.freeze()
+        if not frames:
+            self.burst.resume()
+            return
+        directory = QFileDialog.getExistingDirectory(self, "Save Burst")
+        if not directory:
+            self.burst.resume()
+            return
+        if self.export_executor is None:
+            self.export_executor = ThreadPoolExecutor(max_workers=1)
+        self.burst_future = self.export_executor.submit(camera.save_burst, frames, directory)
+        self.burst_button.setEnabled(False)
+        self.burst_button.setText("Saving...")
+        self.burst_timer.start()
+
+    def poll_burst(self):
+        """Report the saved burst and let the ring take frames again once the files are written"""
+        if not self.burst_future.done():
+            return
+        self.burst_timer.stop()
+        future, self.burst_future = self.burst_future, None
+        self.burst_button.setEnabled(True)
+        self.burst_button.setText("Save Burst")
+        if self.capture_thread is not None and self.burst in self.capture_thread.sinks:
+            self.burst.resume()
+        else:
+            self.release_burst()
+        try:
+            paths = future.result()
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to save burst: {str(e)}")
+            return
+        self.statusBar().showMessage(f"Saved {len(paths)} frames to {os.path.dirname(paths[0])}", 5000)
+
+    def display_size(self):
+        """Return the size of the canvas as a (width, height) tuple"""
+        return self.canvas.width(), self.canvas.height()
+
+    def display_interval(self):
+        """Return the display refresh interval in milliseconds"""
+        screen = self.screen()
+        refresh_rate = screen.refreshRate() if screen is not None else 0
+        return max(1, int(1000 / (refresh_rate if refresh_rate > 0 else 60)))
 
     def update_frame(self):
-        """Update the frame from the camera"""
-        ret, frame = self.capture.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            h, w, ch = frame.shape
-            bytes_per_line = ch * w
-            image = QImage(frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
-            scaled_image = image.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.image_label.setPixmap(QPixmap.fromImage(scaled_image))
-
-            self.current_pixmap = QPixmap.fromImage(image)
-            self.cv_image = frame
-            self.take_photo()
+        """Display the newest camera frame, if a new one has arrived"""
+        if self.camera_grid is not None:
+            self.update_grid()
+            return
+        frame = self.capture_thread.buffer.latest()
+        if frame is None:
+            if not self.capture_thread.is_alive():
+                self.camera_button.setChecked(False)
+                self.toggle_camera()
+            return
+
+        with tracer.span('update_frame'):
+            self.last_frame = frame
+            self.capture_thread.display_size = self.display_size()
+            # Zooming in shows the full camera frame instead of the scaled preview
+            image = frame.image
+            self.canvas.set_image(frame.preview, (image.shape[1], image.shape[0]), image)
+
+            # Counted a few rows per frame within a fixed time budget, so the display rate is unaffected
+            if self.histogram_visible():
+                if self.camera_histogram is None:
+                    import histogram
+                    self.camera_histogram = histogram.IncrementalHistogram()
+                if self.camera_histogram.update(image):
+                    self.histogram_panel.set_statistics(self.camera_histogram.statistics)
+
+        if tracer.enabled:
+            thread = self.capture_thread
+            tracer.counter('camera', fps=thread.fps, captured=thread.frames_captured, dropped=thread.dropped,
+                           latency_ms=(time.perf_counter() - frame.timestamp) * 1000)
+
+    def update_grid(self):
+        """Composite the newest frames of every source into the grid and repaint the tiles that changed"""
+        grid = self.camera_grid
+        if not grid.is_alive() and not any(len(thread.buffer) for thread in grid.threads):
+            self.camera_button.setChecked(False)
+            self.toggle_camera()
+            return
+
+        with tracer.span('update_grid'):
+            resized = grid.resize(self.display_size())
+            dirty = grid.update()
+            if dirty is None and not resized:
+                return
+            # The grid is updated in place, the canvas repaints the changed region from it
+            self.canvas.set_image(grid.image, dirty=None if resized else dirty)
+            if self.histogram_visible():
+                if self.camera_histogram is None:
+                    import histogram
+                    self.camera_histogram = histogram.IncrementalHistogram()
+                if self.camera_histogram.update(grid.image):
+                    self.histogram_panel.set_statistics(self.camera_histogram.statistics)
+
+        if tracer.enabled:
+            for index, thread in enumerate(grid.threads):
+                tracer.counter(f'camera.{index + 1}', fps=thread.fps, captured=thread.frames_captured,
+                               dropped=thread.dropped, latency_ms=grid.latencies[index] * 1000)
+
+    def toggle_profiling(self):
+        """Turn stage timing and the overlay on or off"""
+        if tracer.enabled:
+            tracer.disable()
+            self.profile_timer.stop()
+            self.profile_overlay.hide()
+        else:
+            tracer.enable()
+            self.profile_timer.start(250)
+            self.update_profile_overlay()
+            self.profile_overlay.show()
+
+    def update_profile_overlay(self):
+        """Show the latest stage timings and counters in the overlay"""
+        lines = tracer.summary()
+        self.profile_overlay.setText("\n".join(lines[:16]) if lines else "Profiling: no events yet")
+        self.profile_overlay.adjustSize()
+        self.profile_overlay.raise_()
+
+    def export_trace(self):
+        """Save the recorded events as a Chrome trace-event file"""
+        file_path = self.trace_path
+        if not file_path:
+            file_path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json", "Trace (*.json)")
+        if file_path:
+            try:
+                tracer.export_chrome_trace(file_path)
+            except OSError as e:
+                QMessageBox.critical(self, "Error", f"Failed to export trace: {str(e)}")
 
     def take_photo(self):
-        """Capture a photo from the camera and display it"""
-        if hasattr(self, 'current_pixmap'):
-            self.image_label.setPixmap(
-                self.current_pixmap.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        """Keep the last displayed camera frame as the image to edit"""
+        if self.last_frame is None:
+            return
+        self.set_image(self.last_frame.image)
+        self.image_path = None
+        self.last_frame = None
 
     def closeEvent(self, event):
         """Handle the close event to release the camera"""
-        if self.capture and self.capture.isOpened():
-            self.timer.stop()
-            self.capture.release()
+        self.stop_capture()
+        if self.load_thread is not None:
+            self.finish_load()
+        if self.filmstrip is not None:
+            self.filmstrip.shutdown()
+            self.prefetcher.shutdown()
+        if self.commit_executor is not None:
+            self.commit_executor.shutdown(wait=False)
+        self.canvas.shutdown()
+        self.memory.shutdown()
+        if self.export_executor is not None:
+            # A running export finishes writing its files, its temporary files are never left behind
+            self.export_executor.shutdown(wait=True)
+        if self.video_executor is not None:
+            # The partial output of a cancelled video is removed by the worker before it exits
+            self.video_cancel.set()
+            self.video_executor.shutdown(wait=True)
+        if self.trace_path:
+            self.export_trace()
         event.accept()
 
-    def resize_image(self):
-        """Resize the current image"""
-        if not self.image_label.pixmap():
+    def save_session(self):
+        """Save the image being edited, its edits and previews of the result to a session file"""
+        import session
+
+        if self.document is None:
             QMessageBox.warning(self, "Warning", "Please load an image first.")
             return
+        if self.image_path:
+            default_path = os.path.splitext(self.image_path)[0] + session.SESSION_EXTENSION
+        else:
+            default_path = os.path.join(os.getcwd(), 'photo' + session.SESSION_EXTENSION)
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Session", default_path,
+                                                   f"Sessions (*{session.SESSION_EXTENSION})")
+        if not file_path:
+            return
 
-        current_width = self.current_pixmap.width()
-        current_height = self.current_pixmap.height()
+        steps, position = self.history.recorded_steps()
+        # Rendered from the display pyramid, the full-resolution edits are not needed
+        preview = self.document.render(session.preview_size(self.document.output_size()))
+        try:
+            # Images that were not opened from a file, e.g. camera photos, are stored in the session
+            session.write_session(file_path, steps, position, self.document.output_size(), preview,
+                                  source_path=self.image_path, source=self.original_image)
+        except (OSError, ValueError, TypeError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to save session: {str(e)}")
+            return
+        self.statusBar().showMessage(f"Saved session to {file_path}", 5000)
 
-        dialog = ResizeDialog(current_width, current_height, self)
+    def open_session(self, file_path):
+        """
+        Reopen a session: its stored preview is shown at once, the source is decoded in the background
+        and the edits are then restored.
+        """
+        import session
+
+        try:
+            state = session.read_session(file_path)
+            state.check_source()
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to open session: {str(e)}")
+            return
+        if self.load_thread is not None:
+            self.finish_load()
+        if state.source is not None:
+            # A source stored in the session is memory-mapped, there is nothing to decode
+            self.set_image(state.source, steps=state.steps, position=state.position)
+            self.image_path = None
+            return
+        self.start_load(state.source_path)
+        self.pending_session = state
+        self.display_session_preview()
+
+    def display_session_preview(self):
+        """Display the stored preview of the session whose source is being decoded"""
+        pyramid = self.pending_session.pyramid
+        output_width, output_height = self.pending_session.output_size
+        self.loading_preview = pyramid.fit(*self.display_size())
+        # Zooming in shows the largest stored level until the full-resolution image is ready
+        self.display_image(self.loading_preview, (output_width, output_height), pyramid.image)
+
+    def export_image(self):
+        """Encode and write the edited image to the outputs chosen by the user, in the background"""
+        from concurrent.futures import ThreadPoolExecutor
+        from export_dialog import ExportDialog
+        import export
+
+        if self.cv_image is None:
+            QMessageBox.warning(self, "Warning", "Please load an image first.")
+            return
+        if self.export_future is not None:
+            QMessageBox.warning(self, "Warning", "An export is already running.")
+            return
+
+        if self.image_path:
+            base_path = os.path.splitext(self.image_path)[0] + '_edited'
+        else:
+            base_path = os.path.join(os.getcwd(), 'photo')
+        dialog = ExportDialog(base_path, self)
+        if not dialog.exec_():
+            return
+        targets = dialog.get_targets()
 
-        dialog.update_validators(self.image_label.width(), self.image_label.height())
+        # The snapshot is shared with the worker, later edits copy it instead of changing it
+        if self.export_executor is None:
+            self.export_executor = ThreadPoolExecutor(max_workers=1)
+        history = self.history
+        self.export_future = self.export_executor.submit(lambda: export.export_all(history.snapshot(), targets))
+        self.export_button.setEnabled(False)
+        self.export_button.setText("Exporting...")
+        self.export_timer.start()
+
+    def poll_export(self):
+        """Report the results of the export once the worker is done"""
+        import export
+
+        if not self.export_future.done():
+            return
+        self.export_timer.stop()
+        future, self.export_future = self.export_future, None
+        self.export_button.setEnabled(True)
+        self.export_button.setText("Export")
+        try:
+            results = future.result()
+        except (OSError, ValueError, MemoryError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to export image: {str(e)}")
+            return
+
+        message = "\n".join(export.format_results(results))
+        if any(result.error for result in results):
+            QMessageBox.critical(self, "Error", message)
+        else:
+            QMessageBox.information(self, "Export", message)
+
+    def process_video(self):
+        """Apply the edits of the current image to every frame of a video file, in the background"""
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+        import video
+
+        if self.video_future is not None:
+            return
+        extensions = ' '.join('*' + extension for extension in video.VIDEO_EXTENSIONS)
+        input_path, _ = QFileDialog.getOpenFileName(self, "Open Video", "", f"Videos ({extensions})")
+        if not input_path:
+            return
+        output_path, _ = QFileDialog.getSaveFileName(self, "Save Processed Video",
+                                                     os.path.splitext(input_path)[0] + '_edited.avi',
+                                                     "Videos (*.avi *.mp4)")
+        if not output_path:
+            return
+
+        # Without an image the frames are re-encoded unchanged
+        steps = self.history.steps() if self.history is not None else []
+        if self.video_executor is None:
+            self.video_executor = ThreadPoolExecutor(max_workers=1)
+        self.video_cancel = threading.Event()
+        self.video_progress = (0, None)
+
+        def progress(done, total):
+            # Read by poll_video on the GUI thread, a tuple is replaced atomically
+            self.video_progress = (done, total)
+
+        self.video_future = self.video_executor.submit(video.process_video, input_path, output_path, steps,
+                                                       progress=progress, cancel=self.video_cancel)
+        self.video_dialog = QProgressDialog(f"Processing {os.path.basename(input_path)}...", "Cancel", 0, 0, self)
+        self.video_dialog.setWindowTitle("Process Video")
+        self.video_dialog.setWindowModality(Qt.WindowModal)
+        self.video_dialog.setMinimumDuration(0)
+        self.video_button.setEnabled(False)
+        self.video_timer.start()
+
+    def poll_video(self):
+        """Show the progress of the video being processed and report the result once it is done"""
+        import video
+
+        if self.video_dialog.wasCanceled():
+            self.video_cancel.set()
+        done, total = self.video_progress
+        if total:
+            self.video_dialog.setMaximum(total)
+            self.video_dialog.setValue(min(done, total))
+        self.video_dialog.setLabelText(f"Processed {done} of {total or '?'} frames")
+        if not self.video_future.done():
+            return
+        self.video_timer.stop()
+        future, self.video_future = self.video_future, None
+        self.video_dialog.close()
+        self.video_dialog = None
+        self.video_button.setEnabled(True)
+        try:
+            result = future.result()
+        except Exception as e:
+            # e.g. a MemoryError in a frame worker, raised again by process_video
+            QMessageBox.critical(self, "Error", f"Processing the video failed: {str(e) or type(e).__name__}")
+            return
+        if result.error:
+            QMessageBox.critical(self, "Error", video.format_result(result))
+        elif not result.cancelled:
+            QMessageBox.information(self, "Process Video", video.format_result(result))
+
+    def resize_image(self):
+        """Resize the current image at full resolution"""
+        from resize_dialog import ResizeDialog
+
+        if self.cv_image is None:
+            QMessageBox.warning(self, "Warning", "Please load an image first.")
+            return
+
+        current_width, current_height = self.document.output_size()
+        dialog = ResizeDialog(current_width, current_height, self)
 
         if dialog.exec_():
             new_width, new_height = dialog.get_new_dimensions()
-            new_pixmap = self.current_pixmap.scaled(new_width, new_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.image_label.setPixmap(new_pixmap)
+            self.preview_edit(('resize', {'width': new_width, 'height': new_height, 'keep_aspect_ratio': False,
+                                          'interpolation': dialog.get_interpolation()}))
 
+    @traced('display_channel')
     def display_channel(self, channel):
         """Display the specified color channel of the image"""
+        import operations
+
         if self.cv_image is None:
             QMessageBox.warning(self, "Warning", "Please load an image first.")
             return
 
-        red_channel, green_channel, blue_channel = cv2.split(self.cv_image)
-
-        if channel == 'R':
-            channel_image = cv2.merge((red_channel,
-                                       np.zeros_like(red_channel),
-                                       np.zeros_like(red_channel)))
-        elif channel == 'G':
-            channel_image = cv2.merge((np.zeros_like(green_channel),
-                                       green_channel,
-                                       np.zeros_like(green_channel)))
-        elif channel == 'B':
-            channel_image = cv2.merge((np.zeros_like(blue_channel),
-                                       np.zeros_like(blue_channel),
-                                       blue_channel))
-        else:
+        # The channel view only changes the display, so it is computed on the proxy
+        try:
+            channel_image = operations.extract_channel(self.preview_image, channel)
+        except ValueError:
             QMessageBox.warning(self, "Warning", "Invalid channel specified.")
             return
 
-        h, w, ch = channel_image.shape
-        bytes_per_line = ch * w
-        q_image = QImage(channel_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        scaled_q_image = q_image.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.image_label.setPixmap(QPixmap.fromImage(scaled_q_image))
+        full_width, full_height = self.document.output_size()
+        renderer = self.document.region_renderer()
+        self.display_image(channel_image, (full_width, full_height),
+                           lambda scale, bounds: operations.extract_channel(renderer(scale, bounds), channel))
 
     def adjust_brightness(self):
         """Adjust the brightness of the current image"""
+        from brightness_dialog import BrightnessDialog
+
         if self.cv_image is None:
             QMessageBox.warning(self, "Warning", "Please load an image first.")
             return
 
         dialog = BrightnessDialog(self)
+        dialog.percentage_changed.connect(self.preview_brightness)
         if dialog.exec_():
             percentage = dialog.get_percentage()
             self.apply_brightness(percentage)
+        else:
+            # Restore the preview from before the dialog
+            self.display_image(self.preview_image, self.document.output_size(), self.document.region_renderer())
+            self.update_histogram()
+
+    @traced('preview_brightness')
+    def preview_brightness(self, percentage):
+        """Show a brightness adjustment on the display proxy without adding it to the history"""
+        import numpy as np
+        import operations
 
+        if self.brightness_buffer is None or self.brightness_buffer.shape != self.preview_image.shape:
+            self.brightness_buffer = np.empty_like(self.preview_image)
+        operations.adjust_brightness(self.preview_image, percentage, dst=self.brightness_buffer)
+        self.display_image(self.brightness_buffer, self.document.output_size())
+        if self.histogram_visible():
+            import histogram
+            self.histogram_panel.set_statistics(histogram.compute_statistics(self.brightness_buffer))
+
+    @traced('apply_brightness')
     def apply_brightness(self, percentage):
         """Apply the brightness adjustment to the image using OpenCV"""
         if self.original_image is None:
             QMessageBox.warning(self, "Warning", "Please load an image first.")
             return
 
-        # Calculate the brightness factor
-        factor = percentage / 100.0
-
-        # Apply brightness adjustment based on the original image
-        brightened_image = cv2.convertScaleAbs(self.original_image, alpha=factor, beta=0)
-
-        # Convert the updated image back to QPixmap
-        h, w, ch = brightened_image.shape
-        bytes_per_line = ch * w
-        q_image = QImage(brightened_image.data, w, h, bytes_per_line, QImage.Format_BGR888)
-
-        scaled_image = q_image.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.image_label.setPixmap(QPixmap.fromImage(scaled_image))
-        self.current_pixmap = QPixmap.fromImage(scaled_image)
-        self.cv_image = brightened_image
+        self.preview_edit(('brightness', {'percentage': percentage}))
 
     def draw_rectangle(self):
         """Draw a filled blue rectangle on the image"""
+        from rectangle_dialog import RectangleDialog
+
         if self.cv_image is None:
             QMessageBox.warning(self, "Warning", "Please load an image first.")
             return
 
-        original_width = self.cv_image.shape[1]
-        original_height = self.cv_image.shape[0]
-        display_width = self.image_label.width()
-        display_height = self.image_label.height()
+        # The dialog coordinates refer to the displayed proxy
+        display_height, display_width = self.preview_image.shape[:2]
 
         dialog = RectangleDialog(display_width, display_height, self)
 
         if dialog.exec_():
             x, y, width, height = dialog.get_rectangle_params()
 
-            # Calculate scaling factors
-            scale_x = original_width / display_width
-            scale_y = original_height / display_height
+            # Calculate scaling factors, earlier resizes change the full-resolution size
+            full_width, full_height = self.document.output_size()
+            scale_x = full_width / display_width
+            scale_y = full_height / display_height
 
             # Scale the rectangle coordinates and size to match the original image size
             x = int(x * scale_x)
@@ -314,16 +1156,27 @@ class MainWindow(QMainWindow):
             width = int(width * scale_x)
             height = int(height * scale_y)
 
-            # Draw filled rectangle on the cv_image using cv2
-            rect_image = self.cv_image.copy()
-            cv2.rectangle(rect_image, (x, y), (x + width, y + height), (255, 0, 0), -1)
+            self.preview_edit(('rectangle', {'x': x, 'y': y, 'width': width, 'height': height}))
 
-            # Convert the updated image back to QPixmap
-            h, w, ch = rect_image.shape
-            bytes_per_line = ch * w
-            q_image = QImage(rect_image.data, w, h, bytes_per_line, QImage.Format_BGR888)
+    def import_boxes(self):
+        """Draw the annotation boxes of a JSON or CSV file on the image"""
+        import annotations
+
+        if self.cv_image is None:
+            QMessageBox.warning(self, "Warning", "Please load an image first.")
+            return
+
+        file_path, _ = QFileDialog.getOpenFileName(self, "Import Boxes", "", "Boxes (*.json *.csv)")
+        if not file_path:
+            return
+        try:
+            boxes = annotations.load_boxes(file_path)
+        except (OSError, ValueError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to import boxes: {str(e)}")
+            return
+        if not boxes:
+            QMessageBox.warning(self, "Warning", "The file contains no boxes.")
+            return
 
-            scaled_image = q_image.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.image_label.setPixmap(QPixmap.fromImage(scaled_image))
-            self.current_pixmap = QPixmap.fromImage(scaled_image)
-            self.cv_image = rect_image
+        # All boxes are a single edit, drawn in one pass and undone together
+        self.preview_edit(('boxes', {'boxes': boxes}))
@@ -0,0 +1,219 @@
+"""
+This module keeps the memory held by image buffers under a limit.
+
+Image buffers are owned by several components: the source image, the history's materialized image
+and undo deltas, the document's pyramid and memoized renders, the canvas' detail tiles and the
+prefetched images. Each component is registered with the MemoryManager as a consumer, an object with:
+- memory_buffers(): the arrays it holds;
+- drop_caches(excess_bytes), optional: release buffers that can be computed again;
+- spill_candidates(), optional: (last used, bytes, spill function) tuples of buffers that can be moved
+  to disk. The spill function is called on the manager's worker thread with the spill directory and
+  returns whether it spilled, or a function without arguments that the manager calls on the thread of
+  enforce() to put the spilled copy in place, which returns whether it did.
+
+Arrays shared by several consumers, e.g. the source image that is also the history's base, are counted
+once. Memory-mapped arrays are on disk and are not counted.
+
+When the total is over the limit, the manager first drops derivable caches, in the order the
+consumers were registered, then spills the least recently used buffers to memory-mapped temporary
+files. Spilled buffers stay usable, their pages are read back from disk when they are accessed.
+Spilling copies large buffers, so it runs on a worker thread and enforce() never waits for it.
+"""
+import mmap
+import os
+from profiling import tracer
+
+# The fraction of physical memory the image buffers may use by default
+DEFAULT_LIMIT_FRACTION = 0.5
+FALLBACK_LIMIT_BYTES = 2 * 1024 ** 3
+# Smaller buffers are not worth a file of their own
+MIN_SPILL_BYTES = 4 * 1024 ** 2
+
+
+def physical_memory_bytes():
+    """Return the physical memory of the machine in bytes, or None if it is not known"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_limit_bytes():
+    physical = physical_memory_bytes()
+    return int(physical * DEFAULT_LIMIT_FRACTION) if physical else FALLBACK_LIMIT_BYTES
+
+
+def heap_buffer(array):
+    """
+    Return the memory behind an array.
+
+    Returns:
+        tuple: A key identifying the memory and its size in bytes, or None if the array is memory-mapped.
+    """
+    import numpy as np
+
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if isinstance(root, np.memmap) or isinstance(root.base, mmap.mmap):
+        return None
+    return id(root), root.nbytes
+
+
+def format_bytes(size):
+    """Return a size in bytes as a short human-readable string"""
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.1f} GB"
+    return f"{size / 1024 ** 2:.0f} MB"
+
+
+class CallbackConsumer:
+    """A consumer made of functions, for buffers that are not owned by a single object"""
+    def __init__(self, memory_buffers, spill_candidates=None):
+        self.memory_buffers = memory_buffers
+        if spill_candidates is not None:
+            self.spill_candidates = spill_candidates
+
+
+class MemoryManager:
+    """
+    Tracks the bytes held by the image buffers of the registered consumers and enforces a limit.
+
+    Attributes:
+        limit_bytes (int): The memory the image buffers may use.
+        spill_directory (str): The directory spilled buffers are written to, the system temporary directory if None.
+        spilled_bytes (int): The number of bytes spilled so far.
+    """
+    def __init__(self, limit_bytes=None, spill_directory=None):
+        self.limit_bytes = default_limit_bytes() if limit_bytes is None else limit_bytes
+        self.spill_directory = spill_directory
+        self.spilled_bytes = 0
+        self._consumers = []
+        self._executor = None
+        # The spills running on the worker, their results are taken by the next enforce()
+        self._spilling = None
+
+    def register(self, name, consumer):
+        """Add a consumer, or replace the one registered under the same name, keeping its position"""
+        for index, (other, _) in enumerate(self._consumers):
+            if other == name:
+                self._consumers[index] = (name, consumer)
+                return
+        self._consumers.append((name, consumer))
+
+    def unregister(self, name):
+        self._consumers = [(other, consumer) for other, consumer in self._consumers if other != name]
+
+    def usage(self):
+        """
+        Return the bytes held by each consumer.
+
+        Returns:
+            list: (name, bytes) tuples in registration order. A shared array counts for the first consumer holding it.
+        """
+        seen = set()
+        usage = []
+        for name, consumer in self._consumers:
+            total = 0
+            for array in consumer.memory_buffers():
+                buffer = None if array is None else heap_buffer(array)
+                if buffer is None or buffer[0] in seen:
+                    continue
+                seen.add(buffer[0])
+                total += buffer[1]
+            usage.append((name, total))
+        return usage
+
+    def total_bytes(self):
+        return sum(size for _, size in self.usage())
+
+    def enforce(self):
+        """
+        Drop caches until the image buffers fit in the limit, then start spilling buffers in the background.
+
+        The spills started by an earlier call that have finished are put in place first.
+
+        Returns:
+            int: The number of bytes freed by this call.
+        """
+        start = total = self.total_bytes()
+        if self._spilling is not None and self._spilling.done():
+            self._finish_spills()
+            total = self.total_bytes()
+        if total <= self.limit_bytes:
+            return start - total
+
+        for name, consumer in self._consumers:
+            drop_caches = getattr(consumer, 'drop_caches', None)
+            if drop_caches is None:
+                continue
+            with tracer.span('memory.drop', consumer=name):
+                drop_caches(total - self.limit_bytes)
+            total = self.total_bytes()
+            if total <= self.limit_bytes:
+                return start - total
+
+        if self._spilling is not None:
+            return start - total
+        candidates = []
+        for _, consumer in self._consumers:
+            spill_candidates = getattr(consumer, 'spill_candidates', None)
+            if spill_candidates is not None:
+                candidates.extend(spill_candidates())
+        # Least recently used first, until the expected total fits
+        candidates.sort(key=lambda candidate: candidate[0])
+        spills = []
+        expected = total
+        for _, size, spill in candidates:
+            if expected <= self.limit_bytes:
+                break
+            if size < MIN_SPILL_BYTES:
+                continue
+            spills.append((size, spill))
+            expected -= size
+        if spills:
+            from concurrent.futures import ThreadPoolExecutor
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-spill')
+            self._spilling = self._executor.submit(self._spill, spills, self.spill_directory)
+        return start - total
+
+    @staticmethod
+    def _spill(spills, directory):
+        # Runs on the worker, returns the (bytes, result) of every spill
+        results = []
+        for size, spill in spills:
+            with tracer.span('memory.spill') as span:
+                span.set_bytes(size)
+                try:
+                    result = spill(directory)
+                except OSError:
+                    # The spill directory is full or not writable, the next enforce() tries again
+                    break
+            results.append((size, result))
+        return results
+
+    def _finish_spills(self):
+        """Put the spilled copies made on the worker in place and count them"""
+        future, self._spilling = self._spilling, None
+        for size, result in future.result():
+            if callable(result):
+                result = result()
+            if result:
+                self.spilled_bytes += size
+
+    def shutdown(self):
+        """Stop the spill worker, a spill in progress finishes writing its copy"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def summary(self):
+        """Return a one-line description of the usage and a line per consumer"""
+        usage = self.usage()
+        total = sum(size for _, size in usage)
+        line = f"Memory: {format_bytes(total)} / {format_bytes(self.limit_bytes)}"
+        if self.spilled_bytes:
+            line += f" ({format_bytes(self.spilled_bytes)} spilled to disk)"
+        return line, [f"{name}: {format_bytes(size)}" for name, size in usage]
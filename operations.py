@@ -0,0 +1,493 @@
+"""
+This module defines the image editing operations of the Photo Editor application.
+
+The operations work on plain NumPy arrays in OpenCV's BGR channel order and do not depend on Qt,
+so they can be shared by the main window and by headless batch processing.
+
+Every operation is also registered under a short name so that a list of edits (a recipe) can be
+described as data:
+    [('brightness', {'percentage': 70}), ('rectangle', {'x': 10, 'y': 10, 'width': 100, 'height': 50})]
+
+Parameters are plain values or tuples, so recipes can be hashed; annotation boxes are a tuple of Box.
+
+Consecutive channel and brightness steps map every pixel value independently, so apply_operations
+fuses each run of them into a single pass, see fuse_pixel_steps.
+"""
+import collections
+import functools
+import mmap
+import os
+import cv2
+import numpy as np
+from profiling import tracer
+
+CHANNEL_INDICES = {'B': 0, 'G': 1, 'R': 2}
+BLUE = (255, 0, 0)
+
+
+def map_file(file_path):
+    """
+    Memory-map a file read-only and return its contents as a uint8 array.
+
+    The bytes are paged in by the OS on access instead of being copied onto the heap,
+    so the compressed data does not stay resident next to the decoded image.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File {file_path} not found.")
+
+    # Opening the file from Python keeps non-ASCII paths working on Windows, unlike cv2.imread
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.empty(0, dtype=np.uint8)
+        # The array keeps the mapping alive, the file descriptor is not needed after mapping
+        return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+
+def load_image(file_path, flags=cv2.IMREAD_COLOR):
+    """Load an image from the filesystem as a BGR array"""
+    image_data = map_file(file_path)
+    if image_data.size == 0:
+        return None
+    return cv2.imdecode(image_data, flags)
+
+
+def save_image(image, file_path, params=None):
+    """Encode an image according to the file extension and write it to the filesystem"""
+    extension = os.path.splitext(file_path)[1] or '.png'
+    ok, encoded = cv2.imencode(extension, image, params or [])
+    if not ok:
+        raise ValueError(f"Failed to encode image as {extension}.")
+    encoded.tofile(file_path)
+
+
+def extract_channel(image, channel):
+    """
+    Keep a single color channel of the image and zero the other two.
+
+    Args:
+        image (np.ndarray): The BGR image.
+        channel (str): 'R', 'G' or 'B'.
+
+    Returns:
+        np.ndarray: A new BGR image containing only the selected channel.
+    """
+    if channel not in CHANNEL_INDICES:
+        raise ValueError(f"Invalid channel {channel!r}, expected one of R, G, B.")
+
+    channel_image = np.zeros_like(image)
+    index = CHANNEL_INDICES[channel]
+    channel_image[..., index] = image[..., index]
+    return channel_image
+
+
+@functools.lru_cache(maxsize=64)
+def brightness_lut(percentage):
+    """
+    Return the 256-entry lookup table that scales brightness by percentage.
+
+    The values are computed in single precision, rounded half to even and saturated, the same way
+    cv2.convertScaleAbs does. The table is cached and read-only.
+    """
+    values = np.arange(256, dtype=np.float32) * np.float32(percentage / 100.0)
+    lut = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def adjust_brightness(image, percentage, dst=None):
+    """
+    Scale the brightness of the image with a lookup table.
+
+    Args:
+        image (np.ndarray): The BGR image.
+        percentage (int): The brightness relative to the input, 100 leaves the image unchanged
+            and values above 100 brighten it.
+        dst (np.ndarray): An optional output buffer of the same shape to reuse, may be the image itself.
+
+    Returns:
+        np.ndarray: The adjusted image, dst if it was given.
+    """
+    if dst is not None:
+        return cv2.LUT(image, brightness_lut(percentage), dst=dst)
+    return cv2.LUT(image, brightness_lut(percentage))
+
+
+@functools.lru_cache(maxsize=64)
+def fuse_pixel_steps(keys):
+    """
+    Combine a run of channel and brightness steps into one lookup table.
+
+    Brightness maps 0 to 0, so after a channel step the other channels stay black whatever follows,
+    and the whole run is one table applied either to every channel or to a single kept channel.
+
+    Args:
+        keys (tuple): ('brightness', percentage) and ('channel', 'R'|'G'|'B') tuples, in order.
+
+    Returns:
+        tuple: (channel, table), the index of the kept channel or None for every channel, and the
+            read-only 256-entry table. The result is exactly that of applying the steps one by one.
+    """
+    channel = None
+    table = np.arange(256, dtype=np.uint8)
+    for name, value in keys:
+        if name == 'brightness':
+            table = brightness_lut(value)[table]
+        elif value not in CHANNEL_INDICES:
+            raise ValueError(f"Invalid channel {value!r}, expected one of R, G, B.")
+        elif channel is None:
+            channel = CHANNEL_INDICES[value]
+        elif channel != CHANNEL_INDICES[value]:
+            # Keeping a second channel zeroes the one that was kept
+            table = np.zeros(256, dtype=np.uint8)
+    table.flags.writeable = False
+    return channel, table
+
+
+def apply_pixel_steps(image, steps, dst=None):
+    """
+    Apply a run of channel and brightness steps in a single pass over the image.
+
+    Args:
+        image (np.ndarray): The BGR image.
+        steps (list): The (name, params) steps, all in PIXEL_OPERATIONS.
+        dst (np.ndarray): An optional output buffer of the same shape to reuse, may be the image itself.
+
+    Returns:
+        np.ndarray: The edited image, dst if it was given.
+    """
+    if image.ndim != 3 or image.shape[2] != 3 or image.dtype != np.uint8:
+        for name, params in steps:
+            image = apply_operation(image, name, params)
+        return image
+    channel, table = fuse_pixel_steps(tuple(
+        (name, params['channel'] if name == 'channel' else params['percentage']) for name, params in steps))
+    if channel is None:
+        return cv2.LUT(image, table, dst=dst) if dst is not None else cv2.LUT(image, table)
+    # Only the kept channel is read and mapped, the others are cleared
+    plane = cv2.extractChannel(image, channel)
+    cv2.LUT(plane, table, dst=plane)
+    if dst is None:
+        dst = np.zeros_like(image)
+    else:
+        dst[...] = 0
+    cv2.insertChannel(plane, dst, channel)
+    return dst
+
+
+def draw_rectangle(image, x, y, width, height, color=BLUE):
+    """
+    Draw a filled rectangle on the image in place.
+
+    Args:
+        image (np.ndarray): The BGR image, modified in place.
+        x (int): The x-coordinate of the top-left corner in image pixels.
+        y (int): The y-coordinate of the top-left corner in image pixels.
+        width (int): The width of the rectangle.
+        height (int): The height of the rectangle.
+        color (tuple): The BGR fill color.
+
+    Returns:
+        np.ndarray: The same image, for chaining.
+    """
+    cv2.rectangle(image, (x, y), (x + width, y + height), color, -1)
+    return image
+
+
+# An annotation box: pixels x <= px < x + width and y <= py < y + height, a BGR color, filled or outlined
+# with the given thickness inside the box, and an optional label drawn above its top-left corner
+Box = collections.namedtuple('Box', ['x', 'y', 'width', 'height', 'color', 'fill', 'thickness', 'label'],
+                             defaults=(BLUE, False, 2, None))
+
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_FONT_SCALE = 0.5
+
+
+@functools.lru_cache(maxsize=1024)
+def _text_size(text, font_scale):
+    # Detector labels repeat a lot, measuring each distinct one once is enough
+    return cv2.getTextSize(text, LABEL_FONT, font_scale, 1)
+
+
+def _label_layout(box, text_scale):
+    """Return the (x0, y0, x1, y1) background rectangle of a box label and the origin of its text"""
+    (text_width, text_height), baseline = _text_size(box.label, LABEL_FONT_SCALE * text_scale)
+    height = text_height + baseline + 2
+    # Labels go above the box, or inside it when there is no room above
+    top = box.y - height if box.y >= height else box.y
+    return (box.x, top, box.x + text_width + 2, top + height), (box.x + 1, top + text_height + 1)
+
+
+def _box_rectangles(boxes, left, top):
+    """
+    Return the rectangles to fill for boxes, in drawing order, and the index of the box of each one.
+
+    A filled box is one rectangle and an outline is four: its top, bottom, left and right bands.
+    Rectangles are (x0, y0, x1, y1) rows relative to the (left, top) origin, not yet clipped.
+    """
+    values = np.array([(box.x, box.y, box.width, box.height, box.thickness, box.fill) for box in boxes],
+                      dtype=np.int64).reshape(-1, 6)
+    x0, y0 = values[:, 0] - left, values[:, 1] - top
+    x1, y1 = x0 + values[:, 2], y0 + values[:, 3]
+    thickness = np.maximum(1, np.minimum(values[:, 4], np.minimum(values[:, 2], values[:, 3])))
+    filled = values[:, 5].astype(bool)
+    rectangles = np.stack([
+        np.stack([x0, y0, x1, np.where(filled, y1, y0 + thickness)], axis=1),
+        np.stack([x0, y1 - thickness, x1, y1], axis=1),
+        np.stack([x0, y0 + thickness, x0 + thickness, y1 - thickness], axis=1),
+        np.stack([x1 - thickness, y0 + thickness, x1, y1 - thickness], axis=1),
+    ], axis=1)
+    used = np.ones((len(boxes), 4), dtype=bool)
+    used[filled, 1:] = False
+    indices = np.broadcast_to(np.arange(len(boxes))[:, np.newaxis], used.shape)
+    return rectangles[used], indices[used]
+
+
+def _color_row(rows, color, width):
+    """Return a row of width pixels of a color, tiled once per color"""
+    row = rows.get(color)
+    if row is None:
+        row = rows[color] = np.tile(np.array(color, dtype=np.uint8), width)
+    return row
+
+
+def draw_boxes(image, boxes, origin=(0, 0), text_scale=1.0):
+    """
+    Draw annotation boxes on the image in place, in a single pass.
+
+    The rectangles of all boxes are computed and clipped at once with NumPy. Each one is then filled
+    through a height x (width * 3) byte view of the image from a pre-tiled row of its color, which is
+    tens of times faster than assigning a color tuple that NumPy broadcasts three bytes at a time.
+    Labels are drawn after all boxes, so no box covers another box's label.
+
+    Args:
+        image (np.ndarray): The BGR image, modified in place. Its pixels must be contiguous within rows.
+        boxes (tuple): The Box annotations in image pixels.
+        origin (tuple): The (x, y) image position of the array's top-left pixel, for drawing on a tile.
+        text_scale (float): The scale of the label text, for drawing on a scaled proxy.
+
+    Returns:
+        np.ndarray: The same image, for chaining.
+    """
+    if not boxes:
+        return image
+    if image.strides[1:] != (3, 1):
+        raise ValueError("Boxes can only be drawn on BGR images with contiguous rows.")
+    height, width = image.shape[:2]
+    pixels = np.lib.stride_tricks.as_strided(image, (height, width * 3), (image.strides[0], 1))
+    left, top = origin
+    rows = {}
+
+    rectangles, indices = _box_rectangles(boxes, left, top)
+    np.clip(rectangles[:, 0::2], 0, width, out=rectangles[:, 0::2])
+    np.clip(rectangles[:, 1::2], 0, height, out=rectangles[:, 1::2])
+    visible = (rectangles[:, 0] < rectangles[:, 2]) & (rectangles[:, 1] < rectangles[:, 3])
+    for (x0, y0, x1, y1), index in zip(rectangles[visible].tolist(), indices[visible].tolist()):
+        pixels[y0:y1, 3 * x0:3 * x1] = _color_row(rows, boxes[index].color, width)[:3 * (x1 - x0)]
+
+    for box in boxes:
+        if not box.label:
+            continue
+        (x0, y0, x1, y1), (text_x, text_y) = _label_layout(box, text_scale)
+        x0, y0 = max(x0 - left, 0), max(y0 - top, 0)
+        x1, y1 = min(x1 - left, width), min(y1 - top, height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        pixels[y0:y1, 3 * x0:3 * x1] = _color_row(rows, box.color, width)[:3 * (x1 - x0)]
+        # Dark text on light colors and light text on dark ones
+        blue, green, red = box.color
+        text_color = (0, 0, 0) if 0.114 * blue + 0.587 * green + 0.299 * red > 128 else (255, 255, 255)
+        cv2.putText(image, box.label, (text_x - left, text_y - top), LABEL_FONT, LABEL_FONT_SCALE * text_scale,
+                    text_color, 1, cv2.LINE_AA)
+    return image
+
+
+def boxes_bounds(boxes, shape, text_scale=1.0):
+    """Return the (y0, y1, x0, x1) region that draw_boxes changes, clipped to the image"""
+    if not boxes:
+        return 0, 0, 0, 0
+    x0 = min(box.x for box in boxes)
+    y0 = min(box.y for box in boxes)
+    x1 = max(box.x + box.width for box in boxes)
+    y1 = max(box.y + box.height for box in boxes)
+    for box in boxes:
+        if box.label:
+            (label_x0, label_y0, label_x1, label_y1), _ = _label_layout(box, text_scale)
+            x0, y0, x1, y1 = min(x0, label_x0), min(y0, label_y0), max(x1, label_x1), max(y1, label_y1)
+    height, width = shape[:2]
+    return min(max(y0, 0), height), min(max(y1, 0), height), min(max(x0, 0), width), min(max(x1, 0), width)
+
+
+def fit_size(width, height, max_width, max_height):
+    """Return the largest (width, height) with the same aspect ratio that fits inside max_width x max_height"""
+    scale = min(max_width / width, max_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+INTERPOLATIONS = {
+    'nearest': cv2.INTER_NEAREST,
+    'area': cv2.INTER_AREA,
+    'linear': cv2.INTER_LINEAR,
+    'cubic': cv2.INTER_CUBIC,
+    'lanczos': cv2.INTER_LANCZOS4,
+}
+
+
+def resize_dimensions(width, height, target_width, target_height, keep_aspect_ratio=True):
+    """Return the (width, height) an image of width x height is resized to"""
+    if keep_aspect_ratio:
+        return fit_size(width, height, target_width, target_height)
+    return max(1, target_width), max(1, target_height)
+
+
+def resolve_interpolation(interpolation, source_size, target_size):
+    """Return the interpolation name to use, 'auto' is area for shrinking and cubic for enlarging"""
+    if interpolation == 'auto':
+        return 'area' if target_size[0] * target_size[1] < source_size[0] * source_size[1] else 'cubic'
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation {interpolation!r}.")
+    return interpolation
+
+
+def resize_image(image, width, height, keep_aspect_ratio=True, interpolation='auto'):
+    """
+    Resize the image to the given dimensions.
+
+    When keep_aspect_ratio is set, the image is scaled to the largest size that fits inside
+    width x height, the same way Qt.KeepAspectRatio does in the main window.
+
+    Args:
+        image (np.ndarray): The image.
+        width (int): The target width.
+        height (int): The target height.
+        keep_aspect_ratio (bool): Whether to fit the image inside width x height.
+        interpolation (str): One of INTERPOLATIONS or 'auto'. Except for nearest neighbour, reductions by
+            more than 2x first halve the image repeatedly with area averaging. This keeps linear, cubic and
+            Lanczos from skipping input pixels and aliasing, and is faster than one large area reduction.
+    """
+    source_size = (image.shape[1], image.shape[0])
+    width, height = resize_dimensions(source_size[0], source_size[1], width, height, keep_aspect_ratio)
+    interpolation = resolve_interpolation(interpolation, source_size, (width, height))
+
+    if interpolation != 'nearest':
+        while image.shape[1] >= 2 * width and image.shape[0] >= 2 * height:
+            image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+    return cv2.resize(image, (width, height), interpolation=INTERPOLATIONS[interpolation])
+
+
+OPERATIONS = {
+    'channel': extract_channel,
+    'brightness': adjust_brightness,
+    'rectangle': draw_rectangle,
+    'resize': resize_image,
+    'boxes': draw_boxes,
+}
+IN_PLACE_OPERATIONS = {'rectangle', 'boxes'}
+# Operations that map each pixel value on its own, consecutive ones are applied in a single pass
+PIXEL_OPERATIONS = {'channel', 'brightness'}
+
+
+def is_identity(step):
+    """Return whether a (name, params) step leaves every pixel unchanged, e.g. brightness at 100%"""
+    name, params = step
+    if name == 'brightness':
+        return params['percentage'] == 100
+    if name == 'boxes':
+        return not params['boxes']
+    return False
+
+
+def apply_operation(image, name, params):
+    """Apply a single named operation and return the resulting image"""
+    try:
+        operation = OPERATIONS[name]
+    except KeyError:
+        raise ValueError(f"Unknown operation {name!r}.") from None
+    if not tracer.enabled:
+        return operation(image, **params)
+    with tracer.span(name, 'operation') as span:
+        result = operation(image, **params)
+        if result is not image:
+            span.set_bytes(result.nbytes)
+        return result
+
+
+def apply_operations(image, steps, copy=True):
+    """
+    Apply a list of (name, params) steps in order.
+
+    Runs of consecutive channel and brightness steps are fused into a single pass. Once the image
+    is no longer the source, the fused passes write into it instead of allocating a new image.
+
+    Args:
+        image (np.ndarray): The source image.
+        steps (list): The steps to apply.
+        copy (bool): Whether to protect the source image from in-place operations.
+
+    Returns:
+        np.ndarray: The edited image.
+    """
+    # Whether the image may be modified, every step returns an image of its own
+    owned = not copy
+    index = 0
+    while index < len(steps):
+        name, params = steps[index]
+        if name not in PIXEL_OPERATIONS:
+            if name in IN_PLACE_OPERATIONS and not owned:
+                image = image.copy()
+            image = apply_operation(image, name, params)
+            owned = True
+            index += 1
+            continue
+        end = index + 1
+        while end < len(steps) and steps[end][0] in PIXEL_OPERATIONS:
+            end += 1
+        run = steps[index:end]
+        if len(run) == 1 and not owned:
+            image = apply_operation(image, name, params)
+        elif not tracer.enabled:
+            image = apply_pixel_steps(image, run, dst=image if owned else None)
+        else:
+            with tracer.span('+'.join(step[0] for step in run), 'operation') as span:
+                image = apply_pixel_steps(image, run, dst=image if owned else None)
+                span.set_bytes(image.nbytes)
+        owned = True
+        index = end
+    return image
+
+
+def parse_step(text):
+    """
+    Parse a textual step description into a (name, params) tuple.
+
+    Accepted forms:
+        channel:R
+        brightness:70
+        rectangle:X,Y,WIDTH,HEIGHT
+        resize:WIDTHxHEIGHT
+        resize:WIDTHxHEIGHT:INTERPOLATION, e.g. resize:640x480:lanczos
+        boxes:FILE, where FILE is a JSON or CSV box file, see annotations.load_boxes
+    """
+    name, _, argument = text.partition(':')
+    name = name.strip().lower()
+    argument = argument.strip()
+    try:
+        if name == 'channel':
+            return name, {'channel': argument.upper()}
+        if name == 'brightness':
+            return name, {'percentage': int(argument)}
+        if name == 'rectangle':
+            x, y, width, height = (int(value) for value in argument.split(','))
+            return name, {'x': x, 'y': y, 'width': width, 'height': height}
+        if name == 'resize':
+            size, _, interpolation = argument.lower().partition(':')
+            width, height = (int(value) for value in size.split('x'))
+            if interpolation and interpolation not in INTERPOLATIONS:
+                raise ValueError()
+            return name, {'width': width, 'height': height, 'interpolation': interpolation or 'auto'}
+    except ValueError:
+        raise ValueError(f"Invalid arguments for {name}: {argument!r}.") from None
+    if name == 'boxes':
+        # Imported here, the annotations module depends on this one for Box
+        import annotations
+        return name, {'boxes': annotations.load_boxes(argument)}
+    raise ValueError(f"Unknown operation {name!r}.")
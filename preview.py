@@ -0,0 +1,146 @@
+"""
+This module defines the preview pyramid used to display large images.
+
+Scaling a 24-50 MP image down to the window on every edit takes hundreds of milliseconds.
+The pyramid keeps progressively halved copies of the image, so a display-sized proxy is computed
+from the smallest level that still has enough pixels, and edits can be previewed on the proxy
+while the full-resolution result is computed only when it is needed.
+"""
+import collections
+import cv2
+import numpy as np
+from operations import fit_size
+import tiled
+
+
+class PreviewPyramid:
+    """
+    Halved copies of an image and a cache of display-sized proxies.
+
+    Levels are built lazily, only as deep as the requested display sizes need. When the image is
+    memory-mapped, the first level needed is reduced from it directly, strip by strip, so the
+    intermediate levels of a gigapixel image are never held in memory.
+
+    Attributes:
+        levels (list): The image at full resolution followed by its halved copies.
+        min_size (int): The smallest side length a level is allowed to have.
+        cache_size (int): The number of display-sized proxies kept.
+    """
+    def __init__(self, image, min_size=256, cache_size=4):
+        self.levels = [image]
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self._proxies = collections.OrderedDict()
+
+    @property
+    def image(self):
+        """The full-resolution image"""
+        return self.levels[0]
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    def level_for(self, width, height):
+        """Return the smallest level that is at least width x height, building levels as needed"""
+        h, w = self.levels[0].shape[:2]
+        index = 0
+        # The next level must still cover the target and stay above the minimum size
+        while w // 2 >= width and h // 2 >= height and min(w, h) // 2 >= self.min_size:
+            w, h = w // 2, h // 2
+            index += 1
+
+        if index >= len(self.levels):
+            self.levels.extend([None] * (index + 1 - len(self.levels)))
+        if self.levels[index] is None:
+            # Start from the deepest level already built
+            start = max(i for i in range(index) if self.levels[i] is not None)
+            level = self.levels[start]
+            if start == 0 and index > 0 and isinstance(level, np.memmap):
+                start = index
+                level = tiled.reduce(level, 2 ** index)
+                self.levels[index] = level
+            for i in range(start + 1, index + 1):
+                level = cv2.pyrDown(level, dstsize=(level.shape[1] // 2, level.shape[0] // 2))
+                self.levels[i] = level
+        return self.levels[index]
+
+    def fit(self, max_width, max_height):
+        """
+        Return a proxy of the image that fits inside max_width x max_height, keeping the aspect ratio.
+
+        The returned array is cached and shared, callers must copy it before modifying it.
+        """
+        size = fit_size(self.width, self.height, max_width, max_height)
+        proxy = self._proxies.get(size)
+        if proxy is not None:
+            self._proxies.move_to_end(size)
+            return proxy
+
+        level = self.level_for(*size)
+        if (level.shape[1], level.shape[0]) == size:
+            proxy = level
+        else:
+            interpolation = cv2.INTER_AREA if level.shape[1] > size[0] else cv2.INTER_LINEAR
+            proxy = cv2.resize(level, size, interpolation=interpolation)
+
+        self._proxies[size] = proxy
+        if len(self._proxies) > self.cache_size:
+            self._proxies.popitem(last=False)
+        return proxy
+
+    def memory_buffers(self):
+        """Return the arrays the pyramid holds, for the memory manager"""
+        return [level for level in self.levels if level is not None] + list(self._proxies.values())
+
+    def drop_caches(self):
+        """Drop the proxies and the reduced levels, they are rebuilt from the full-resolution image when needed"""
+        del self.levels[1:]
+        self._proxies.clear()
+
+    def replace_image(self, image):
+        """Replace the full-resolution image with an identical copy, e.g. one spilled to disk"""
+        previous = self.levels[0]
+        self.levels[0] = image
+        # A proxy at full resolution is the previous image itself
+        for size, proxy in list(self._proxies.items()):
+            if proxy is previous:
+                del self._proxies[size]
+
+
+def scale_step(step, scale_x, scale_y):
+    """
+    Convert a (name, params) step given in full-resolution pixels to a proxy of another size.
+
+    Args:
+        step (tuple): The step in full-resolution coordinates.
+        scale_x (float): The proxy width divided by the full-resolution width.
+        scale_y (float): The proxy height divided by the full-resolution height.
+
+    Returns:
+        tuple: The step in proxy coordinates.
+    """
+    name, params = step
+    if name == 'rectangle':
+        x0 = int(round(params['x'] * scale_x))
+        y0 = int(round(params['y'] * scale_y))
+        x1 = int(round((params['x'] + params['width']) * scale_x))
+        y1 = int(round((params['y'] + params['height']) * scale_y))
+        params = dict(params, x=x0, y=y0, width=x1 - x0, height=y1 - y0)
+    elif name == 'boxes':
+        boxes = []
+        for box in params['boxes']:
+            x0, y0 = int(round(box.x * scale_x)), int(round(box.y * scale_y))
+            x1 = int(round((box.x + box.width) * scale_x))
+            y1 = int(round((box.y + box.height) * scale_y))
+            thickness = max(1, int(round(box.thickness * min(scale_x, scale_y))))
+            boxes.append(box._replace(x=x0, y=y0, width=max(1, x1 - x0), height=max(1, y1 - y0), thickness=thickness))
+        params = dict(params, boxes=tuple(boxes), text_scale=params.get('text_scale', 1.0) * scale_y)
+    elif name == 'resize':
+        params = dict(params, width=max(1, round(params['width'] * scale_x)),
+                      height=max(1, round(params['height'] * scale_y)))
+    return name, params
@@ -0,0 +1,204 @@
+"""
+This module defines the opt-in profiling and tracing of the Photo Editor application.
+
+Code marks its stages with the traced decorator or the span context manager, and reports values
+such as camera FPS with counter. While tracing is disabled, which is the default, a traced call
+costs one attribute check and span returns a shared no-op context manager.
+
+When enabled, the tracer records:
+- a timed event for every stage, with the thread it ran on and optional arguments such as the
+  number of bytes the stage allocated;
+- per-stage statistics (count, total, last and maximum duration) for the on-screen overlay;
+- counter samples.
+
+The events can be exported in the Chrome trace-event format and opened in chrome://tracing or Perfetto.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+MAX_EVENTS = 200000
+
+
+class StageStats:
+    """
+    Timing statistics of one stage.
+
+    Attributes:
+        count (int): The number of times the stage ran.
+        total (float): The total duration in seconds.
+        last (float): The duration of the last run in seconds.
+        maximum (float): The longest duration in seconds.
+        bytes (int): The bytes allocated by the last run, if reported.
+    """
+    __slots__ = ('count', 'total', 'last', 'maximum', 'bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.maximum = 0.0
+        self.bytes = None
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class _Span:
+    """A running stage, use Tracer.span to create one"""
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+    def set_bytes(self, nbytes):
+        """Report the number of bytes the stage allocated"""
+        self.args['bytes'] = int(nbytes)
+
+
+class _NullSpan:
+    """The span returned while tracing is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_bytes(self, nbytes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Collects stage timings and counters while enabled.
+
+    Attributes:
+        enabled (bool): Whether events are recorded.
+        stats (dict): The StageStats of every stage name.
+        counters (dict): The last value of every counter.
+    """
+    def __init__(self, max_events=MAX_EVENTS):
+        self.enabled = False
+        self.stats = {}
+        self.counters = {}
+        self._events = collections.deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+            self.counters.clear()
+            self._events.clear()
+            self._origin = time.perf_counter()
+
+    def span(self, name, category='stage', **args):
+        """Return a context manager that times the enclosed code as the stage name"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def record(self, name, category, start, duration, args=None):
+        """Record a stage that started at the time.perf_counter() value start"""
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StageStats()
+            stats.count += 1
+            stats.total += duration
+            stats.last = duration
+            stats.maximum = max(stats.maximum, duration)
+            if args and 'bytes' in args:
+                stats.bytes = args['bytes']
+            self._events.append(('X', name, category, start, duration, threading.get_ident(), args or None))
+
+    def counter(self, name, **values):
+        """Record a sample of one or more counter values, e.g. counter('camera', fps=29.8, dropped=3)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters.update((f"{name}.{key}", value) for key, value in values.items())
+            self._events.append(('C', name, 'counter', time.perf_counter(), 0.0, threading.get_ident(), values))
+
+    def chrome_trace(self):
+        """Return the recorded events as a Chrome trace-event dictionary"""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            origin = self._origin
+        trace_events = []
+        for phase, name, category, start, duration, thread, args in events:
+            event = {'name': name, 'cat': category, 'ph': phase, 'pid': pid, 'tid': thread,
+                     'ts': (start - origin) * 1e6}
+            if phase == 'X':
+                event['dur'] = duration * 1e6
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        """Write the recorded events to a Chrome trace-event JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self):
+        """Return one line per stage with its last, mean and maximum duration, slowest mean first"""
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1].mean, reverse=True)
+            lines = []
+            for name, stats in items:
+                line = (f"{name}: {stats.last * 1000:.1f} ms (mean {stats.mean * 1000:.1f}, "
+                        f"max {stats.maximum * 1000:.1f}, n={stats.count})")
+                if stats.bytes is not None:
+                    line += f" {stats.bytes / 1024 ** 2:.1f} MB"
+                lines.append(line)
+            lines.extend(f"{name}: {value:.1f}" if isinstance(value, float) else f"{name}: {value}"
+                         for name, value in sorted(self.counters.items()))
+        return lines
+
+
+tracer = Tracer()
+
+
+def traced(name, category='stage'):
+    """Decorate a function so that every call is recorded as the stage name while tracing is enabled"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.record(name, category, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
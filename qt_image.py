@@ -0,0 +1,87 @@
+"""
+This module converts between NumPy image arrays and QImage without copying pixel data where possible.
+
+QImage can wrap external memory as long as every row is a contiguous run of pixels, whatever the
+distance between rows is. Only arrays that do not meet that (for example column slices with a step,
+negative strides or non-uint8 data) are copied before wrapping.
+
+A wrapped QImage does not own its pixels. The returned QImage keeps a reference to the array,
+so the array stays alive as long as that QImage object exists. QPixmap.fromImage and QImage.copy
+make their own copies and do not depend on the array afterwards.
+"""
+import numpy as np
+from PyQt5 import sip
+from PyQt5.QtGui import QImage, QPixmap
+
+# Formats for arrays with 1, 3 and 4 channels in OpenCV's channel order.
+# ARGB32 is stored as B, G, R, A bytes on little-endian machines, which is OpenCV's BGRA.
+_FORMATS = {
+    1: QImage.Format_Grayscale8,
+    3: QImage.Format_BGR888,
+    4: QImage.Format_ARGB32,
+}
+
+
+def _wrappable(array):
+    """Return whether QImage can use the array's memory as it is"""
+    if array.dtype != np.uint8 or array.strides[0] <= 0:
+        return False
+    if array.ndim == 2:
+        return array.strides[1] == 1
+    return array.strides[2] == 1 and array.strides[1] == array.shape[2]
+
+
+def numpy_to_qimage(array):
+    """
+    Wrap a grayscale, BGR or BGRA uint8 array in a QImage.
+
+    Args:
+        array (np.ndarray): A height x width, height x width x 1, x 3 or x 4 array. Row strides
+            other than width * channels (e.g. a crop of a larger image) are supported without copying.
+
+    Returns:
+        QImage: An image sharing the array's memory, or a copy if the layout cannot be shared.
+    """
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    if channels not in _FORMATS:
+        raise ValueError(f"Unsupported number of channels: {channels}.")
+
+    if not _wrappable(array):
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+
+    height, width = array.shape[:2]
+    # A raw pointer is used because PyQt rejects buffers whose rows are not adjacent
+    image = QImage(sip.voidptr(array.ctypes.data), width, height, array.strides[0], _FORMATS[channels])
+    # Keep the pixel memory alive for as long as this QImage object exists
+    image.ndarray = array
+    return image
+
+
+def numpy_to_qpixmap(array):
+    """Convert a grayscale, BGR or BGRA uint8 array to a QPixmap, copying the pixels only once"""
+    return QPixmap.fromImage(numpy_to_qimage(array))
+
+
+def qimage_to_numpy(image):
+    """
+    Return an array view of a QImage's pixels.
+
+    Grayscale8 images give height x width arrays, BGR888 images height x width x 3 and
+    32-bit images height x width x 4 in B, G, R, A order. These share the QImage's memory,
+    the QImage must be kept alive while the view is used. Other formats are converted to a BGR copy.
+    """
+    channels = {QImage.Format_Grayscale8: 1, QImage.Format_BGR888: 3, QImage.Format_RGB32: 4,
+                QImage.Format_ARGB32: 4, QImage.Format_ARGB32_Premultiplied: 4}.get(image.format())
+    if channels is None:
+        # The converted image is a temporary, so its pixels must be copied out
+        return np.array(qimage_to_numpy(image.convertToFormat(QImage.Format_BGR888)))
+
+    height, width = image.height(), image.width()
+    # constBits does not detach, so an image wrapping an array is not copied
+    pointer = image.constBits()
+    pointer.setsize(image.sizeInBytes())
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    strides = (image.bytesPerLine(), 1) if channels == 1 else (image.bytesPerLine(), channels, 1)
+    return np.ndarray(shape, dtype=np.uint8, buffer=pointer, strides=strides)
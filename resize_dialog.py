@@ -2,17 +2,34 @@
 This module defines a dialog for resizing an image.
 """
 from PyQt5.QtGui import QIntValidator
-from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QLineEdit, QLabel, QVBoxLayout
+from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QLineEdit, QLabel, QVBoxLayout, QComboBox
+
+MIN_DIMENSION = 1
+# The largest side JPEG and most other formats can store
+MAX_DIMENSION = 65535
+
+# The interpolation choices and the names operations.resize_image accepts for them
+INTERPOLATION_CHOICES = [
+    ("Automatic", 'auto'),
+    ("Nearest neighbour (fastest)", 'nearest'),
+    ("Area (best for shrinking)", 'area'),
+    ("Bilinear", 'linear'),
+    ("Bicubic", 'cubic'),
+    ("Lanczos (sharpest)", 'lanczos'),
+]
 
 
 class ResizeDialog(QDialog):
     """
     A dialog for resizing an image.
 
+    The dimensions are those of the full-resolution image, they are not limited by the window size.
+
     Attributes:
     current_width (int): The current width of the image.
     current_height (int): The current height of the image.
     aspect_ratio (float): The aspect ratio of the image (width / height).
+    interpolation_combo (QComboBox): The interpolation choice.
     """
     def __init__(self, current_width, current_height, parent=None):
         super().__init__(parent)
@@ -27,13 +44,14 @@ class ResizeDialog(QDialog):
         self.width_edit = QLineEdit(str(self.current_width))
         self.height_edit = QLineEdit(str(self.current_height))
 
-        min_value = 100
-        max_width = parent.image_label.width()
-        max_height = parent.image_label.height()
-        width_range = f"({min_value} - {max_width})"
-        height_range = f"({min_value} - {max_height})"
-        self.width_validator = QIntValidator(min_value, max_width, self)
-        self.height_validator = QIntValidator(min_value, max_height, self)
+        width_range = f"({MIN_DIMENSION} - {MAX_DIMENSION})"
+        height_range = f"({MIN_DIMENSION} - {MAX_DIMENSION})"
+        self.width_validator = QIntValidator(MIN_DIMENSION, MAX_DIMENSION, self)
+        self.height_validator = QIntValidator(MIN_DIMENSION, MAX_DIMENSION, self)
+
+        self.interpolation_combo = QComboBox(self)
+        for label, _ in INTERPOLATION_CHOICES:
+            self.interpolation_combo.addItem(label)
 
         self.width_edit.setValidator(self.width_validator)
         self.height_edit.setValidator(self.height_validator)
@@ -50,6 +68,8 @@ class ResizeDialog(QDialog):
         form_layout.addWidget(self.width_edit)
         form_layout.addWidget(QLabel(f"Height {height_range}:"))
         form_layout.addWidget(self.height_edit)
+        form_layout.addWidget(QLabel("Interpolation:"))
+        form_layout.addWidget(self.interpolation_combo)
 
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box.accepted.connect(self.accept)
@@ -121,7 +141,6 @@ class ResizeDialog(QDialog):
         new_height = int(self.height_edit.text())
         return new_width, new_height
 
-    def update_validators(self, max_width, max_height):
-        """Update the range of the validators for the width and height input fields"""
-        self.width_validator.setRange(100, max_width)
-        self.height_validator.setRange(100, max_height)
+    def get_interpolation(self):
+        """Return the chosen interpolation as a name accepted by operations.resize_image"""
+        return INTERPOLATION_CHOICES[self.interpolation_combo.currentIndex()][1]
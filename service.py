@@ -0,0 +1,414 @@
+"""
+This module runs the editing operations as a resident service for other programs on the same machine.
+
+Starting a process, importing OpenCV and spawning workers costs more than editing a small image, so
+the service does it once. It listens on localhost HTTP and dispatches jobs to a pool of worker
+processes that are started and warmed up, with OpenCV and the operations imported, before the first
+request is accepted. Jobs run through batch.process_file, the same operations.apply_operations the
+window applies its edits with, so the results match the window's pixel for pixel.
+
+Small jobs waiting in the queue are sent to a worker together, so the inter-process round trip is
+paid once per batch instead of once per image. At most two batches per worker are in flight; beyond
+that jobs wait in a bounded queue, and a job that finds the queue full is rejected with HTTP 503 and
+a Retry-After header instead of piling up without limit.
+
+Usage:
+    python main.py --serve --port 8765 --workers 4
+
+    curl -X POST localhost:8765/jobs -d '{"source": "in.jpg", "output": "out.png",
+                                         "operations": ["brightness:70", "resize:640x480"]}'
+    curl localhost:8765/metrics
+
+    Operations are strings in the --op syntax, see operations.parse_step, or {"name": ..., "params": ...}
+    objects as stored in the edit history. The request waits for the job and returns its outcome.
+"""
+import collections
+import importlib
+import os
+import queue
+import signal
+import threading
+import time
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUE = 256
+DEFAULT_BATCH_SIZE = 16
+# Sources up to this size are batched, larger ones are worth a round trip of their own
+SMALL_JOB_BYTES = 1024 ** 2
+# The number of recent jobs the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+JOB_TIMEOUT_SECONDS = 600
+
+
+def _init_worker():
+    import cv2
+
+    # Each process already owns a core, OpenCV's own thread pool would only oversubscribe them
+    cv2.setNumThreads(1)
+    # Imported now, so the first job does not pay for it
+    for name in ('operations', 'batch'):
+        importlib.import_module(name)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def process_jobs(jobs):
+    """
+    Process a batch of jobs in a worker process.
+
+    Args:
+        jobs (list): (source, output, steps) tuples.
+
+    Returns:
+        list: The (error, seconds) of each job, error is None on success.
+    """
+    from batch import process_file
+
+    results = []
+    for source, output, steps in jobs:
+        start = time.perf_counter()
+        _, error = process_file(source, output, steps)
+        results.append((error, time.perf_counter() - start))
+    return results
+
+
+def parse_steps(operations_list):
+    """
+    Parse the operations of a job.
+
+    Args:
+        operations_list (list): Strings in the --op syntax or {"name": ..., "params": ...} objects.
+
+    Returns:
+        list: The (name, params) steps.
+    """
+    from operations import OPERATIONS, parse_step
+
+    if not isinstance(operations_list, list):
+        raise ValueError("operations must be a list.")
+    steps = []
+    for operation in operations_list:
+        if isinstance(operation, str):
+            steps.append(parse_step(operation))
+        elif isinstance(operation, dict) and operation.get('name') in OPERATIONS:
+            steps.append((operation['name'], dict(operation.get('params', {}))))
+        else:
+            raise ValueError(f"Invalid operation {operation!r}.")
+    return steps
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is full"""
+
+
+class Job:
+    """A job waiting in the queue or running, its future receives the (error, seconds) outcome"""
+    __slots__ = ('source', 'output', 'steps', 'size', 'submitted', 'future')
+
+    def __init__(self, source, output, steps, size):
+        from concurrent.futures import Future
+
+        self.source = source
+        self.output = output
+        self.steps = steps
+        self.size = size
+        self.submitted = time.perf_counter()
+        self.future = Future()
+
+
+class ProcessingService:
+    """
+    A queue of jobs dispatched in batches to a warm pool of worker processes.
+
+    Attributes:
+        workers (int): The number of worker processes.
+        max_queue (int): The number of jobs that may wait, later jobs are rejected.
+        batch_size (int): The maximum number of small jobs sent to a worker at once.
+    """
+    def __init__(self, workers=None, max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self._queue = queue.Queue(max_queue)
+        # Batches beyond two per worker wait here, so the bounded queue is where backpressure applies
+        self._slots = threading.Semaphore(2 * self.workers)
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._counts = collections.Counter()
+        self._running = 0
+        self._executor = None
+        self._dispatcher = None
+        self._started = None
+
+    def start(self):
+        """Start the worker processes, wait until all of them are warm, then start dispatching"""
+        self._executor = self._create_executor()
+        # A task per worker makes every process start and run its initializer
+        for future in [self._executor.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+        self._started = time.perf_counter()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='service-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def _create_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def _restart_workers(self):
+        # Only the dispatcher thread replaces the executor, stop() joins it first
+        broken, self._executor = self._executor, self._create_executor()
+        broken.shutdown(wait=False)
+        with self._lock:
+            self._counts['restarts'] += 1
+
+    def stop(self):
+        """Finish the queued jobs and stop the workers"""
+        if self._dispatcher is not None:
+            self._queue.put(None)
+            self._dispatcher.join()
+            self._dispatcher = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def submit(self, source, output, steps):
+        """
+        Queue a job.
+
+        Args:
+            source (str): The image file to edit.
+            output (str): The file to write the result to, its extension selects the format.
+            steps (list): The (name, params) operations to apply.
+
+        Returns:
+            Future: Receives the (error, seconds) outcome of the job, or the error if it could not be sent to the workers.
+
+        Raises:
+            FileNotFoundError: If the source does not exist.
+            QueueFull: If the queue is full.
+        """
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"File {source} not found.")
+        job = Job(source, output, steps, os.path.getsize(source))
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._counts['rejected'] += 1
+            raise QueueFull(f"The queue is full ({self.max_queue} jobs).") from None
+        with self._lock:
+            self._counts['submitted'] += 1
+        return job.future
+
+    def _dispatch(self):
+        held = []
+        while True:
+            job = held.pop() if held else self._queue.get()
+            if job is None:
+                return
+            self._slots.acquire()
+            jobs = [job]
+            # Small jobs that queued up while the workers were busy go together
+            while job.size <= SMALL_JOB_BYTES and len(jobs) < self.batch_size:
+                try:
+                    waiting = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if waiting is None or waiting.size > SMALL_JOB_BYTES:
+                    # The stop request or a large job is handled on the next iteration, in order
+                    held.append(waiting)
+                    break
+                jobs.append(waiting)
+            self._submit_batch(jobs)
+
+    def _submit_batch(self, jobs):
+        with self._lock:
+            self._running += len(jobs)
+            self._counts['batches'] += 1
+        batch = [(job.source, job.output, job.steps) for job in jobs]
+        try:
+            future = self._executor.submit(process_jobs, batch)
+        except Exception:
+            # A worker died and broke the pool, e.g. it ran out of memory, so the batch goes to new workers
+            try:
+                self._restart_workers()
+                future = self._executor.submit(process_jobs, batch)
+            except Exception as e:
+                self._fail(jobs, e)
+                return
+        future.add_done_callback(lambda done: self._finish(jobs, done))
+
+    def _fail(self, jobs, error):
+        self._slots.release()
+        with self._lock:
+            self._running -= len(jobs)
+            self._counts['failed'] += len(jobs)
+        for job in jobs:
+            job.future.set_exception(error)
+
+    def _finish(self, jobs, batch):
+        self._slots.release()
+        try:
+            results = batch.result()
+        except Exception as e:
+            # The worker died, e.g. it ran out of memory
+            results = [(f"Worker failed: {e}", 0.0)] * len(jobs)
+        finished = time.perf_counter()
+        with self._lock:
+            self._running -= len(jobs)
+            for job, (error, _) in zip(jobs, results):
+                self._latencies.append(finished - job.submitted)
+                self._counts['failed' if error else 'completed'] += 1
+        for job, result in zip(jobs, results):
+            job.future.set_result(result)
+
+    def metrics(self):
+        """Return the queue depth, job counts and latency percentiles as a dictionary"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            counts = dict(self._counts)
+            running = self._running
+        batches = counts.get('batches', 0)
+        done = counts.get('completed', 0) + counts.get('failed', 0)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 2)
+
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queue_limit': self.max_queue,
+            'running': running,
+            'workers': self.workers,
+            'submitted': counts.get('submitted', 0),
+            'completed': counts.get('completed', 0),
+            'failed': counts.get('failed', 0),
+            'rejected': counts.get('rejected', 0),
+            'worker_restarts': counts.get('restarts', 0),
+            'batches': batches,
+            'mean_batch_size': round(done / batches, 2) if batches else None,
+            'latency_ms': {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99)},
+            'uptime_seconds': round(time.perf_counter() - self._started, 1) if self._started else 0.0,
+        }
+
+
+def make_handler(service):
+    """
+    Return the HTTP request handler class of a service:
+    - POST /jobs with {"source", "output", "operations"} runs a job and returns its outcome;
+    - GET /metrics returns ProcessingService.metrics;
+    - GET /health returns 200 once the workers are warm.
+    """
+    # Imported here, so registering the command line options does not slow down the window's startup
+    import json
+    from concurrent.futures import TimeoutError
+    from http.server import BaseHTTPRequestHandler
+
+    class ServiceRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body, headers=()):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, service.metrics())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f"Unknown path {self.path}."})
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self.send_json(404, {'error': f"Unknown path {self.path}."})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                source, output = request['source'], request['output']
+                steps = parse_steps(request.get('operations', []))
+                future = service.submit(source, output, steps)
+            except QueueFull as e:
+                self.send_json(503, {'error': str(e)}, [('Retry-After', '1')])
+                return
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                message = f"Missing field {e}." if isinstance(e, KeyError) else str(e)
+                self.send_json(400, {'error': message})
+                return
+
+            submitted = time.perf_counter()
+            try:
+                error, seconds = future.result(JOB_TIMEOUT_SECONDS)
+            except TimeoutError:
+                self.send_json(504, {'error': "The job did not finish in time."})
+                return
+            except Exception as e:
+                # The job could not be sent to the workers
+                self.send_json(500, {'error': f"Worker failed: {e}"})
+                return
+            body = {'source': source, 'output': output, 'error': error,
+                    'processing_ms': round(seconds * 1000, 2),
+                    'latency_ms': round((time.perf_counter() - submitted) * 1000, 2)}
+            self.send_json(422 if error else 200, body)
+
+        def log_message(self, format, *args):
+            # Every request would be logged to stderr, the metrics are the record instead
+            pass
+
+    return ServiceRequestHandler
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT):
+    """Start the service and answer requests until interrupted"""
+    from http.server import ThreadingHTTPServer
+
+    class ServiceServer(ThreadingHTTPServer):
+        # Clients beyond the listen backlog would be refused before the queue could answer them
+        request_queue_size = 128
+        daemon_threads = True
+
+    # Bound first, so a port in use is reported before the workers are started
+    server = ServiceServer((host, port), make_handler(service))
+    try:
+        service.start()
+        # Service managers stop the service with SIGTERM, it finishes the queued jobs like on Ctrl+C
+        signal.signal(signal.SIGTERM, _interrupt)
+        print(f"Serving on http://{host}:{server.server_address[1]} with {service.workers} warm workers")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+def add_arguments(parser):
+    """Register the service command line options on an argparse parser, --workers is shared with --batch"""
+    parser.add_argument('--serve', action='store_true',
+                        help="run the processing service on localhost instead of opening the window")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"service port (default: {DEFAULT_PORT})")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE, metavar='JOBS',
+                        help=f"jobs that may wait before new ones are rejected (default: {DEFAULT_MAX_QUEUE})")
+
+
+def run_from_arguments(args):
+    """Run the service described by parsed command line arguments and return the exit code"""
+    try:
+        serve(ProcessingService(args.workers, args.max_queue), port=args.port)
+    except OSError as e:
+        print(f"error: {e}")
+        return 1
+    return 0
@@ -0,0 +1,311 @@
+"""
+This module saves and reopens editing sessions: the source image, its edits and previews of the result.
+
+A session file is a small container:
+- an 8-byte magic and the length of a JSON header, followed by the header. The header holds the
+  source reference (path, size and modification time), every recorded edit with the undo position
+  and the layout of the arrays;
+- the arrays, uncompressed and aligned to ALIGNMENT bytes, so they are memory-mapped instead of read:
+  the levels of a preview pyramid of the edited image, and the source pixels when the image was not
+  opened from a file, e.g. a camera photo.
+
+Reopening a session maps the preview levels and displays the edited image at once, without decoding
+the source or applying the edits. The source is then decoded in the background and the edits are
+applied at full resolution when they are needed.
+"""
+import inspect
+import json
+import math
+import numbers
+import os
+import struct
+import numpy as np
+import operations
+from operations import Box
+from preview import PreviewPyramid
+
+SESSION_EXTENSION = '.session'
+MAGIC = b'PESESSN1'
+VERSION = 1
+# Arrays start on page boundaries, so they are mapped without copying
+ALIGNMENT = 4096
+# The size the largest preview level is fitted into, the smaller levels are halved down to the pyramid minimum
+PREVIEW_SIZE = (2048, 2048)
+
+_PREFIX = struct.Struct('<8sQ')
+
+
+class Session:
+    """
+    An editing session read from a file.
+
+    Attributes:
+        path (str): The session file.
+        source_path (str): The source image file, None if the source is stored in the session.
+        source (np.ndarray): The source stored in the session as a read-only memory map, or None.
+        steps (list): Every recorded (name, params) step, including the undone ones.
+        position (int): The number of steps applied, the others can be redone.
+        output_size (tuple): The (width, height) of the edited image at full resolution.
+        pyramid (PreviewPyramid): The memory-mapped preview levels of the edited image.
+    """
+    def __init__(self, path, source_path, source, steps, position, output_size, pyramid, source_stat=None):
+        self.path = path
+        self.source_path = source_path
+        self.source = source
+        self.steps = steps
+        self.position = position
+        self.output_size = output_size
+        self.pyramid = pyramid
+        # The size and modification time of the source file when the session was saved
+        self._source_stat = source_stat
+
+    def check_source(self):
+        """Raise ValueError if the source image file is missing or was modified after the session was saved"""
+        if self.source_path is None:
+            return
+        try:
+            stat = os.stat(self.source_path)
+        except OSError:
+            raise ValueError(f"The source image {self.source_path} is missing.") from None
+        if [stat.st_size, stat.st_mtime_ns] != self._source_stat:
+            raise ValueError(f"The source image {self.source_path} was modified after the session was saved.")
+
+
+def preview_size(output_size):
+    """Return the size to render the preview of an edited image at, PREVIEW_SIZE or smaller, never enlarged"""
+    return min(output_size[0], PREVIEW_SIZE[0]), min(output_size[1], PREVIEW_SIZE[1])
+
+
+def _encode_params(params):
+    encoded = {}
+    for name, value in params.items():
+        if name == 'boxes':
+            value = [list(box) for box in value]
+        encoded[name] = value
+    return encoded
+
+
+def _decode_params(params):
+    decoded = {}
+    for name, value in params.items():
+        if name == 'boxes':
+            value = tuple(Box(*fields[:4], tuple(fields[4]), *fields[5:]) for fields in value)
+        elif isinstance(value, list):
+            # Colors are tuples, so the steps can be hashed like the ones made in the window
+            value = tuple(value)
+        decoded[name] = value
+    return decoded
+
+
+def _json_value(value):
+    # NumPy integers and floats from annotation files or dialogs
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} cannot be stored in a session.")
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_session(path, steps, position, output_size, preview, source_path=None, source=None):
+    """
+    Write a session file, under a temporary name that replaces the file once it is complete.
+
+    Args:
+        path (str): The session file.
+        steps (list): Every recorded (name, params) step, including the undone ones.
+        position (int): The number of steps applied.
+        output_size (tuple): The (width, height) of the edited image at full resolution.
+        preview (np.ndarray): The edited image fitted into preview_size, its pyramid levels are stored.
+        source_path (str): The source image file, referenced by path.
+        source (np.ndarray): The source pixels, stored in the session when source_path is None.
+    """
+    pyramid = PreviewPyramid(preview)
+    # Builds every level down to the minimum size of the pyramid
+    pyramid.level_for(1, 1)
+    levels = [level for level in pyramid.levels if level is not None]
+    arrays = levels if source_path is not None else levels + [source]
+    offset = 0
+    layouts = []
+    for array in arrays:
+        layouts.append({'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str})
+        offset = _aligned(offset + array.nbytes)
+
+    if source_path is not None:
+        stat = os.stat(source_path)
+        source_header = {'path': os.path.abspath(source_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    else:
+        source_header = {'array': layouts[-1]}
+    header = {
+        'version': VERSION,
+        'steps': [{'name': name, 'params': _encode_params(params)} for name, params in steps],
+        'position': position,
+        'output_size': list(output_size),
+        'levels': layouts[:len(levels)],
+        'source': source_header,
+    }
+    encoded = json.dumps(header, separators=(',', ':'), default=_json_value).encode('utf-8')
+    data_start = _aligned(_PREFIX.size + len(encoded))
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, 'wb') as file:
+            file.write(_PREFIX.pack(MAGIC, len(encoded)))
+            file.write(encoded)
+            for array, layout in zip(arrays, layouts):
+                file.seek(data_start + layout['offset'])
+                # Strips keep the copies of memory-mapped sources small
+                rows = max(1, (64 * 1024 ** 2) // max(1, array[:1].nbytes))
+                for y0 in range(0, array.shape[0], rows):
+                    file.write(np.ascontiguousarray(array[y0:y0 + rows]).data)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def _is_int(value, minimum=0):
+    # JSON booleans are ints in Python
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+
+def _is_color(value):
+    return isinstance(value, tuple) and len(value) == 3 and all(_is_int(c) and c <= 255 for c in value)
+
+
+def _is_box(box):
+    return all(isinstance(value, int) and not isinstance(value, bool) for value in box[:4]) \
+        and _is_color(box.color) and isinstance(box.fill, bool) and _is_int(box.thickness, 1) \
+        and (box.label is None or isinstance(box.label, str))
+
+
+# The check of each parameter of the operations, on the decoded values
+_PARAM_CHECKS = {
+    'channel': lambda value: value in operations.CHANNEL_INDICES,
+    'percentage': lambda value: isinstance(value, numbers.Real) and not isinstance(value, bool) and value >= 0,
+    'x': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'y': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'width': lambda value: _is_int(value),
+    'height': lambda value: _is_int(value),
+    'color': _is_color,
+    'keep_aspect_ratio': lambda value: isinstance(value, bool),
+    'interpolation': lambda value: value == 'auto' or value in operations.INTERPOLATIONS,
+    'boxes': lambda value: isinstance(value, tuple) and all(_is_box(box) for box in value),
+    'origin': lambda value: isinstance(value, tuple) and len(value) == 2 and all(_is_int(v) for v in value),
+    'text_scale': lambda value: isinstance(value, numbers.Real) and not isinstance(value, bool) and value > 0,
+}
+
+
+def _check_step(name, params, path):
+    """Raise ValueError unless name is an operation and params are the arguments it takes, with valid values"""
+    operation = operations.OPERATIONS.get(name)
+    if operation is None:
+        raise ValueError(f"The session file {path} has an unknown operation {name!r}.")
+    # Every argument after the image, except the output buffer
+    arguments = [parameter for parameter in list(inspect.signature(operation).parameters.values())[1:]
+                 if parameter.name != 'dst']
+    required = {parameter.name for parameter in arguments if parameter.default is inspect.Parameter.empty}
+    allowed = {parameter.name for parameter in arguments}
+    if not required <= params.keys() <= allowed:
+        raise ValueError(f"The session file {path} has invalid arguments for {name}: {sorted(params)}.")
+    for argument, value in params.items():
+        # An empty rectangle is a valid edit, an empty image is not
+        if not _PARAM_CHECKS[argument](value) or (name == 'resize' and argument in ('width', 'height') and value < 1):
+            raise ValueError(f"The session file {path} has an invalid {argument} {value!r} for {name}.")
+
+
+def _check_layout(layout, path):
+    """Raise ValueError unless layout describes an array: an offset, a shape and a dtype"""
+    if not isinstance(layout, dict) or not _is_int(layout.get('offset')) \
+            or not isinstance(layout.get('shape'), list) or not isinstance(layout.get('dtype'), str):
+        raise ValueError(f"The session file {path} has an invalid array layout.")
+    if not 2 <= len(layout['shape']) <= 3 or not all(_is_int(size, 1) for size in layout['shape']):
+        raise ValueError(f"The session file {path} has an invalid array shape {layout['shape']!r}.")
+    try:
+        dtype = np.dtype(layout['dtype'])
+    except TypeError:
+        dtype = None
+    # Sessions only store 8-bit images
+    if dtype != np.uint8:
+        raise ValueError(f"The session file {path} has an invalid array type {layout['dtype']!r}.")
+
+
+def _check_header(header, path):
+    """Raise ValueError unless the header has every field read_session uses, with the right types"""
+    if not isinstance(header, dict):
+        raise ValueError(f"{path} is not a session file.")
+    if header.get('version') != VERSION:
+        raise ValueError(f"Unsupported session version {header.get('version')!r}.")
+    steps = header.get('steps')
+    if not isinstance(steps, list) or not all(
+            isinstance(step, dict) and isinstance(step.get('name'), str) and isinstance(step.get('params'), dict)
+            for step in steps):
+        raise ValueError(f"The session file {path} has invalid steps.")
+    position = header.get('position')
+    if not _is_int(position) or position > len(steps):
+        raise ValueError(f"The session file {path} has an invalid undo position {position!r}.")
+    output_size = header.get('output_size')
+    if not isinstance(output_size, list) or len(output_size) != 2 or not all(_is_int(size, 1) for size in output_size):
+        raise ValueError(f"The session file {path} has an invalid image size {output_size!r}.")
+    levels = header.get('levels')
+    if not isinstance(levels, list) or not levels:
+        raise ValueError(f"The session file {path} has no preview.")
+    for layout in levels:
+        _check_layout(layout, path)
+    source = header.get('source')
+    if isinstance(source, dict) and 'array' in source:
+        _check_layout(source['array'], path)
+    elif not isinstance(source, dict) or not isinstance(source.get('path'), str) \
+            or not _is_int(source.get('size')) or not _is_int(source.get('mtime_ns')):
+        raise ValueError(f"The session file {path} has an invalid source reference.")
+
+
+def read_session(path):
+    """
+    Read a session file, its arrays are memory-mapped and only read from disk when they are used.
+
+    Returns:
+        Session: The session.
+
+    Raises:
+        ValueError: If the file is not a session file, is malformed or is truncated.
+    """
+    with open(path, 'rb') as file:
+        prefix = file.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a session file.")
+        _, length = _PREFIX.unpack(prefix)
+        encoded = file.read(length)
+    try:
+        header = json.loads(encoded.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError(f"{path} is not a session file.") from None
+    _check_header(header, path)
+
+    data_start = _aligned(_PREFIX.size + length)
+    file_size = os.path.getsize(path)
+
+    def mapped(layout):
+        dtype = np.dtype(layout['dtype'])
+        shape = tuple(layout['shape'])
+        if data_start + layout['offset'] + dtype.itemsize * math.prod(shape) > file_size:
+            raise ValueError(f"The session file {path} is truncated.")
+        return np.memmap(path, dtype=dtype, mode='r', offset=data_start + layout['offset'], shape=shape)
+
+    levels = [mapped(layout) for layout in header['levels']]
+    pyramid = PreviewPyramid(levels[0])
+    pyramid.levels = levels
+    source_header = header['source']
+    source = mapped(source_header['array']) if 'array' in source_header else None
+    try:
+        steps = [(step['name'], _decode_params(step['params'])) for step in header['steps']]
+    except (TypeError, IndexError):
+        # Annotation boxes with missing or mistyped fields
+        raise ValueError(f"The session file {path} has invalid steps.") from None
+    # Rejected here, the steps are otherwise only applied when the preview is rendered
+    for name, params in steps:
+        _check_step(name, params, path)
+    source_stat = [source_header['size'], source_header['mtime_ns']] if 'path' in source_header else None
+    return Session(path, source_header.get('path'), source, steps, header['position'], tuple(header['output_size']),
+                   pyramid, source_stat)
@@ -0,0 +1,102 @@
+"""
+This module creates and caches the thumbnails shown by the folder browser.
+
+Thumbnails are stored as small JPEG files in an on-disk cache keyed by the path, modification time
+and size of the source file, so browsing a folder a second time only reads the cached files.
+They are created in worker processes from the fastest decode available: the EXIF thumbnail or a
+reduced JPEG decode, falling back to a full decode for other formats.
+"""
+import os
+import tempfile
+import cv2
+import numpy as np
+import loader
+import operations
+import tiled
+
+THUMBNAIL_SIZE = 128
+DEFAULT_CACHE_BYTES = 256 * 1024 ** 2
+
+
+class ThumbnailCache(tiled.TileCache):
+    """
+    On-disk cache of thumbnails stored as JPEG files.
+
+    Several processes can create thumbnails in the same cache, every file is written under a
+    temporary name and renamed when complete.
+    """
+    extension = '.jpg'
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_BYTES):
+        super().__init__(directory or os.path.join(tempfile.gettempdir(), 'photo_editor_thumbnails'), max_bytes)
+
+    def get(self, file_path):
+        """Return the cached thumbnail of a source file, or None"""
+        try:
+            path = self.path_for(file_path)
+            data = np.fromfile(path, dtype=np.uint8)
+            # Touch the file so eviction sees it as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    def store(self, file_path, thumbnail):
+        """Store the thumbnail of a source file"""
+        path = self.path_for(file_path)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        ok, encoded = cv2.imencode('.jpg', thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if ok:
+            encoded.tofile(temporary_path)
+            os.replace(temporary_path, path)
+
+
+def make_thumbnail(file_path, size=THUMBNAIL_SIZE):
+    """
+    Decode an image file at the smallest resolution that covers a size x size thumbnail.
+
+    Returns:
+        np.ndarray: The thumbnail, fitted into size x size, or None if the file cannot be decoded.
+    """
+    data = operations.map_file(file_path)
+    if data.size == 0:
+        return None
+    image = None
+    dimensions = tiled.read_image_size(data)
+    if dimensions is not None and bytes(data[:2]) == b'\xff\xd8':
+        exif_thumbnail = loader.read_exif_thumbnail(data)
+        if exif_thumbnail is not None:
+            image = cv2.imdecode(exif_thumbnail, cv2.IMREAD_COLOR)
+            if image is not None and max(image.shape[:2]) < size:
+                image = None
+        if image is None:
+            reduction = loader.preview_reduction(dimensions[0], dimensions[1], (size, size))
+            image = cv2.imdecode(data, reduction[1] if reduction else cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    width, height = operations.fit_size(image.shape[1], image.shape[0], size, size)
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def cached_thumbnail(file_path, cache_directory, size=THUMBNAIL_SIZE):
+    """
+    Return the thumbnail of a file from the cache, creating and storing it if it is missing.
+
+    This runs in the worker processes of the folder browser.
+
+    Returns:
+        tuple: The file path and its thumbnail, or None if it cannot be created.
+    """
+    cache = ThumbnailCache(cache_directory)
+    thumbnail = cache.get(file_path)
+    if thumbnail is not None:
+        return file_path, thumbnail
+    try:
+        thumbnail = make_thumbnail(file_path, size)
+        if thumbnail is not None:
+            cache.store(file_path, thumbnail)
+    except (OSError, cv2.error):
+        thumbnail = None
+    return file_path, thumbnail
@@ -0,0 +1,447 @@
+"""
+This module defines the tiled, memory-mapped backend for very large images.
+
+Gigapixel scans and stitched panoramas do not fit in memory several times over, so they are kept
+in memory-mapped raster files instead of on the heap:
+- binary PPM files and .npy arrays are mapped directly and converted strip by strip, without
+  ever holding the whole image;
+- formats OpenCV can only decode as a whole (JPEG, PNG, ...) are decoded once into an on-disk
+  tile cache keyed by path, modification time and size, so later opens skip the decode.
+
+Per-pixel operations and rectangles are then applied tile by tile, so the peak memory of an edit
+is a few tiles regardless of the image size.
+
+Note that OpenCV refuses to decode images above CV_IO_MAX_IMAGE_PIXELS (2^30 by default),
+set that environment variable before starting the application to open larger files.
+"""
+import hashlib
+import math
+import os
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import operations
+
+TILE_SIZE = 1024
+# Images above this many pixels are loaded into the tile cache instead of the heap
+TILED_THRESHOLD_PIXELS = 100 * 1000 * 1000
+TILE_LOCAL_OPERATIONS = {'channel', 'brightness', 'rectangle', 'boxes'}
+
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_image_size(data):
+    """
+    Read the (width, height) of a PNG, JPEG or binary PPM image from its header.
+
+    Args:
+        data (np.ndarray): The encoded file contents, usually a memory map.
+
+    Returns:
+        tuple: The width and height, or None if the format is not recognized.
+    """
+    header = bytes(data[:32])
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return struct.unpack('>II', header[16:24])
+    if header.startswith(b'\xff\xd8'):
+        return _read_jpeg_size(data)
+    if header[:2] in (b'P5', b'P6'):
+        width, height, _, _ = read_pnm_header(data)
+        return width, height
+    return None
+
+
+def _read_jpeg_size(data):
+    offset = 2
+    size = len(data)
+    while offset + 9 < size:
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        length = (int(data[offset + 2]) << 8) | int(data[offset + 3])
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', bytes(data[offset + 5:offset + 9]))
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def read_pnm_header(data):
+    """
+    Parse the header of a binary PGM (P5) or PPM (P6) file.
+
+    Returns:
+        tuple: The width, height, number of channels and the offset of the pixel data.
+    """
+    fields = []
+    offset = 2
+    while len(fields) < 3:
+        # Skip whitespace and comments between the header fields
+        while chr(data[offset]).isspace():
+            offset += 1
+        if data[offset] == ord('#'):
+            while data[offset] != ord('\n'):
+                offset += 1
+            continue
+        start = offset
+        while not chr(data[offset]).isspace():
+            offset += 1
+        fields.append(int(bytes(data[start:offset])))
+    width, height, max_value = fields
+    if max_value > 255:
+        raise ValueError("Only 8-bit PPM and PGM files are supported.")
+    channels = 3 if bytes(data[:2]) == b'P6' else 1
+    # A single whitespace character separates the header from the pixel data
+    return width, height, channels, offset + 1
+
+
+class TileCache:
+    """
+    On-disk cache of decoded images stored as memory-mappable .npy rasters.
+
+    Attributes:
+        directory (str): The directory the rasters are stored in.
+        max_bytes (int): The cache size above which the least recently used rasters are removed.
+    """
+    extension = '.npy'
+
+    def __init__(self, directory=None, max_bytes=20 * 1024 ** 3):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'photo_editor_tiles')
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, file_path):
+        """Return the cache file of a source file, keyed by its path, modification time and size"""
+        stat = os.stat(file_path)
+        key = f"{os.path.abspath(file_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + self.extension)
+
+    def get(self, file_path):
+        """Return the cached raster of a source file as a read-only memory map, or None"""
+        path = self.path_for(file_path)
+        if not os.path.exists(path):
+            return None
+        # Touch the file so eviction sees it as recently used
+        os.utime(path)
+        return np.load(path, mmap_mode='r')
+
+    def store(self, file_path, shape, fill):
+        """
+        Create the raster of a source file.
+
+        Args:
+            file_path (str): The source file.
+            shape (tuple): The shape of the raster.
+            fill (callable): Called with the writable raster to fill it, returns False on failure.
+
+        Returns:
+            np.memmap: The stored raster as a read-only memory map, or None if fill failed.
+        """
+        path = self.path_for(file_path)
+        # A unique name, so threads converting the same file never write into each other's raster
+        handle, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(handle)
+        try:
+            raster = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.uint8, shape=shape)
+            try:
+                ok = fill(raster) is not False
+                raster.flush()
+            finally:
+                # The mapping must be closed before the file can be renamed or removed on Windows
+                del raster
+            if ok:
+                # Rename last, so an interrupted conversion never leaves a truncated raster behind
+                os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        if not ok:
+            return None
+        self.evict()
+        return np.load(path, mmap_mode='r')
+
+    def evict(self):
+        """Remove the least recently used rasters until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.extension):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                # Still mapped by another process on Windows, try again next time
+                pass
+
+
+def create_scratch(shape, directory=None):
+    """Create an anonymous, file-backed writable raster that is deleted when it is no longer used"""
+    return np.memmap(tempfile.TemporaryFile(prefix='photo_editor_', dir=directory), dtype=np.uint8, mode='w+',
+                     shape=shape)
+
+
+def spill(image, directory=None, strip_bytes=64 * 1024 ** 2):
+    """
+    Copy an image to a scratch raster, so its memory can be freed and its pixels paged in from disk.
+
+    Args:
+        image (np.ndarray): The uint8 image.
+        directory (str): The directory of the scratch file, the system temporary directory by default.
+        strip_bytes (int): The size of the strips the image is copied in, which bounds the dirty pages.
+
+    Returns:
+        np.memmap: The writable copy.
+    """
+    out = create_scratch(image.shape, directory)
+    rows = max(1, strip_bytes // max(1, image[:1].nbytes))
+    for y0 in range(0, image.shape[0], rows):
+        out[y0:y0 + rows] = image[y0:y0 + rows]
+    return out
+
+
+def iter_tiles(height, width, tile_size=TILE_SIZE):
+    """Yield the (y0, y1, x0, x1) bounds of the tiles covering a height x width image, row by row"""
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width)
+
+
+def open_image(file_path, cache=None, threshold=TILED_THRESHOLD_PIXELS, progress=None):
+    """
+    Load an image, keeping it memory-mapped if it is large.
+
+    Images with fewer than threshold pixels are decoded onto the heap as usual.
+    Larger ones are returned as read-only memory maps of a tile cache raster.
+
+    Args:
+        progress (callable): Called with the fraction converted so far while a PNM image is converted
+            strip by strip. It may raise to abort the conversion.
+
+    Returns:
+        np.ndarray: The BGR image, an np.memmap for large images, or None if it cannot be decoded.
+    """
+    if file_path.lower().endswith('.npy'):
+        image = np.load(file_path, mmap_mode='r')
+        if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+            raise ValueError("Only height x width x 3 uint8 arrays are supported.")
+        return image
+
+    data = operations.map_file(file_path)
+    if data.size == 0:
+        return None
+    size = read_image_size(data)
+    is_pnm = bytes(data[:2]) in (b'P5', b'P6')
+    if size is None or (size[0] * size[1] < threshold and not is_pnm):
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    cache = cache or TileCache()
+    image = cache.get(file_path)
+    if image is not None:
+        return image
+
+    width, height = size
+
+    def fill(raster):
+        if is_pnm:
+            return _convert_pnm(data, raster, progress=progress)
+        return _decode(data, raster)
+    return cache.store(file_path, (height, width, 3), fill)
+
+
+def _decode(data, raster):
+    """Decode a whole image into a raster, for formats OpenCV cannot decode partially"""
+    decoded = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if decoded is None or decoded.shape != raster.shape:
+        return False
+    raster[...] = decoded
+    return True
+
+
+def _convert_pnm(data, raster, strip_rows=TILE_SIZE, progress=None):
+    """Convert RGB or grayscale PNM pixel data to a BGR raster strip by strip"""
+    width, height, channels, offset = read_pnm_header(data)
+    pixels = data[offset:offset + width * height * channels].reshape(height, width, channels)
+    code = cv2.COLOR_RGB2BGR if channels == 3 else cv2.COLOR_GRAY2BGR
+    for y0 in range(0, height, strip_rows):
+        y1 = min(y0 + strip_rows, height)
+        raster[y0:y1] = cv2.cvtColor(np.ascontiguousarray(pixels[y0:y1]), code)
+        if progress is not None:
+            progress(y1 / height)
+
+
+def apply_operations_tiled(image, steps, out=None, tile_size=TILE_SIZE):
+    """
+    Apply channel, brightness, rectangle and boxes steps tile by tile in a single pass.
+
+    Args:
+        image (np.ndarray): The source image, usually a memory map.
+        steps (list): The (name, params) steps in full-resolution coordinates.
+        out (np.ndarray): The destination, a new scratch raster by default. May be the source if it is writable.
+        tile_size (int): The side length of the tiles.
+
+    Returns:
+        np.ndarray: The destination image.
+    """
+    for name, _ in steps:
+        if name not in TILE_LOCAL_OPERATIONS:
+            raise ValueError(f"Operation {name!r} cannot be applied tile by tile.")
+    if out is None:
+        out = create_scratch(image.shape)
+
+    height, width = image.shape[:2]
+    for y0, y1, x0, x1 in iter_tiles(height, width, tile_size):
+        tile = np.ascontiguousarray(image[y0:y1, x0:x1])
+        # Consecutive channel and brightness steps are fused into one pass over the tile
+        out[y0:y1, x0:x1] = operations.apply_operations(tile, tile_steps(steps, (y0, y1, x0, x1)))
+    return out
+
+
+def tile_steps(steps, bounds):
+    """
+    Convert tile-local steps to the coordinates of a tile, dropping the rectangles outside it.
+
+    Args:
+        steps (list): The (name, params) steps in image coordinates.
+        bounds (tuple): The (y0, y1, x0, x1) region of the image the tile covers.
+
+    Returns:
+        list: The steps to apply to the tile.
+    """
+    y0, y1, x0, x1 = bounds
+    converted = []
+    for name, params in steps:
+        if name == 'rectangle':
+            # Rectangles are drawn with tile-relative coordinates, OpenCV clips the parts outside the tile
+            left, top = params['x'] - x0, params['y'] - y0
+            if left > x1 - x0 or top > y1 - y0 or left + params['width'] < 0 or top + params['height'] < 0:
+                continue
+            params = dict(params, x=left, y=top)
+        elif name == 'boxes':
+            params = dict(params, origin=(x0, y0))
+        converted.append((name, params))
+    return converted
+
+
+def reduce(image, factor, strip_rows=TILE_SIZE, out=None):
+    """
+    Downscale an image by an integer factor with area averaging, reading it strip by strip.
+
+    Strips are a multiple of factor rows high, so every output pixel averages exactly the
+    same input pixels as a whole-image cv2.resize with INTER_AREA would.
+    """
+    height, width = image.shape[:2]
+    out_width, out_height = max(1, width // factor), max(1, height // factor)
+    reduced = out if out is not None else np.empty((out_height, out_width) + image.shape[2:], dtype=image.dtype)
+    strip_rows = max(factor, strip_rows - strip_rows % factor)
+    for y0 in range(0, out_height * factor, strip_rows):
+        y1 = min(y0 + strip_rows, out_height * factor)
+        strip = np.ascontiguousarray(image[y0:y1, :out_width * factor])
+        reduced[y0 // factor:y1 // factor] = cv2.resize(strip, (out_width, (y1 - y0) // factor),
+                                                         interpolation=cv2.INTER_AREA)
+    return reduced
+
+
+def _allocate(shape):
+    """Return a new raster, memory-mapped if it is above the tiled threshold"""
+    if shape[0] * shape[1] >= TILED_THRESHOLD_PIXELS:
+        return create_scratch(shape)
+    return np.empty(shape, dtype=np.uint8)
+
+
+def resize(image, width, height, keep_aspect_ratio=True, interpolation='auto', tile_size=TILE_SIZE, workers=None):
+    """
+    Resize a memory-mapped image tile by tile on a thread pool.
+
+    The image is first reduced by the largest power of two that keeps it above the target size,
+    with area averaging, then every output tile is interpolated from the source window it covers.
+    All tiles use the same source-to-destination mapping, so there are no seams between them.
+    Nearest neighbour skips the reduction, and area interpolation uses linear interpolation for
+    the remaining factor below 2.
+
+    Args:
+        image (np.ndarray): The source image, usually a memory map.
+        width (int): The target width.
+        height (int): The target height.
+        keep_aspect_ratio (bool): Whether to fit the image inside width x height.
+        interpolation (str): One of operations.INTERPOLATIONS or 'auto'.
+        tile_size (int): The side length of the output tiles.
+        workers (int): The number of threads, the number of cores by default.
+
+    Returns:
+        np.ndarray: The resized image, a scratch memory map if it is above the tiled threshold.
+    """
+    source_size = (image.shape[1], image.shape[0])
+    width, height = operations.resize_dimensions(source_size[0], source_size[1], width, height, keep_aspect_ratio)
+    interpolation = operations.resolve_interpolation(interpolation, source_size, (width, height))
+
+    factor = 1
+    if interpolation != 'nearest':
+        while source_size[0] // (factor * 2) >= width and source_size[1] // (factor * 2) >= height:
+            factor *= 2
+    if factor > 1:
+        reduced_shape = (source_size[1] // factor, source_size[0] // factor) + image.shape[2:]
+        image = reduce(image, factor, out=_allocate(reduced_shape))
+    source_height, source_width = image.shape[:2]
+    if (source_width, source_height) == (width, height):
+        return image
+
+    out = _allocate((height, width) + image.shape[2:])
+    scale_x, scale_y = source_width / width, source_height / height
+    flags = cv2.INTER_LINEAR if interpolation == 'area' else operations.INTERPOLATIONS[interpolation]
+    # Enough source pixels around each tile for the widest kernel, Lanczos reads 4 on each side
+    margin = 5
+    # cv2.resize samples the source at destination pixel centers, except for nearest neighbour
+    center = 0.0 if interpolation == 'nearest' else 0.5
+
+    def resize_tile(tile):
+        y0, y1, x0, x1 = tile
+        top = max(0, math.floor(y0 * scale_y) - margin)
+        bottom = min(source_height, math.ceil(y1 * scale_y) + margin)
+        left = max(0, math.floor(x0 * scale_x) - margin)
+        right = min(source_width, math.ceil(x1 * scale_x) + margin)
+        window = np.ascontiguousarray(image[top:bottom, left:right])
+        # Maps destination pixels to the same source positions as cv2.resize
+        matrix = np.array([[scale_x, 0, (x0 + center) * scale_x - 0.5 - left],
+                           [0, scale_y, (y0 + center) * scale_y - 0.5 - top]])
+        out[y0:y1, x0:x1] = cv2.warpAffine(window, matrix, (x1 - x0, y1 - y0), flags=flags | cv2.WARP_INVERSE_MAP,
+                                           borderMode=cv2.BORDER_REPLICATE)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(resize_tile, iter_tiles(height, width, tile_size)):
+            pass
+    return out
+
+
+def apply_operations_large(image, steps):
+    """
+    Apply steps to a memory-mapped image without loading it into memory as a whole.
+
+    Runs of tile-local steps are applied in one tiled pass and resizes run tile by tile. Once a
+    resize brings the image below the tiled threshold, the remaining steps run in memory as usual.
+    """
+    index = 0
+    while index < len(steps) and isinstance(image, np.memmap):
+        name, params = steps[index]
+        if name == 'resize':
+            image = resize(image, **params)
+            index += 1
+        elif name in TILE_LOCAL_OPERATIONS:
+            end = index
+            while end < len(steps) and steps[end][0] in TILE_LOCAL_OPERATIONS:
+                end += 1
+            image = apply_operations_tiled(image, steps[index:end])
+            index = end
+        else:
+            break
+    return operations.apply_operations(image, steps[index:])
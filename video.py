@@ -0,0 +1,262 @@
+"""
+This module applies the editing operations to every frame of a video file.
+
+Frames stream through three stages, so a video of any length is processed in bounded memory:
+- a decoder thread reads frames ahead into a queue of READ_AHEAD_FRAMES frames;
+- a thread pool applies the operations, OpenCV releases the GIL while it works, so the frames are
+  processed on several cores without copying them into other processes;
+- a writer thread encodes the results in their original order, waiting for each frame's future in
+  turn. At most two frames per worker are in flight.
+
+The output is written under a temporary name next to the destination and renamed when it is complete,
+so a failed or cancelled run never leaves a truncated video behind.
+
+Usage:
+    python main.py --video INPUT [INPUT ...] --output DIR --op brightness:70 --op resize:1280x720
+
+    The operations use the --op syntax of --batch. The output has the extension of the input, or the
+    one given with --format, see camera.VIDEO_CODECS for the supported ones.
+
+OpenCV and the operations are imported by the functions that use them, so that main.py can register
+the video options without delaying the window.
+"""
+import collections
+import os
+import queue
+import threading
+import time
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv')
+READ_AHEAD_FRAMES = 16
+# The interval at which blocked stages check whether the run was stopped
+POLL_SECONDS = 0.1
+
+VideoResult = collections.namedtuple('VideoResult', ['path', 'frames', 'seconds', 'error', 'cancelled'])
+VideoResult.__doc__ = """
+The outcome of processing a video file.
+
+Attributes:
+    frames (int): The number of frames written.
+    seconds (float): The time spent decoding, processing and encoding.
+    error (str): The error message if processing failed, otherwise None.
+    cancelled (bool): Whether processing was cancelled, the output is then not written.
+"""
+
+
+def _put(items, item, stop):
+    """Put an item into a bounded queue unless stop is set first, return whether it was put"""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(items, stop):
+    """Get an item from a queue, or None once stop is set"""
+    while not stop.is_set():
+        try:
+            return items.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return None
+
+
+def process_video(input_path, output_path, steps, workers=None, read_ahead=READ_AHEAD_FRAMES, progress=None,
+                  cancel=None):
+    """
+    Apply operations to every frame of a video file.
+
+    Args:
+        input_path (str): The video file to read.
+        output_path (str): The video file to write, its extension selects the codec.
+        steps (list): The (name, params) operations to apply to each frame.
+        workers (int): The number of frame worker threads, all cores by default.
+        read_ahead (int): The number of decoded frames that may wait for a worker.
+        progress (callable): Called from the writer thread with (frames written, total frames or None).
+        cancel (threading.Event): Stops processing when set.
+
+    Returns:
+        VideoResult: The outcome, errors are reported in it instead of raised.
+
+    Raises:
+        BaseException: An unexpected error of a stage, e.g. a MemoryError in a frame worker, after the
+            other stages stopped and the partial output was removed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import cv2
+    import operations
+    from camera import VIDEO_CODECS
+
+    start = time.perf_counter()
+    root, extension = os.path.splitext(output_path)
+    codec = VIDEO_CODECS.get(extension.lower())
+    if codec is None:
+        return VideoResult(output_path, 0, 0.0, f"Unsupported video format {extension!r}, expected one of "
+                                                f"{', '.join(VIDEO_CODECS)}.", False)
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        return VideoResult(output_path, 0, 0.0, f"Failed to open video file {input_path}.", False)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    total = total if total > 0 else None
+    workers = workers or os.cpu_count() or 1
+    cancel = cancel or threading.Event()
+    temporary_path = f"{root}.{os.getpid()}.tmp{extension}"
+
+    # Set on an error or a cancel, every stage stops at its next queue operation
+    stop = threading.Event()
+    decoded = queue.Queue(read_ahead)
+    pending = queue.Queue(2 * workers)
+    # An unexpected exception of the decoder or the writer is raised again on this thread
+    state = {'frames': 0, 'error': None, 'exception': None}
+
+    def decode():
+        try:
+            while not stop.is_set():
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if not _put(decoded, frame, stop):
+                    break
+        except cv2.error as e:
+            state['error'] = str(e)
+            stop.set()
+        except BaseException as e:
+            state['exception'] = e
+            stop.set()
+        finally:
+            capture.release()
+            _put(decoded, None, stop)
+
+    def write():
+        writer = None
+        try:
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                if stop.is_set():
+                    # Keep draining, so the dispatcher never waits for room in the queue
+                    continue
+                try:
+                    image = future.result()
+                    if writer is None:
+                        writer = cv2.VideoWriter(temporary_path, cv2.VideoWriter_fourcc(*codec), fps,
+                                                 (image.shape[1], image.shape[0]))
+                        if not writer.isOpened():
+                            raise IOError(f"Failed to open {output_path} for writing.")
+                    writer.write(image)
+                except (OSError, ValueError, TypeError, cv2.error) as e:
+                    state['error'] = str(e)
+                    stop.set()
+                    continue
+                except BaseException as e:
+                    state['exception'] = e
+                    stop.set()
+                    continue
+                state['frames'] += 1
+                if progress is not None:
+                    progress(state['frames'], total)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    decoder = threading.Thread(target=decode, name='video-decoder', daemon=True)
+    writer_thread = threading.Thread(target=write, name='video-writer', daemon=True)
+    decoder.start()
+    writer_thread.start()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if cancel.is_set():
+                stop.set()
+            frame = _get(decoded, stop)
+            if frame is None:
+                break
+            # The decoded frame is not used elsewhere, in-place operations may modify it
+            _put(pending, executor.submit(operations.apply_operations, frame, steps, False), stop)
+    pending.put(None)
+    writer_thread.join()
+    decoder.join()
+
+    error = state['error']
+    cancelled = cancel.is_set() and error is None
+    try:
+        if state['exception'] is not None:
+            raise state['exception']
+        if error is None and not cancelled:
+            if state['frames'] == 0:
+                error = f"No frames could be read from {input_path}."
+            else:
+                os.replace(temporary_path, output_path)
+    except OSError as e:
+        error = str(e)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return VideoResult(output_path, state['frames'], time.perf_counter() - start, error, cancelled)
+
+
+def format_result(result):
+    """Return a line describing a VideoResult"""
+    name = os.path.basename(result.path)
+    if result.error:
+        return f"{name}: failed: {result.error}"
+    rate = result.frames / result.seconds if result.seconds > 0 else 0.0
+    state = "cancelled after" if result.cancelled else "wrote"
+    return f"{name}: {state} {result.frames} frames in {result.seconds:.1f} s ({rate:.1f} frames/s)"
+
+
+def add_arguments(parser):
+    """Register the video processing command line options, --output, --op, --workers and --format are shared"""
+    parser.add_argument('--video', nargs='+', metavar='INPUT',
+                        help="apply the --op operations to every frame of video files without opening the window")
+
+
+def check_arguments(parser, args):
+    """Validate the --format of parsed command line arguments with --video, exit through parser.error if it is unsupported"""
+    from camera import VIDEO_CODECS
+
+    if args.extension:
+        extension = args.extension if args.extension.startswith('.') else '.' + args.extension
+        if extension.lower() not in VIDEO_CODECS:
+            parser.error(f"unsupported video format {args.extension!r}, expected one of {', '.join(VIDEO_CODECS)}")
+        args.extension = extension
+
+
+def run_from_arguments(args):
+    """Process the videos described by parsed command line arguments and return the exit code"""
+    import operations
+    from camera import VIDEO_CODECS
+
+    if not args.output:
+        print("error: --output is required with --video")
+        return 2
+    try:
+        steps = [operations.parse_step(text) for text in args.op]
+    except (ValueError, FileNotFoundError) as e:
+        print(f"error: {e}")
+        return 2
+    os.makedirs(args.output, exist_ok=True)
+
+    failed = False
+    for input_path in args.video:
+        # --format was checked by check_arguments, inputs in other formats are written as AVI
+        extension = args.extension or os.path.splitext(input_path)[1]
+        if extension.lower() not in VIDEO_CODECS:
+            extension = '.avi'
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        output_path = os.path.join(args.output, name + extension)
+        started = time.perf_counter()
+
+        def report(done, total):
+            if done % 30 == 0 or done == total:
+                rate = done / max(time.perf_counter() - started, 1e-9)
+                print(f"\r{name}: {done}/{total or '?'} frames ({rate:.1f} frames/s)", end='', flush=True)
+
+        result = process_video(input_path, output_path, steps, args.workers, progress=report)
+        print("\r" + format_result(result))
+        failed = failed or result.error is not None
+    return 1 if failed else 0